@@ -1,5 +1,8 @@
+import hashlib
+import itertools
 import logging
 import math
+import pickle
 import pybullet as p
 import time
 import enum
@@ -13,11 +16,10 @@ import numpy as np
 import matplotlib.colors as colors
 import matplotlib.cm as cmx
 
-from arm_pytorch_utilities import tensor_utils, math_utils
+from arm_pytorch_utilities import tensor_utils
 
-import pytorch_kinematics as pk
-from base_experiments.env.pybullet_env import PybulletEnv, get_total_contact_force, make_box, state_action_color_pairs, \
-    ContactInfo, make_cylinder, closest_point_on_surface
+from base_experiments.env.pybullet_env import PybulletEnv, make_box, state_action_color_pairs, \
+    ContactInfo, make_cylinder, closest_points_on_surface, get_contact_wrench, get_contacts_by_body, IKSolver
 from base_experiments.env.env import InfoKeys, TrajectoryLoader, handle_data_format_for_state_diff, EnvDataSource
 from base_experiments import cfg
 from base_experiments.defines import NO_CONTACT_ID
@@ -113,6 +115,67 @@ class ReactionForceStrategy(enum.IntEnum):
     MEDIAN_OVER_MINI_STEPS = 3
 
 
+def angle_between(u, v):
+    """Numerically stable angle between two vectors; single vector version of math_utils.angle_between_stable"""
+    uv = np.multiply(u, np.linalg.norm(v))
+    vu = np.multiply(v, np.linalg.norm(u))
+    return 2 * math.atan2(np.linalg.norm(uv - vu), np.linalg.norm(uv + vu))
+
+
+def transform_between_poses(pose, other_pose):
+    """World frame transform of points moving with a body from where they are at pose to where they are at other_pose;
+    poses and the returned transform are pybullet (pos, xyzw) pairs"""
+    return p.multiplyTransforms(*other_pose, *p.invertTransform(*pose))
+
+
+class GroundTruthLogging(enum.IntEnum):
+    OFF = 0
+    POSES = 1
+    POSES_AND_DISTANCES = 2
+
+
+class StepInfoBuffers:
+    """High frequency info values of each sim step in a control step, recorded into arrays reused across control steps
+
+    Each key gets a buffer the first time it is observed; clearing only resets the counts. The arrays match what
+    stacking the values of the key would give, except that their dtype is promoted to fit all values observed since the
+    key's shape was set rather than only those since the last clear. Buffers grow if a control step overruns them.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self._buffers = {}
+        self._counts = {}
+
+    def clear(self):
+        for key in self._counts:
+            self._counts[key] = 0
+
+    def append(self, key, value):
+        value = np.asarray(value)
+        buffer = self._buffers.get(key)
+        n = self._counts.get(key, 0)
+        if buffer is None or (n == 0 and buffer.shape[1:] != value.shape):
+            buffer = self._buffers[key] = np.empty((self.capacity,) + value.shape, dtype=value.dtype)
+        else:
+            # like stacking, values of a key have to have the same shape
+            if value.shape != buffer.shape[1:]:
+                raise ValueError(f"{key} value of shape {value.shape} does not match the shape {buffer.shape[1:]} "
+                                 f"of its earlier values")
+            dtype = np.result_type(buffer.dtype, value.dtype)
+            if n == len(buffer) or dtype != buffer.dtype:
+                grown = np.empty((len(buffer) * 2 if n == len(buffer) else len(buffer),) + buffer.shape[1:],
+                                 dtype=dtype)
+                grown[:n] = buffer[:n]
+                buffer = self._buffers[key] = grown
+        buffer[n] = value
+        self._counts[key] = n + 1
+
+    def arrays(self):
+        """Copies of the values observed since the last clear, stacked along the first dimension"""
+        return {key: self._buffers[key][:n].copy() for key, n in self._counts.items() if n}
+
+
 class ArmEnv(PybulletEnv):
     """To start with we have a fixed gripper orientation so the state is 3D position only"""
     nu = 3
@@ -122,6 +185,8 @@ class ArmEnv(PybulletEnv):
     MAX_PUSH_DIST = 0.03
     FINGER_OPEN = 0.04
     FINGER_CLOSED = 0.01
+    # increase when scene setup changes so that scenes cached before then are not loaded
+    SCENE_CACHE_VERSION = 3
 
     @staticmethod
     def state_names():
@@ -191,6 +256,15 @@ class ArmEnv(PybulletEnv):
                  contact_residual_precision=None,
                  reaction_force_strategy=ReactionForceStrategy.MEDIAN_OVER_MINI_STEPS,
                  observe_additional_info_fn=None,
+                 pool_objects=False,
+                 snapshot_resets=False,
+                 scene_cache_seed=None,
+                 observe_every_sim_steps=1,
+                 ground_truth_logging=GroundTruthLogging.POSES_AND_DISTANCES,
+                 ground_truth_distance=1.,
+                 converge_pos_tolerance=None,
+                 converge_vel_tolerance=0.01,
+                 ik_waypoints=False,
                  **kwargs):
         """
         :param environment_level: what obstacles should show up in the environment
@@ -199,7 +273,7 @@ class ArmEnv(PybulletEnv):
         :param mini_steps how many mini control steps to divide the control step into;
         more is better for controller and allows greater force to prevent sliding
         :param wait_sim_steps_per_mini_step how many sim steps to wait per mini control step executed;
-        inversely proportional to mini_steps
+        inversely proportional to mini_steps; given at the default time step and scaled to the physics preset's
         :param contact_residual_threshold magnitude threshold on the reaction residual (measured force and torque
         at end effector) for when we should consider to be in contact with an object
         :param contact_residual_precision if specified, the inverse of a matrix representing the expected measurement
@@ -209,6 +283,25 @@ class ArmEnv(PybulletEnv):
         for normalization.
         :param reaction_force_strategy how to aggregate measured reaction forces over control step into 1 value
         :param observe_additional_info_fn function with a dictionary info argument that's run to observe high frequency state
+        :param pool_objects whether resets should restore the objects loaded on the first setup to their initial state
+        instead of removing and reloading them; randomly generated levels are always reloaded
+        :param snapshot_resets whether to save the settled simulation state at the end of a reset and restore it on
+        later resets with the same level, init, and goal instead of resetting and settling again; randomly generated
+        levels are always reset, as are scenes with bodies added since the snapshot (e.g. drawn meshes)
+        :param scene_cache_seed if given, seed with it before setting up the scene and cache the settled scene on disk
+        under cfg.DATA_DIR, keyed by the env class, level, init, goal, physics preset, and this seed; later
+        constructions with the same key load the scene from the cache instead of generating and settling it
+        :param observe_every_sim_steps observe high frequency info (and update the contact detector) only every this
+        many sim steps; the sim step sampling each mini step's reaction force and the end of each mini step are always
+        observed, so a large value observes only those
+        :param ground_truth_logging what ground truth of the scene objects to add to the info of each control step
+        :param ground_truth_distance objects further than this from the robot are logged with an infinite distance
+        :param converge_pos_tolerance if given, end each mini step early once the end effector is within this distance
+        of its commanded position and slower than converge_vel_tolerance, after sampling the mini step's reaction
+        force; wait_sim_steps_per_mini_step becomes the cap on its sim steps
+        :param converge_vel_tolerance end effector speed below which it is considered settled
+        :param ik_waypoints whether to solve the IK of all mini step waypoints of an action up front, each starting from
+        the last solution, instead of from the arm's state as each mini step starts; makes arm trajectories repeatable
         :param kwargs:
         """
         super().__init__(**kwargs, default_debug_height=0.1, camera_dist=camera_dist)
@@ -219,14 +312,28 @@ class ArmEnv(PybulletEnv):
         self.sim_step_wait = sim_step_wait
         # as long as this is above a certain amount we won't exceed it in freespace pushing if we have many mini steps
         self.mini_steps = mini_steps
-        self.wait_sim_step_per_mini_step = wait_sim_steps_per_mini_step
+        self.wait_sim_step_per_mini_step = self.sim_steps(wait_sim_steps_per_mini_step)
         self.reaction_force_strategy = reaction_force_strategy
         self.dist_for_done = dist_for_done
         self.observe_additional_info_fn = observe_additional_info_fn
+        self.observe_every_sim_steps = max(1, observe_every_sim_steps)
+        self.ground_truth_logging = GroundTruthLogging(ground_truth_logging)
+        self.ground_truth_distance = ground_truth_distance
+        self.converge_pos_tolerance = converge_pos_tolerance
+        self.converge_vel_tolerance = converge_vel_tolerance
+        self.ik_waypoints = ik_waypoints
 
         # object IDs
         self.immovable = []
         self.movable = []
+        # object whose contacts the end effector displacement in contact is tracked with
+        self.target_object_id = None
+        self.pool_objects = pool_objects
+        # (level, goal) the pooled objects were set up for, and their initial states
+        self._object_pool = None
+        self.snapshot_resets = snapshot_resets
+        # (level, init, goal) the reset snapshot was saved for, its pybullet state ID, and the env state
+        self._reset_snapshot = None
 
         # debug parameter for extruding objects so penetration is measured wrt the x-y plane
         self.extrude_objects_in_z = False
@@ -235,6 +342,7 @@ class ArmEnv(PybulletEnv):
         self.goal = None
         self.init = None
         self.armId = None
+        self._ik = None
 
         self._debug_visualizations = {
             DebugVisualization.STATE: False,
@@ -244,35 +352,110 @@ class ArmEnv(PybulletEnv):
             DebugVisualization.GOAL: False,
             DebugVisualization.INIT: False,
         }
-        if debug_visualizations is not None:
+        # nothing would see the drawings without visualization
+        if debug_visualizations is not None and self.visualize:
             self._debug_visualizations.update(debug_visualizations)
         self._contact_debug_names = []
 
         # avoid the spike at the start of each mini step from rapid acceleration
-        self._steps_since_start_to_get_reaction = 5
+        self._steps_since_start_to_get_reaction = self.sim_steps(5)
+        # info is observed before and after each of the sim steps waited in every mini step
+        self._contact_info = StepInfoBuffers(self.mini_steps * (self.wait_sim_step_per_mini_step + 1))
+        # end effector contacts of the sim step being observed, by body ID
+        self._ee_contacts = {}
         self._clear_state_between_control_steps()
         self._abort_movement = False
 
         self.set_task_config(goal, init)
+        self._scene_cache_file = None
+        self._cached_scene = None
+        if scene_cache_seed is not None:
+            self.seed(scene_cache_seed)
+            self._scene_cache_file = self._get_scene_cache_file(scene_cache_seed)
+            self._cached_scene = self._load_scene_cache_info()
         self._setup_experiment()
         self._contact_detector = self.create_contact_detector(contact_residual_threshold, contact_residual_precision)
-        # start at rest
-        for _ in range(1000):
-            p.stepSimulation()
+        if not self._restore_cached_scene():
+            # start at rest
+            for _ in range(1000):
+                p.stepSimulation(physicsClientId=self.physics_client)
+            self._save_scene_cache()
+        # only used when constructing
+        self._cached_scene = None
         self.state = self._obs()
 
     @property
     def contact_detector(self) -> ContactDetector:
         return self._contact_detector
 
+    @property
+    def ik(self) -> IKSolver:
+        """Cached IK of the arm's end effector"""
+        if self._ik is None or self._ik.body_id != self.armId:
+            self._ik = IKSolver(self.armId, self.endEffectorIndex, physics_client=self.physics_client)
+        return self._ik
+
+    # --- on disk scene cache
+    def _scene_config(self):
+        """Configuration that determines the generated scene, other than the seed"""
+        # the scene is settled with the preset's time step and solver parameters
+        return self.level, np.ravel(self.init).tolist(), np.ravel(self.goal).tolist(), self.physics_preset.value
+
+    def _get_scene_cache_file(self, seed):
+        config = repr((type(self).__name__, self._scene_config(), seed, self.SCENE_CACHE_VERSION))
+        digest = hashlib.sha1(config.encode()).hexdigest()[:12]
+        return os.path.join(cfg.DATA_DIR, "scene_cache", f"{type(self).__name__}_{self.level.name}_{seed}_{digest}")
+
+    def _load_scene_cache_info(self):
+        if not os.path.exists(f"{self._scene_cache_file}.pkl") or not os.path.exists(
+                f"{self._scene_cache_file}.bullet"):
+            return None
+        with open(f"{self._scene_cache_file}.pkl", 'rb') as f:
+            return pickle.load(f)
+
+    def _scene_cache_info(self):
+        """Information needed to set up the same scene without generating it again"""
+        return {'num_bodies': p.getNumBodies(physicsClientId=self.physics_client),
+                'immovable': list(self.immovable),
+                'movable': list(self.movable),
+                # generating the scene consumes random numbers that loading it from the cache does not
+                'random_state': random.getstate()}
+
+    def _restore_cached_scene(self):
+        if self._cached_scene is None:
+            return False
+        # the scene has to be set up with the same bodies for the cached state to apply
+        info = self._scene_cache_info()
+        if any(info[k] != self._cached_scene[k] for k in ('num_bodies', 'immovable', 'movable')):
+            logger.warning("scene cache %s does not match the scene that was set up; regenerating it",
+                           self._scene_cache_file)
+            return False
+        p.restoreState(fileName=f"{self._scene_cache_file}.bullet", physicsClientId=self.physics_client)
+        random.setstate(self._cached_scene['random_state'])
+        logger.info("loaded scene from cache %s", self._scene_cache_file)
+        return True
+
+    def _save_scene_cache(self):
+        if self._scene_cache_file is None:
+            return
+        os.makedirs(os.path.dirname(self._scene_cache_file), exist_ok=True)
+        p.saveBullet(f"{self._scene_cache_file}.bullet", physicsClientId=self.physics_client)
+        with open(f"{self._scene_cache_file}.pkl", 'wb') as f:
+            pickle.dump(self._scene_cache_info(), f)
+        logger.info("saved scene to cache %s", self._scene_cache_file)
+
     # --- initialization and task configuration
     def _clear_state_between_control_steps(self):
         self._sim_step = 0
+        # sim steps taken by the control step, and the mini step and sim steps since its start being observed
+        self._control_step_sim_steps = 0
+        self._mini_step = 0
+        self._mini_step_sim_step = 0
         self._mini_step_contact = {'full': np.zeros((self.mini_steps + 1, 3)),
                                    'torque': np.zeros((self.mini_steps + 1, 3)),
                                    'mag': np.zeros(self.mini_steps + 1),
                                    'id': np.ones(self.mini_steps + 1) * NO_CONTACT_ID}
-        self._contact_info = {}
+        self._contact_info.clear()
         self._largest_contact = {}
         self._reaction_force = np.zeros(2)
 
@@ -300,14 +483,11 @@ class ArmEnv(PybulletEnv):
             self._calculate_init_joints()
 
     def _calculate_init_joints(self):
-        self.initJoints = list(p.calculateInverseKinematics(self.armId,
-                                                            self.endEffectorIndex,
-                                                            self.init,
-                                                            self.endEffectorOrientation))
+        self.initJoints = list(self.ik.solve(self.init, self.endEffectorOrientation))
 
     def set_state(self, state, action=None):
         for i in self.armInds:
-            p.resetJointState(self.armId, i, state[i])
+            p.resetJointState(self.armId, i, state[i], physicsClientId=self.physics_client)
         self.state = state
         self._draw_state()
         if action is not None:
@@ -328,20 +508,15 @@ class ArmEnv(PybulletEnv):
         if self.level == 0:
             pass
         elif self.level in [1, 2]:
-            half_extents = [0.2, 0.05, 0.3]
-            colId = p.createCollisionShape(p.GEOM_BOX, halfExtents=half_extents)
-            visId = p.createVisualShape(p.GEOM_BOX, halfExtents=half_extents, rgbaColor=[0.2, 0.2, 0.2, 0.8])
-            wallId = p.createMultiBody(0, colId, visId, basePosition=[0.6, 0.30, 0.2],
-                                       baseOrientation=p.getQuaternionFromEuler([0, 0, 1.1]))
-            p.changeDynamics(wallId, -1, lateralFriction=1)
-            self.immovable.append(wallId)
+            self.immovable.append(make_box([0.2, 0.05, 0.3], [0.6, 0.30, 0.2], [0, 0, 1.1], lateral_friction=1,
+                                           physics_client=self.physics_client))
 
         for wallId in self.immovable:
-            p.changeVisualShape(wallId, -1, rgbaColor=[0.2, 0.2, 0.2, 0.8])
+            p.changeVisualShape(wallId, -1, rgbaColor=[0.2, 0.2, 0.2, 0.8], physicsClientId=self.physics_client)
 
     def _setup_experiment(self):
         # add plane to push on (slightly below the base of the robot)
-        self.planeId = p.loadURDF("plane.urdf", [0, 0, 0], useFixedBase=True)
+        self.planeId = p.loadURDF("plane.urdf", [0, 0, 0], useFixedBase=True, physicsClientId=self.physics_client)
 
         self._setup_gripper()
         self._setup_objects()
@@ -352,14 +527,15 @@ class ArmEnv(PybulletEnv):
         self._draw_state()
 
         # set gravity
-        p.setGravity(0, 0, -10)
+        p.setGravity(0, 0, -10, physicsClientId=self.physics_client)
 
     def _setup_gripper(self):
         # add kuka arm
         # self.armId = p.loadSDF("kuka_iiwa/kuka_with_gripper2.sdf")[0]
         # self.armId = p.loadURDF("franka_panda/panda.urdf", useFixedBase=True)
-        self.armId = p.loadURDF("kuka_iiwa/model.urdf", [0, 0, 0], useFixedBase=True)
-        self.reset_base_link_frame(self.armId, [0, 0, 0], [0, 0, 0])
+        self.armId = p.loadURDF("kuka_iiwa/model.urdf", [0, 0, 0], useFixedBase=True,
+                                physicsClientId=self.physics_client)
+        self.reset_base_link_frame(self.armId, [0, 0, 0], [0, 0, 0], physics_client=self.physics_client)
 
         # TODO modify dynamics to induce traps
         # for j in range(p.getNumJoints(self.armId)):
@@ -368,7 +544,7 @@ class ArmEnv(PybulletEnv):
         # orientation of the end effector
         self.endEffectorOrientation = p.getQuaternionFromEuler([0, math.pi / 2, 0])
         self.endEffectorIndex = kukaEndEffectorIndex
-        self.numJoints = p.getNumJoints(self.armId)
+        self.numJoints = p.getNumJoints(self.armId, physicsClientId=self.physics_client)
         # get the joint ids
         # TODO try out arm with attached grippers
         # self.armInds = [i for i in range(pandaNumDofs)]
@@ -392,18 +568,18 @@ class ArmEnv(PybulletEnv):
         #     0.00001, 0.00001, 0.00001, 0.00001
         # ]
 
-        p.enableJointForceTorqueSensor(self.armId, self.endEffectorIndex)
+        p.enableJointForceTorqueSensor(self.armId, self.endEffectorIndex, physicsClientId=self.physics_client)
         self._calculate_init_joints()
         for i in self.armInds:
-            p.resetJointState(self.armId, i, self.initJoints[i])
+            p.resetJointState(self.armId, i, self.initJoints[i], physicsClientId=self.physics_client)
         # self.open_gripper()
         # self.close_gripper()
 
-        self._make_robot_translucent(self.armId)
+        self._make_robot_translucent(self.armId, physics_client=self.physics_client)
 
     def visualize_rollouts(self, rollout, state_cmap='Blues_r', contact_cmap='Reds_r'):
         """In GUI mode, show how the sequence of states will look like"""
-        if rollout is None:
+        if rollout is None or not self.visualize:
             return
         if type(rollout) is tuple and len(rollout) == 3:
             states, contact_model_active, center_points = rollout
@@ -413,20 +589,19 @@ class ArmEnv(PybulletEnv):
             center_points = [None]
         # assume states is iterable, so could be a bunch of row vectors
         T = len(states)
+        point_name = 'rx{}'.format(state_cmap)
+        line_name = 'tx{}'.format(state_cmap)
         if T > 0:
+            if torch.is_tensor(states):
+                states = states.cpu().numpy()
             smap = cmx.ScalarMappable(norm=colors.Normalize(vmin=0, vmax=T), cmap=state_cmap)
             cmap = cmx.ScalarMappable(norm=colors.Normalize(vmin=0, vmax=T), cmap=contact_cmap)
-            prev_pos = None
-            for t in range(T):
-                pos = self.get_ee_pos(states[t])
-                rgba = cmap.to_rgba(t) if contact_model_active[t] else smap.to_rgba(t)
-                self._dd.draw_point('rx{}.{}'.format(state_cmap, t), pos, rgba[:-1])
-                if t > 0:
-                    self._dd.draw_2d_line('tx{}.{}'.format(state_cmap, t), prev_pos, pos - prev_pos, scale=1,
-                                          color=rgba[:-1])
-                prev_pos = pos
-        self._dd.clear_visualization_after('rx{}'.format(state_cmap), T)
-        self._dd.clear_visualization_after('tx{}'.format(state_cmap), T)
+            pos = np.stack([self.get_ee_pos(states[t]) for t in range(T)])
+            rgbs = np.array([(cmap.to_rgba(t) if contact_model_active[t] else smap.to_rgba(t))[:-1] for t in range(T)])
+            self._dd.draw_points(point_name, pos, rgbs)
+            self._dd.draw_2d_lines(line_name, pos[:-1], pos[1:] - pos[:-1], rgbs[1:], scale=1)
+        else:
+            self._dd.clear_visualizations([point_name, line_name])
 
         if center_points[0] is not None:
             obj_center_color_maps = ['Purples_r', 'Greens_r', 'Greys_r']
@@ -443,48 +618,42 @@ class ArmEnv(PybulletEnv):
                 self.visualize_rollouts([], state_cmap=obj_center_color_maps[j % len(obj_center_color_maps)])
 
     def visualize_goal_set(self, states):
-        if states is None:
+        if states is None or not self.visualize:
             return
         T = len(states)
-        for t in range(T):
-            pos = self.get_ee_pos(states[t])
-            c = (t + 1) / (T + 1)
-            self._dd.draw_point('gs.{}'.format(t), pos, (c, c, c))
-        self._dd.clear_visualization_after('gs', T)
+        c = (np.arange(T) + 1) / (T + 1)
+        self._dd.draw_points('gs', [self.get_ee_pos(states[t]) for t in range(T)], np.stack((c, c, c), axis=1))
 
     def visualize_trap_set(self, trap_set):
-        if trap_set is None:
+        if trap_set is None or not self.visualize:
             return
         T = len(trap_set)
+        poses = []
         for t in range(T):
-            c = (t + 1) / (T + 1)
             # decide whether we're given state and action or just state
             if len(trap_set[t]) == 2:
                 state, action = trap_set[t]
                 self._draw_action(action.cpu().numpy(), old_state=state.cpu().numpy(), debug=t + 1)
             else:
                 state = trap_set[t]
-            pose = self.get_ee_pos(state)
-            self._dd.draw_point('ts.{}'.format(t), pose, (1, 0, c))
-        self._dd.clear_visualization_after('ts', T)
+            poses.append(self.get_ee_pos(state))
+        c = (np.arange(T) + 1) / (T + 1)
+        self._dd.draw_points('ts', poses, np.stack((np.ones(T), np.zeros(T), c), axis=1))
         self._dd.clear_visualization_after('u', T + 1)
 
     def visualize_state_actions(self, base_name, states, actions, state_c, action_c, action_scale):
+        if not self.visualize:
+            return
         if torch.is_tensor(states):
             states = states.cpu()
             if actions is not None:
                 actions = actions.cpu()
-        j = -1
-        for j in range(len(states)):
-            p = self.get_ee_pos(states[j])
-            name = '{}.{}'.format(base_name, j)
-            self._dd.draw_point(name, p, color=state_c)
-            if actions is not None:
-                # draw action
-                name = '{}a.{}'.format(base_name, j)
-                self._dd.draw_2d_line(name, p, actions[j], color=action_c, scale=action_scale)
-        self._dd.clear_visualization_after(base_name, j + 1)
-        self._dd.clear_visualization_after('{}a'.format(base_name), j + 1)
+        pos = [self.get_ee_pos(states[j]) for j in range(len(states))]
+        self._dd.draw_points(base_name, pos, color=state_c)
+        if actions is not None:
+            self._dd.draw_2d_lines('{}a'.format(base_name), pos, actions, color=action_c, scale=action_scale)
+        else:
+            self._dd.clear_visualizations(['{}a'.format(base_name)])
 
     def visualize_prediction_error(self, predicted_state):
         """In GUI mode, show the difference between the predicted state and the current actual state"""
@@ -504,6 +673,8 @@ class ArmEnv(PybulletEnv):
             self._draw_reaction_force(self.state[3:6], 'sr', (0, 0, 0))
 
     def _draw_action(self, action, old_state=None, debug=0):
+        if not self.visualize:
+            return
         if old_state is None:
             old_state = self._obs()
         start = old_state[:3]
@@ -524,13 +695,14 @@ class ArmEnv(PybulletEnv):
         return state
 
     def _observe_joints(self):
-        states = p.getJointStates(self.armId, self.armInds)
+        states = p.getJointStates(self.armId, self.armInds, physicsClientId=self.physics_client)
         # retrieve just joint position
         pos = [state[0] for state in states]
         return pos
 
     def _observe_ee(self, return_z=True, return_orientation=False):
-        link_info = p.getLinkState(self.armId, self.endEffectorIndex, computeForwardKinematics=True)
+        link_info = p.getLinkState(self.armId, self.endEffectorIndex, computeForwardKinematics=True,
+                                   physicsClientId=self.physics_client)
         pos = link_info[4]
         if not return_z:
             pos = pos[:2]
@@ -554,65 +726,74 @@ class ArmEnv(PybulletEnv):
             raise NotImplementedError("Not implemented max over control step reaction torque")
 
     def _observe_additional_info(self, info, visualize=True):
-        joint_pos, joint_vel, joint_reaction_force, joint_applied = p.getJointState(self.armId, self.endEffectorIndex)
+        joint_pos, joint_vel, joint_reaction_force, joint_applied = p.getJointState(self.armId, self.endEffectorIndex,
+                                                                                    physicsClientId=self.physics_client)
         info['pv'] = joint_vel
 
         # transform reaction to world frame
-        states = p.getLinkState(self.armId, self.endEffectorIndex)
+        states = p.getLinkState(self.armId, self.endEffectorIndex, physicsClientId=self.physics_client)
         world_link_orientation = states[5]
         r = p.rotateVector(world_link_orientation, joint_reaction_force[:3])
         t = p.rotateVector(world_link_orientation, joint_reaction_force[3:])
 
         self._observe_raw_reaction_force(info, r, t, visualize)
 
-    def _observe_info(self, visualize=True):
+    def _mini_step_position(self):
+        """Mini step the current sim step belongs to, and how many sim steps since the start of that mini step"""
+        if self.converge_pos_tolerance is not None:
+            return min(self._mini_step, self.mini_steps), self._mini_step_sim_step
+        # otherwise counted as if each mini step took wait_sim_step_per_mini_step sim steps
+        mini_step, step_since_start = divmod(self._sim_step, self.wait_sim_step_per_mini_step)
+        # few wait steps per mini step (such as with large time steps) overrun the count into the last slot
+        return min(mini_step, self.mini_steps), step_since_start
+
+    def _observe_info(self, visualize=True, decimate=True):
+        if decimate and self._sim_step % self.observe_every_sim_steps and \
+                self._mini_step_position()[1] != self._steps_since_start_to_get_reaction:
+            self._sim_step += 1
+            self._mini_step_sim_step += 1
+            return
         info = {}
 
+        self._ee_contacts = self.get_ee_contacts()
         self._observe_additional_info(info, visualize)
         if self.observe_additional_info_fn is not None:
             self.observe_additional_info_fn(info)
         self._sim_step += 1
+        self._mini_step_sim_step += 1
 
         for key, value in info.items():
-            if key not in self._contact_info:
-                self._contact_info[key] = []
-            self._contact_info[key].append(value)
+            self._contact_info.append(key, value)
 
     def get_ee_contact_info(self, bodyId):
         # changes when end effector type changes
-        return p.getContactPoints(bodyId, self.armId, linkIndexB=self.endEffectorIndex)
+        return p.getContactPoints(bodyId, self.armId, linkIndexB=self.endEffectorIndex,
+                                  physicsClientId=self.physics_client)
 
-    def _observe_ee_to_world_tf(self):
-        new_ee_pos, new_ee_orientation = self._observe_ee(return_z=True, return_orientation=True)
-        pos = torch.tensor(new_ee_pos)
-        rot = torch.tensor(new_ee_orientation)
-        m = pk.pos_rot_to_matrix(pos, rot)
-        return pk.Transform3d(matrix=m)
+    def get_ee_contacts(self):
+        """Contacts of the end effector with each body from a single query, as get_ee_contact_info gives them"""
+        return get_contacts_by_body(self.armId, link_index=self.endEffectorIndex, flip=True,
+                                    physics_client=self.physics_client)
 
     def _start_move_step(self):
-        self.last_ee_to_world_tf = self._observe_ee_to_world_tf()
+        self.last_ee_pose = self._observe_ee(return_z=True, return_orientation=True)
 
     def _observe_dx(self, info, reaction_force, reaction_torque):
+        # single poses per sim step, so use pybullet's transforms rather than paying torch's overhead
         new_ee_pos, new_ee_orientation = self._observe_ee(return_z=True, return_orientation=True)
         pose = (new_ee_pos, new_ee_orientation)
-        pos = torch.tensor(new_ee_pos)
-        rot = torch.tensor(new_ee_orientation)
-        m = pk.pos_rot_to_matrix(pos, rot)
-        ee_to_world_tf = pk.Transform3d(matrix=m)
 
         max_friction_cone_angle = 45 * math.pi / 180
         if self.contact_detector.observe_residual(np.r_[reaction_force, reaction_torque], pose):
-            # we have the current ee to world
-            A_to_B_world = ee_to_world_tf.compose(self.last_ee_to_world_tf.inverse())
-            B_to_A_world = A_to_B_world.inverse()
+            # transform from the current ee pose to the last one, both in world frame
+            B_to_A_world = transform_between_poses(pose, self.last_ee_pose)
 
             # find point on the robot in contact
-            contacts = self.get_ee_contact_info(self.target_object_id)
+            contacts = self._ee_contacts.get(self.target_object_id, ())
             dx = np.zeros(2)
             for c in contacts:
                 pt_on_robot = c[ContactInfo.POS_B]
-                prev_pt_on_robot = B_to_A_world.transform_points(torch.tensor(pt_on_robot).view(1, -1))
-                prev_pt_on_robot = prev_pt_on_robot.numpy().flatten()
+                prev_pt_on_robot = np.array(p.multiplyTransforms(*B_to_A_world, pt_on_robot, (0, 0, 0, 1))[0])
                 size = c[ContactInfo.NORMAL_MAG]
 
                 # ignore sliding
@@ -623,9 +804,7 @@ class ArmEnv(PybulletEnv):
                 # self.vis.draw_2d_line('contact_normal', pt_on_robot, obj_normal, (0, 0, 1), scale=size / 10)
 
                 this_dx = pt_on_robot - prev_pt_on_robot
-                from_obj_normal = math_utils.angle_between_stable(torch.tensor(obj_normal).view(1, -1),
-                                                                  -torch.tensor(this_dx).view(1, -1))
-                from_obj_normal = from_obj_normal.item()
+                from_obj_normal = angle_between(obj_normal, -this_dx)
                 pushing = from_obj_normal < max_friction_cone_angle
 
                 # if size > 10:
@@ -637,7 +816,7 @@ class ArmEnv(PybulletEnv):
 
             self.contact_detector.observe_dx(dx)
             info[InfoKeys.DEE_IN_CONTACT] = dx
-        self.last_ee_to_world_tf = ee_to_world_tf
+        self.last_ee_pose = pose
         # save end effector pose
         info[InfoKeys.HIGH_FREQ_EE_POSE] = np.r_[new_ee_pos, new_ee_orientation]
 
@@ -651,21 +830,21 @@ class ArmEnv(PybulletEnv):
         info[name] = reaction_force
         reaction_force_size = np.linalg.norm(reaction_force)
         # see if we should save it as the reaction force for this mini-step
-        mini_step, step_since_start = divmod(self._sim_step, self.wait_sim_step_per_mini_step)
+        mini_step, step_since_start = self._mini_step_position()
 
         # detect what we are in contact with
-        for bodyId in self.movable + self.immovable:
-            contactInfo = self.get_ee_contact_info(bodyId)
-            # assume at most single body in contact
-            if len(contactInfo):
-                self._mini_step_contact['id'][mini_step] = bodyId
-                pt = contactInfo[0][ContactInfo.POS_A]
-                info[InfoKeys.HIGH_FREQ_CONTACT_POINT] = pt
-                break
-        else:
-            info[InfoKeys.HIGH_FREQ_CONTACT_POINT] = [0, 0, 0]
-
-        if step_since_start is self._steps_since_start_to_get_reaction:
+        pt = [0., 0., 0.]
+        if self._ee_contacts:
+            for bodyId in itertools.chain(self.movable, self.immovable):
+                contactInfo = self._ee_contacts.get(bodyId)
+                # assume at most single body in contact
+                if contactInfo:
+                    self._mini_step_contact['id'][mini_step] = bodyId
+                    pt = contactInfo[0][ContactInfo.POS_A]
+                    break
+        info[InfoKeys.HIGH_FREQ_CONTACT_POINT] = pt
+
+        if step_since_start == self._steps_since_start_to_get_reaction:
             self._mini_step_contact['full'][mini_step] = reaction_force
             self._mini_step_contact['torque'][mini_step] = reaction_torque
             self._mini_step_contact['mag'][mini_step] = reaction_force_size
@@ -681,7 +860,7 @@ class ArmEnv(PybulletEnv):
                 self._draw_reaction_force(reaction_force, name, (1, 0, 1))
 
     def _aggregate_info(self):
-        info = {key: np.stack(value, axis=0) for key, value in self._contact_info.items() if len(value)}
+        info = self._contact_info.arrays()
         info[InfoKeys.LOW_FREQ_REACTION_F], info[InfoKeys.LOW_FREQ_REACTION_T] = self._observe_reaction_force_torque()
         name = InfoKeys.DEE_IN_CONTACT
         if name in info:
@@ -691,15 +870,25 @@ class ArmEnv(PybulletEnv):
         # count how many times we were in contact with each object
         unique_contact_ids, counts = np.unique(self._mini_step_contact['id'], return_counts=True)
         info[InfoKeys.CONTACT_ID] = {int(ids): count for ids, count in zip(unique_contact_ids, counts)}
+        info[InfoKeys.SIM_STEPS] = self._control_step_sim_steps
 
         # ground truth object information
-        if len(self.movable + self.immovable):
-            for obj_id in self.movable + self.immovable:
-                pose = p.getBasePositionAndOrientation(obj_id)
-                c = p.getClosestPoints(obj_id, self.robot_id, 100000)
-                info[f"obj{obj_id}pose"] = np.concatenate([pose[0], pose[1]])
-                # for multi-link bodies, will return 1 per combination; store the min
-                info[f"obj{obj_id}distance"] = min(cc[ContactInfo.DISTANCE] for cc in c)
+        objects = self.movable + self.immovable
+        if self.ground_truth_logging is not GroundTruthLogging.OFF and len(objects):
+            info[InfoKeys.OBJ_IDS] = np.array(objects)
+            poses = info[InfoKeys.OBJ_POSES] = np.empty((len(objects), 7))
+            for i, obj_id in enumerate(objects):
+                pos, orientation = p.getBasePositionAndOrientation(obj_id, physicsClientId=self.physics_client)
+                poses[i, :3] = pos
+                poses[i, 3:] = orientation
+            if self.ground_truth_logging is GroundTruthLogging.POSES_AND_DISTANCES:
+                distances = info[InfoKeys.OBJ_DISTANCES] = np.full(len(objects), np.inf)
+                for i, obj_id in enumerate(objects):
+                    c = p.getClosestPoints(obj_id, self.robot_id, self.ground_truth_distance,
+                                           physicsClientId=self.physics_client)
+                    # for multi-link bodies, will return 1 per combination; store the min
+                    if len(c):
+                        distances[i] = min(cc[ContactInfo.DISTANCE] for cc in c)
 
         return info
 
@@ -714,16 +903,17 @@ class ArmEnv(PybulletEnv):
         """Evaluate action after finishing it; step should not modify state after calling this"""
         self.state = np.array(self._obs())
 
-        # track trajectory
-        prev_block = self.get_ee_pos(old_state)
-        new_block = self.get_ee_pos(self.state)
-        self._dd.draw_transition(prev_block, new_block)
+        if self.visualize:
+            # track trajectory
+            prev_block = self.get_ee_pos(old_state)
+            new_block = self.get_ee_pos(self.state)
+            self._dd.draw_transition(prev_block, new_block)
 
-        # render current pose
-        self._draw_state()
+            # render current pose
+            self._draw_state()
 
         cost, done = self.evaluate_cost(self.state, action)
-        if cost is not None:
+        if cost is not None and self.visualize:
             self._dd.draw_text('cost', '{0:.3f}'.format(cost), 0)
 
         # summarize information per sim step into information for entire control step
@@ -736,13 +926,17 @@ class ArmEnv(PybulletEnv):
 
     # --- control (commonly overridden)
     def _move_pusher(self, end):
-        jointPoses = p.calculateInverseKinematics(self.armId,
-                                                  self.endEffectorIndex,
-                                                  end,
-                                                  self.endEffectorOrientation)
+        jointPoses = self.ik.solve(end, self.endEffectorOrientation)
         self._send_move_command(jointPoses)
         # self.close_gripper()
 
+    def _waypoint_joints(self, start, end):
+        """Joint commands for the mini step waypoints from start to end, or None for each to solve as it is reached"""
+        if not self.ik_waypoints:
+            return [None] * self.mini_steps
+        waypoints = [linear_interpolate(start, end, (step + 1) / self.mini_steps) for step in range(self.mini_steps)]
+        return self.ik.solve_waypoints(waypoints, self.endEffectorOrientation)
+
     def _send_move_command(self, jointPoses):
         num_arm_indices = len(self.armInds)
         p.setJointMotorControlArray(self.armId, self.armInds, controlMode=p.POSITION_CONTROL,
@@ -751,7 +945,7 @@ class ArmEnv(PybulletEnv):
                                     # forces=[self.MAX_FORCE] * num_arm_indices,
                                     forces=[100, 100, 60, 60, 50, 40, 40],
                                     positionGains=[0.3] * num_arm_indices,
-                                    velocityGains=[1] * num_arm_indices)
+                                    velocityGains=[1] * num_arm_indices, physicsClientId=self.physics_client)
 
     def abort_movement(self):
         self._abort_movement = True
@@ -759,19 +953,45 @@ class ArmEnv(PybulletEnv):
         current_ee = self._observe_ee(return_z=True)
         self._move_pusher(current_ee)
 
-    def _move_and_wait(self, eePos, steps_to_wait=50):
-        # execute the action
+    def _observe_ee_velocity(self):
+        return p.getLinkState(self.armId, self.endEffectorIndex, computeLinkVelocity=True,
+                              physicsClientId=self.physics_client)[6]
+
+    def _move_error(self, target):
+        """Distance of the robot from the target given to _move_pusher"""
+        return np.linalg.norm(np.subtract(self._observe_ee(return_z=True), target))
+
+    def _mini_step_converged(self, target):
+        # need the reaction force sample of the mini step
+        if self.converge_pos_tolerance is None or \
+                self._mini_step_sim_step <= self._steps_since_start_to_get_reaction:
+            return False
+        return self._move_error(target) < self.converge_pos_tolerance and \
+            np.linalg.norm(self._observe_ee_velocity()) < self.converge_vel_tolerance
+
+    def _move_and_wait(self, eePos, steps_to_wait=50, joints=None):
+        # execute the action, with joints solved for eePos if given
         self._start_move_step()
-        self._move_pusher(eePos)
-        p.stepSimulation()
+        if joints is None:
+            self._move_pusher(eePos)
+        else:
+            self._send_move_command(joints)
+        self._mini_step_sim_step = 0
+        p.stepSimulation(physicsClientId=self.physics_client)
+        self._record_video_frame()
+        sim_steps = 1
         for _ in range(steps_to_wait):
             self._observe_info()
-            p.stepSimulation()
-            if self._abort_movement:
+            p.stepSimulation(physicsClientId=self.physics_client)
+            self._record_video_frame()
+            sim_steps += 1
+            if self._abort_movement or self._mini_step_converged(eePos):
                 break
             if self.mode is p.GUI and self.sim_step_wait:
                 time.sleep(self.sim_step_wait)
-        self._observe_info()
+        self._observe_info(decimate=False)
+        self._control_step_sim_steps += sim_steps
+        self._mini_step += 1
 
     def _unpack_action(self, action):
         dx = action[0] * self.MAX_PUSH_DIST
@@ -795,10 +1015,12 @@ class ArmEnv(PybulletEnv):
             self._dd.draw_point('final eepos', final_ee_pos, color=(1, 0.5, 0.5))
 
         self._abort_movement = False
+        waypoint_joints = self._waypoint_joints(ee_pos, final_ee_pos)
         # execute push with mini-steps
         for step in range(self.mini_steps):
             intermediate_ee_pos = linear_interpolate(ee_pos, final_ee_pos, (step + 1) / self.mini_steps)
-            self._move_and_wait(intermediate_ee_pos, steps_to_wait=self.wait_sim_step_per_mini_step)
+            self._move_and_wait(intermediate_ee_pos, steps_to_wait=self.wait_sim_step_per_mini_step,
+                                joints=waypoint_joints[step])
             if self._abort_movement:
                 break
 
@@ -806,12 +1028,51 @@ class ArmEnv(PybulletEnv):
 
         return np.copy(self.state), -cost, done, info
 
+    def _reset_snapshot_key(self):
+        return self.level, tuple(np.ravel(self.init)), tuple(np.ravel(self.goal))
+
+    def _save_reset_snapshot(self):
+        if not self.snapshot_resets or self.level is Levels.RANDOM:
+            return
+        if self._reset_snapshot is not None:
+            p.removeState(self._reset_snapshot[1], physicsClientId=self.physics_client)
+        self._reset_snapshot = self._reset_snapshot_key(), p.saveState(physicsClientId=self.physics_client), np.copy(
+            self.state)
+
+    def _restore_reset_snapshot(self):
+        """Restore the simulation and env state saved at the end of a previous reset with the same configuration;
+        returns whether a snapshot was restored"""
+        if self._reset_snapshot is None or self._reset_snapshot[0] != self._reset_snapshot_key():
+            return False
+        try:
+            p.restoreState(self._reset_snapshot[1], physicsClientId=self.physics_client)
+        except p.error:
+            # bodies created since the snapshot was saved (such as drawn meshes and contact testers) prevent restoring
+            # it; the simulation is left as it was, so fall back to a full reset which saves a new snapshot
+            logger.info("could not restore the reset snapshot, likely due to bodies created since; resetting fully")
+            p.removeState(self._reset_snapshot[1], physicsClientId=self.physics_client)
+            self._reset_snapshot = None
+            return False
+        # motor commands and constraint targets are not part of the saved state
+        self._resume_control_after_restore()
+        self._contact_debug_names = []
+        self._clear_state_between_control_steps()
+        self.state = np.copy(self._reset_snapshot[2])
+        if self._debug_visualizations[DebugVisualization.STATE]:
+            self._dd.draw_point('x0', self.get_ee_pos(self.state), color=(0, 1, 0))
+        return True
+
+    def _resume_control_after_restore(self):
+        self._send_move_command(self.initJoints)
+
     def reset(self):
+        if self._restore_reset_snapshot():
+            return np.copy(self.state)
         # self._setup_ee()
         self._contact_debug_names = []
 
         for i in self.armInds:
-            p.resetJointState(self.armId, i, self.initJoints[i])
+            p.resetJointState(self.armId, i, self.initJoints[i], physicsClientId=self.physics_client)
         # self.open_gripper()
         # self.close_gripper()
 
@@ -820,11 +1081,12 @@ class ArmEnv(PybulletEnv):
         # start at rest
         self._send_move_command(self.initJoints)
         for _ in range(1000):
-            p.stepSimulation()
+            p.stepSimulation(physicsClientId=self.physics_client)
         self.state = self._obs()
         pos = self.get_ee_pos(self.state)
         if self._debug_visualizations[DebugVisualization.STATE]:
             self._dd.draw_point('x0', pos, color=(0, 1, 0))
+        self._save_reset_snapshot()
         return np.copy(self.state)
 
 
@@ -843,10 +1105,10 @@ class ArmJointEnv(ArmEnv):
         # do forward kinematics to get ee pos from state
         state = state.reshape(-1)
         for i in range(6):
-            p.resetJointState(self.armId, i, state[i])
+            p.resetJointState(self.armId, i, state[i], physicsClientId=self.physics_client)
         ee = np.array(self._observe_ee())
         for i in range(6):
-            p.resetJointState(self.armId, i, self.state[i])
+            p.resetJointState(self.armId, i, self.state[i], physicsClientId=self.physics_client)
         return ee
 
     def compare_to_goal(self, state, goal):
@@ -863,15 +1125,13 @@ class ArmJointEnv(ArmEnv):
             # TODO sample many orientations at the goal and include them all
             # TODO change cost function to take the minimum distance to any of these configurations
             goal_orientation = p.getQuaternionFromEuler([0, math.pi, 0])
-            self.goal = p.calculateInverseKinematics(self.armId,
-                                                     self.endEffectorIndex,
-                                                     goal,
-                                                     goal_orientation)
+            self.goal = self.ik.solve(goal, goal_orientation)
             for i in range(6):
-                p.resetJointState(self.armId, i, self.goal[i])
+                p.resetJointState(self.armId, i, self.goal[i], physicsClientId=self.physics_client)
 
             self.goal_pos = np.array(self._observe_ee())
-            self._dd.draw_point('goal', self.goal_pos)
+            if self.visualize:
+                self._dd.draw_point('goal', self.goal_pos)
             self.goal = np.array(self.goal[:6] + (0, 0, 0))
         except AttributeError:
             logger.warning("setting goal before able to do inverse kinematics; set goal after initialization")
@@ -915,6 +1175,9 @@ class ArmJointEnv(ArmEnv):
         # given joint poses directly
         self._send_move_command(end)
 
+    def _move_error(self, target):
+        return np.abs(np.subtract(self._observe_joints(), target[:len(self.armInds)])).max()
+
     def _unpack_action(self, action):
         return np.array([a * self.MAX_ANGLE_CHANGE for a in action])
 
@@ -1047,13 +1310,14 @@ class PlanarArmEnv(ArmEnv):
         if self.level == 0:
             pass
         elif self.level in [1, 2]:
-            self.immovable.append(make_box([0.2, 0.05, 0.3], [0.6, 0.3, 0.2], [0, 0, 1.1], lateral_friction=1))
+            self.immovable.append(make_box([0.2, 0.05, 0.3], [0.6, 0.3, 0.2], [0, 0, 1.1], lateral_friction=1,
+                                           physics_client=self.physics_client))
         for wallId in self.immovable:
-            p.changeVisualShape(wallId, -1, rgbaColor=[0.2, 0.2, 0.2, 0.8])
+            p.changeVisualShape(wallId, -1, rgbaColor=[0.2, 0.2, 0.2, 0.8], physicsClientId=self.physics_client)
 
     def _setup_experiment(self):
         # add plane to push on (slightly below the base of the robot)
-        self.planeId = p.loadURDF("plane.urdf", [0, 0, 0], useFixedBase=True)
+        self.planeId = p.loadURDF("plane.urdf", [0, 0, 0], useFixedBase=True, physicsClientId=self.physics_client)
 
         self._setup_gripper()
         self._setup_objects()
@@ -1064,27 +1328,29 @@ class PlanarArmEnv(ArmEnv):
         self._draw_state()
 
         # set gravity
-        p.setGravity(0, 0, -10)
+        p.setGravity(0, 0, -10, physicsClientId=self.physics_client)
 
     def _setup_gripper(self):
         # add kuka arm
-        self.armId = p.loadURDF("kuka_iiwa/model.urdf", [0, 0, 0], useFixedBase=True)
-        self.reset_base_link_frame(self.armId, [0, 0, self.z], [math.pi / 2, 0, math.pi / 2])
+        self.armId = p.loadURDF("kuka_iiwa/model.urdf", [0, 0, 0], useFixedBase=True,
+                                physicsClientId=self.physics_client)
+        self.reset_base_link_frame(self.armId, [0, 0, self.z], [math.pi / 2, 0, math.pi / 2],
+                                   physics_client=self.physics_client)
 
         # orientation of the end effector
         self.endEffectorOrientation = p.getQuaternionFromEuler([0, math.pi / 2, 0])
         self.endEffectorIndex = kukaEndEffectorIndex
-        self.numJoints = p.getNumJoints(self.armId)
+        self.numJoints = p.getNumJoints(self.armId, physicsClientId=self.physics_client)
         # get the joint ids
         # self.armInds = [i for i in range(pandaNumDofs)]
         self.armInds = [i for i in range(self.numJoints)]
 
-        p.enableJointForceTorqueSensor(self.armId, self.endEffectorIndex)
+        p.enableJointForceTorqueSensor(self.armId, self.endEffectorIndex, physicsClientId=self.physics_client)
         self._calculate_init_joints()
         for i in self.armInds:
-            p.resetJointState(self.armId, i, self.initJoints[i])
+            p.resetJointState(self.armId, i, self.initJoints[i], physicsClientId=self.physics_client)
 
-        self._make_robot_translucent(self.armId)
+        self._make_robot_translucent(self.armId, physics_client=self.physics_client)
 
     def _unpack_action(self, action):
         dx = action[0] * self.MAX_PUSH_DIST
@@ -1107,17 +1373,22 @@ class PlanarArmEnv(ArmEnv):
 
         # execute push with mini-steps
         self._abort_movement = False
+        waypoint_joints = self._waypoint_joints(ee_pos, final_ee_pos)
         for step in range(self.mini_steps):
             intermediate_ee_pos = linear_interpolate(ee_pos, final_ee_pos, (step + 1) / self.mini_steps)
-            self._move_and_wait(intermediate_ee_pos, steps_to_wait=self.wait_sim_step_per_mini_step)
+            self._move_and_wait(intermediate_ee_pos, steps_to_wait=self.wait_sim_step_per_mini_step,
+                                joints=waypoint_joints[step])
             if self._abort_movement:
                 for _ in range(100):
-                    p.stepSimulation()
+                    p.stepSimulation(physicsClientId=self.physics_client)
+                self._control_step_sim_steps += 100
                 break
 
         cost, done, info = self._finish_action(old_state, action)
 
-        dstate = self.state_difference(final_ee_pos[:2], old_state)
+        target_state = np.copy(old_state)
+        target_state[:2] = final_ee_pos[:2]
+        dstate = self.state_difference(target_state, old_state)
         actual_dstate = self.state_difference(self.state, old_state)
         util.evaluate_action(dstate, actual_dstate)
 
@@ -1133,6 +1404,8 @@ class PlanarArmEnv(ArmEnv):
             self._draw_reaction_force(np.r_[self.state[2:], self.z], 'sr', (0, 0, 0))
 
     def _draw_action(self, action, old_state=None, debug=0):
+        if not self.visualize:
+            return
         if old_state is None:
             old_state = self._obs()
         start = np.r_[old_state[:2], self.z]
@@ -1159,7 +1432,7 @@ class FloatingGripperEnv(PlanarArmEnv):
     # --- set current state
     def set_state(self, state, action=None):
         p.resetBasePositionAndOrientation(self.gripperId, (state[0], state[1], self.z),
-                                          self.endEffectorOrientation)
+                                          self.endEffectorOrientation, physicsClientId=self.physics_client)
         self.state = state
         self._draw_state()
         if action is not None:
@@ -1179,7 +1452,7 @@ class FloatingGripperEnv(PlanarArmEnv):
         return self.target_object_id
 
     def _observe_ee(self, return_z=False, return_orientation=False):
-        gripperPose = p.getBasePositionAndOrientation(self.gripperId)
+        gripperPose = p.getBasePositionAndOrientation(self.gripperId, physicsClientId=self.physics_client)
         pos = gripperPose[0]
         if not return_z:
             pos = pos[:2]
@@ -1192,24 +1465,38 @@ class FloatingGripperEnv(PlanarArmEnv):
                                     [BubbleGripperJointID.LEFT_FINGER, BubbleGripperJointID.RIGHT_FINGER],
                                     p.POSITION_CONTROL,
                                     targetPositions=[-amount, amount],
-                                    forces=[self.MAX_GRIPPER_FORCE, self.MAX_GRIPPER_FORCE])
+                                    forces=[self.MAX_GRIPPER_FORCE, self.MAX_GRIPPER_FORCE],
+                                    physicsClientId=self.physics_client)
         if directly_set_joint_state:
-            p.resetJointState(self.gripperId, BubbleGripperJointID.LEFT_FINGER, -amount)
-            p.resetJointState(self.gripperId, BubbleGripperJointID.RIGHT_FINGER, amount)
+            p.resetJointState(self.gripperId, BubbleGripperJointID.LEFT_FINGER, -amount,
+                              physicsClientId=self.physics_client)
+            p.resetJointState(self.gripperId, BubbleGripperJointID.RIGHT_FINGER, amount,
+                              physicsClientId=self.physics_client)
 
     def close_gripper(self, directly_set_joint_state=False):
         p.setJointMotorControlArray(self.gripperId,
                                     [BubbleGripperJointID.LEFT_FINGER, BubbleGripperJointID.RIGHT_FINGER],
                                     p.POSITION_CONTROL,
                                     targetPositions=[-self.CLOSE_ANGLE, self.CLOSE_ANGLE],
-                                    forces=[self.MAX_GRIPPER_FORCE, self.MAX_GRIPPER_FORCE])
+                                    forces=[self.MAX_GRIPPER_FORCE, self.MAX_GRIPPER_FORCE],
+                                    physicsClientId=self.physics_client)
         if directly_set_joint_state:
-            p.resetJointState(self.gripperId, BubbleGripperJointID.LEFT_FINGER, -self.CLOSE_ANGLE)
-            p.resetJointState(self.gripperId, BubbleGripperJointID.RIGHT_FINGER, self.CLOSE_ANGLE)
+            p.resetJointState(self.gripperId, BubbleGripperJointID.LEFT_FINGER, -self.CLOSE_ANGLE,
+                              physicsClientId=self.physics_client)
+            p.resetJointState(self.gripperId, BubbleGripperJointID.RIGHT_FINGER, self.CLOSE_ANGLE,
+                              physicsClientId=self.physics_client)
 
     def _move_pusher(self, end):
         # TODO implement
-        p.changeConstraint(self.gripperConstraint, end, self.endEffectorOrientation, maxForce=self.MAX_FORCE)
+        p.changeConstraint(self.gripperConstraint, end, self.endEffectorOrientation, maxForce=self.MAX_FORCE,
+                           physicsClientId=self.physics_client)
+
+    def _observe_ee_velocity(self):
+        return p.getBaseVelocity(self.gripperId, physicsClientId=self.physics_client)[0]
+
+    def _waypoint_joints(self, start, end):
+        # the gripper is moved directly rather than through IK
+        return [None] * self.mini_steps
 
     def _setup_objects(self):
         self.immovable = []
@@ -1222,17 +1509,17 @@ class FloatingGripperEnv(PlanarArmEnv):
             xs = [0.3, 0.8]
             ys = [-0.3, 0.3]
             objId = p.loadURDF(os.path.join(cfg.URDF_DIR, "tester.urdf"), useFixedBase=False,
-                               basePosition=[xs[0], ys[0], z])
+                               basePosition=[xs[0], ys[0], z], physicsClientId=self.physics_client)
             self.movable.append(objId)
             objId = p.loadURDF(os.path.join(cfg.URDF_DIR, "tester.urdf"), useFixedBase=False,
-                               basePosition=[xs[1], ys[1], z])
+                               basePosition=[xs[1], ys[1], z], physicsClientId=self.physics_client)
             self.movable.append(objId)
 
             objId = p.loadURDF(os.path.join(cfg.URDF_DIR, "tester.urdf"), useFixedBase=True,
-                               basePosition=[xs[1], ys[0], z])
+                               basePosition=[xs[1], ys[0], z], physicsClientId=self.physics_client)
             self.immovable.append(objId)
             objId = p.loadURDF(os.path.join(cfg.URDF_DIR, "tester.urdf"), useFixedBase=True,
-                               basePosition=[xs[0], ys[1], z])
+                               basePosition=[xs[0], ys[1], z], physicsClientId=self.physics_client)
             self.immovable.append(objId)
         elif self.level == Levels.MOVEABLE_CANS:
             scale = 1.0
@@ -1240,28 +1527,32 @@ class FloatingGripperEnv(PlanarArmEnv):
             xs = [0.3, 0.7]
             ys = [-0.2, 0.2]
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "tester.urdf"), useFixedBase=False,
-                                           basePosition=[xs[0], ys[0], z], globalScaling=scale))
+                                           basePosition=[xs[0], ys[0], z], globalScaling=scale,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "tester.urdf"), useFixedBase=False,
-                                           basePosition=[xs[1], ys[1], z], globalScaling=scale))
+                                           basePosition=[xs[1], ys[1], z], globalScaling=scale,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "tester.urdf"), useFixedBase=False,
-                                           basePosition=[xs[1], ys[0], z], globalScaling=scale))
+                                           basePosition=[xs[1], ys[0], z], globalScaling=scale,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "tester.urdf"), useFixedBase=False,
-                                           basePosition=[xs[0], ys[1], z], globalScaling=scale))
+                                           basePosition=[xs[0], ys[1], z], globalScaling=scale,
+                                           physicsClientId=self.physics_client))
             self.immovable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "wall.urdf"), [xs[1] + 0.48, 0., z],
                                              p.getQuaternionFromEuler([0, 0, np.pi / 2]), useFixedBase=True,
-                                             globalScaling=0.5))
+                                             globalScaling=0.5, physicsClientId=self.physics_client))
             self.immovable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "wall.urdf"), [xs[0], ys[0] - 0.43, z],
                                              p.getQuaternionFromEuler([0, 0, 0]), useFixedBase=True,
-                                             globalScaling=0.5))
+                                             globalScaling=0.5, physicsClientId=self.physics_client))
         elif self.level in [Levels.STRAIGHT_LINE, Levels.WALL_BEHIND]:
             scale = 1.0
             z = 0.075 * scale
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "tester.urdf"), useFixedBase=False,
-                                           basePosition=[0.5, 0, z]))
+                                           basePosition=[0.5, 0, z], physicsClientId=self.physics_client))
             if self.level == Levels.WALL_BEHIND:
                 self.immovable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "wall.urdf"), [0.21, 0., z],
                                                  p.getQuaternionFromEuler([0, 0, -np.pi / 2]), useFixedBase=True,
-                                                 globalScaling=0.5))
+                                                 globalScaling=0.5, physicsClientId=self.physics_client))
         elif self.level in [Levels.NCB_C, Levels.NCB_S, Levels.NCB_T]:
             scale = 1.0
             z = 0.075 * scale
@@ -1269,29 +1560,46 @@ class FloatingGripperEnv(PlanarArmEnv):
             width = 0.85
             self.immovable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "wall.urdf"), [-0.3, 0, z],
                                              p.getQuaternionFromEuler([0, 0, -np.pi / 2]), useFixedBase=True,
-                                             globalScaling=0.5))
+                                             globalScaling=0.5, physicsClientId=self.physics_client))
             self.immovable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "wall.urdf"), [0.5, -width / 2, z],
                                              p.getQuaternionFromEuler([0, 0, 0]), useFixedBase=True,
-                                             globalScaling=0.5))
+                                             globalScaling=0.5, physicsClientId=self.physics_client))
             self.immovable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "wall.urdf"), [0.5, width / 2, z],
                                              p.getQuaternionFromEuler([0, 0, 0]), useFixedBase=True,
-                                             globalScaling=0.5))
+                                             globalScaling=0.5, physicsClientId=self.physics_client))
             if self.level == Levels.NCB_C:
                 self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "tester.urdf"), useFixedBase=False,
-                                               basePosition=[0.7, y, z]))
+                                               basePosition=[0.7, y, z], physicsClientId=self.physics_client))
             elif self.level == Levels.NCB_S:
                 self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "block_tall.urdf"), useFixedBase=False,
-                                               basePosition=[0.7, y, z]))
-                p.changeVisualShape(self.movable[-1], -1, rgbaColor=DEFAULT_MOVABLE_RGBA)
+                                               basePosition=[0.7, y, z], physicsClientId=self.physics_client))
+                p.changeVisualShape(self.movable[-1], -1, rgbaColor=DEFAULT_MOVABLE_RGBA,
+                                    physicsClientId=self.physics_client)
             elif self.level == Levels.NCB_T:
                 self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "topple_cylinder.urdf"), useFixedBase=False,
                                                basePosition=[0.7, y, z + 0.02],
-                                               baseOrientation=p.getQuaternionFromEuler([0, np.pi / 2, np.pi / 2])))
+                                               baseOrientation=p.getQuaternionFromEuler([0, np.pi / 2, np.pi / 2]),
+                                               physicsClientId=self.physics_client))
+        elif self.level is Levels.RANDOM and self._cached_scene is not None:
+            # recreate the objects where they were generated instead of sampling them again
+            self._random_objects = self._cached_scene['random_objects']
+            for obj_type, global_scale, moveable, pose in self._random_objects:
+                obj = p.loadURDF(os.path.join(cfg.URDF_DIR, obj_type), useFixedBase=not moveable,
+                                 globalScaling=global_scale * 0.7 if obj_type == "wall.urdf" else global_scale,
+                                 basePosition=pose[0],
+                                 baseOrientation=pose[1], physicsClientId=self.physics_client)
+                if moveable:
+                    self.movable.append(obj)
+                else:
+                    self.immovable.append(obj)
         elif self.level is Levels.RANDOM:
+            # type, scale, whether it's movable, and pose of each generated object
+            self._random_objects = []
             # first move end effector out of the way
-            p.resetBasePositionAndOrientation(self.gripperId, [0, 0, 100], self.endEffectorOrientation)
+            p.resetBasePositionAndOrientation(self.gripperId, [0, 0, 100], self.endEffectorOrientation,
+                                              physicsClientId=self.physics_client)
             if self.gripperConstraint:
-                p.removeConstraint(self.gripperConstraint)
+                p.removeConstraint(self.gripperConstraint, physicsClientId=self.physics_client)
             bound = 0.7
             obj_types = ["tester.urdf", "topple_cylinder.urdf", "block_tall.urdf", "wall.urdf"]
             # randomize number of objects, type of object, and size of object
@@ -1316,96 +1624,156 @@ class FloatingGripperEnv(PlanarArmEnv):
                     obj = p.loadURDF(os.path.join(cfg.URDF_DIR, obj_type), useFixedBase=False,
                                      globalScaling=global_scale * 0.7 if obj_type == "wall.urdf" else global_scale,
                                      basePosition=position,
-                                     baseOrientation=orientation)
+                                     baseOrientation=orientation, physicsClientId=self.physics_client)
                     # let settle
                     for _ in range(1000):
-                        p.stepSimulation()
+                        p.stepSimulation(physicsClientId=self.physics_client)
                     # retry positioning if we teleported out of bounds
-                    pos = p.getBasePositionAndOrientation(obj)[0]
+                    pos = p.getBasePositionAndOrientation(obj, physicsClientId=self.physics_client)[0]
                     in_bounds = bound > pos[0] > -bound and bound > pos[1] > -bound
                     if not in_bounds:
-                        p.removeBody(obj)
+                        p.removeBody(obj, physicsClientId=self.physics_client)
                         continue
                     # don't want objects leaning on each other
                     in_contact = False
                     for other_obj in self.movable + self.immovable:
-                        c = p.getContactPoints(obj, other_obj)
+                        c = p.getContactPoints(obj, other_obj, physicsClientId=self.physics_client)
                         if len(c):
                             in_contact = True
                             break
                     if in_contact:
-                        p.removeBody(obj)
+                        p.removeBody(obj, physicsClientId=self.physics_client)
                         continue
 
                     if in_bounds and not in_contact:
                         break
 
+                pose = p.getBasePositionAndOrientation(obj, physicsClientId=self.physics_client)
+                self._random_objects.append((obj_type, global_scale, moveable, pose))
                 if moveable:
                     self.movable.append(obj)
                 else:
                     # recreate object and make it fixed base
-                    pose = p.getBasePositionAndOrientation(obj)
-                    p.removeBody(obj)
+                    p.removeBody(obj, physicsClientId=self.physics_client)
                     obj = p.loadURDF(os.path.join(cfg.URDF_DIR, obj_type), useFixedBase=True,
                                      globalScaling=global_scale * 0.7 if obj_type == "wall.urdf" else global_scale,
                                      basePosition=pose[0],
-                                     baseOrientation=pose[1])
+                                     baseOrientation=pose[1], physicsClientId=self.physics_client)
                     self.immovable.append(obj)
             # restore gripper movement
-            p.resetBasePositionAndOrientation(self.gripperId, self.init, self.endEffectorOrientation)
+            p.resetBasePositionAndOrientation(self.gripperId, self.init, self.endEffectorOrientation,
+                                              physicsClientId=self.physics_client)
             self.gripperConstraint = p.createConstraint(self.gripperId, -1, -1, -1, p.JOINT_FIXED, [0, 0, 1], [0, 0, 0],
-                                                        self.init, childFrameOrientation=self.endEffectorOrientation)
+                                                        self.init, childFrameOrientation=self.endEffectorOrientation,
+                                                        physicsClientId=self.physics_client)
             self.close_gripper()
         elif self.level in selected_levels:
             z = 0.1
             s = 0.25
             h = 2 if self.extrude_objects_in_z else 0.15
             if self.level is Levels.SELECT1:
-                self.immovable.append(make_box([0.4, 0.15, h], [-0.4, 0, z], [0, 0, -np.pi / 2]))
-                self.movable.append(make_cylinder(0.15, h, [s, s, z], [0, 0, 0]))
+                self.immovable.append(make_box([0.4, 0.15, h], [-0.4, 0, z], [0, 0, -np.pi / 2],
+                                               physics_client=self.physics_client))
+                self.movable.append(make_cylinder(0.15, h, [s, s, z], [0, 0, 0], physics_client=self.physics_client))
                 self._adjust_mass_and_visual(self.movable[-1], 2.2)
-                self.movable.append(make_box([0.1 * 1.5, 0.1 * 1.5, h * 1.5 * 0.5], [s, -s, z], [0, 0, 0]))
+                self.movable.append(make_box([0.1 * 1.5, 0.1 * 1.5, h * 1.5 * 0.5], [s, -s, z], [0, 0, 0],
+                                             physics_client=self.physics_client))
                 self._adjust_box_dynamics(self.movable[-1])
                 self._adjust_mass_and_visual(self.movable[-1], 0.8)
             elif self.level is Levels.SELECT2:
-                self.movable.append(make_cylinder(0.15 * 0.8, h * 0.8, [-s, s, z], [0, 0, 0]))
+                self.movable.append(make_cylinder(0.15 * 0.8, h * 0.8, [-s, s, z], [0, 0, 0],
+                                                  physics_client=self.physics_client))
                 self._adjust_mass_and_visual(self.movable[-1], 1)
-                self.movable.append(make_box([0.1 * 1.2, 0.1 * 1.2, h * 1.2 * 0.5], [s, s, z], [0, 0, 0]))
+                self.movable.append(make_box([0.1 * 1.2, 0.1 * 1.2, h * 1.2 * 0.5], [s, s, z], [0, 0, 0],
+                                             physics_client=self.physics_client))
                 self._adjust_box_dynamics(self.movable[-1])
                 self._adjust_mass_and_visual(self.movable[-1], 1.8)
-                self.movable.append(make_cylinder(0.15 * 1.2, h * 1.2, [s, -s, z], [0, 0, 0]))
+                self.movable.append(make_cylinder(0.15 * 1.2, h * 1.2, [s, -s, z], [0, 0, 0],
+                                                  physics_client=self.physics_client))
                 self._adjust_mass_and_visual(self.movable[-1], 1)
                 self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, "topple_cylinder.urdf"), useFixedBase=False,
                                                basePosition=[-s, -s, z + 0.02],
-                                               baseOrientation=p.getQuaternionFromEuler([0, np.pi / 2, np.pi / 2])))
+                                               baseOrientation=p.getQuaternionFromEuler([0, np.pi / 2, np.pi / 2]),
+                                               physicsClientId=self.physics_client))
                 self._adjust_mass_and_visual(self.movable[-1], 1)
             elif self.level is Levels.SELECT3:
-                self.immovable.append(make_box([0.4, 0.15, h], [0, 0.4, z], [0, 0, 0]))
-                self.movable.append(make_cylinder(0.15 * 1.1, h * 1.1, [-0.2, 0, z], [0, 0, 0]))
+                self.immovable.append(make_box([0.4, 0.15, h], [0, 0.4, z], [0, 0, 0],
+                                               physics_client=self.physics_client))
+                self.movable.append(make_cylinder(0.15 * 1.1, h * 1.1, [-0.2, 0, z], [0, 0, 0],
+                                                  physics_client=self.physics_client))
                 self._adjust_mass_and_visual(self.movable[-1], 1)
-                self.movable.append(make_cylinder(0.15, h, [0.4, -s, z], [0, 0, 0]))
+                self.movable.append(make_cylinder(0.15, h, [0.4, -s, z], [0, 0, 0], physics_client=self.physics_client))
                 self._adjust_mass_and_visual(self.movable[-1], 2.2)
             elif self.level is Levels.SELECT4:
-                self.immovable.append(make_box([0.3, 0.12, h], [0.3, -0.3, z], [0, 0, np.pi / 4]))
-                self.movable.append(make_box([0.1 * 1.5, 0.1 * 1.5, h * 1.5 * 0.5], [s, s, z], [0, 0, 0]))
+                self.immovable.append(make_box([0.3, 0.12, h], [0.3, -0.3, z], [0, 0, np.pi / 4],
+                                               physics_client=self.physics_client))
+                self.movable.append(make_box([0.1 * 1.5, 0.1 * 1.5, h * 1.5 * 0.5], [s, s, z], [0, 0, 0],
+                                             physics_client=self.physics_client))
                 self._adjust_box_dynamics(self.movable[-1])
                 self._adjust_mass_and_visual(self.movable[-1], 1.8)
-                self.movable.append(make_box([0.1 * 1.2, 0.1 * 1.2, h * 1.2 * 0.5], [-s, 0, z], [0, 0, 0]))
+                self.movable.append(make_box([0.1 * 1.2, 0.1 * 1.2, h * 1.2 * 0.5], [-s, 0, z], [0, 0, 0],
+                                             physics_client=self.physics_client))
                 self._adjust_box_dynamics(self.movable[-1])
                 self._adjust_mass_and_visual(self.movable[-1], 1.2)
 
         for objId in self.immovable:
-            p.changeVisualShape(objId, -1, rgbaColor=[0.2, 0.2, 0.2, 0.8])
+            p.changeVisualShape(objId, -1, rgbaColor=[0.2, 0.2, 0.2, 0.8], physicsClientId=self.physics_client)
         self.objects = self.immovable + self.movable
+        self.target_object_id = self.movable[0] if len(self.movable) else None
+
+    def _scene_cache_info(self):
+        info = super()._scene_cache_info()
+        if self.level is Levels.RANDOM:
+            info['random_objects'] = self._random_objects
+        return info
+
+    def _setup_or_restore_objects(self):
+        """Set up the objects of the level, or restore the pooled objects to their initial state"""
+        pool_key = (self.level, tuple(np.ravel(self.goal)))
+        if self._object_pool is not None and self._object_pool[0] == pool_key:
+            self._restore_object_states(self._object_pool[1])
+            return
+
+        for obj in self.immovable + self.movable:
+            p.removeBody(obj, physicsClientId=self.physics_client)
+        self._setup_objects()
+        self._object_pool = None
+        if self.pool_objects and self.level is not Levels.RANDOM:
+            self._object_pool = pool_key, self._capture_object_states()
+
+    def _capture_object_states(self):
+        states = []
+        for obj in self.objects:
+            pose = p.getBasePositionAndOrientation(obj, physicsClientId=self.physics_client)
+            vel = p.getBaseVelocity(obj, physicsClientId=self.physics_client)
+            joints = [p.getJointState(obj, j, physicsClientId=self.physics_client)[:2] for j in
+                      range(p.getNumJoints(obj, physicsClientId=self.physics_client))]
+            dynamics = p.getDynamicsInfo(obj, -1, physicsClientId=self.physics_client)
+            rgba = [v[7] for v in p.getVisualShapeData(obj, physicsClientId=self.physics_client) if v[1] == -1]
+            states.append((obj, pose, vel, joints, dynamics, rgba[0] if len(rgba) else None))
+        return states
+
+    def _restore_object_states(self, states):
+        for obj, pose, vel, joints, dynamics, rgba in states:
+            p.resetBasePositionAndOrientation(obj, pose[0], pose[1], physicsClientId=self.physics_client)
+            p.resetBaseVelocity(obj, vel[0], vel[1], physicsClientId=self.physics_client)
+            for j, (joint_pos, joint_vel) in enumerate(joints):
+                p.resetJointState(obj, j, joint_pos, joint_vel, physicsClientId=self.physics_client)
+            # mass, lateral friction, restitution, rolling friction, and spinning friction of the base
+            p.changeDynamics(obj, -1, mass=dynamics[0], lateralFriction=dynamics[1], restitution=dynamics[5],
+                             rollingFriction=dynamics[6], spinningFriction=dynamics[7],
+                             physicsClientId=self.physics_client)
+            if rgba is not None:
+                p.changeVisualShape(obj, -1, rgbaColor=rgba, physicsClientId=self.physics_client)
 
     def _setup_experiment(self):
         # set gravity
-        p.setGravity(0, 0, -10)
+        p.setGravity(0, 0, -10, physicsClientId=self.physics_client)
         # add plane to push on (slightly below the base of the robot)
-        self.planeId = p.loadURDF("plane.urdf", [0, 0, 0], useFixedBase=True)
+        self.planeId = p.loadURDF("plane.urdf", [0, 0, 0], useFixedBase=True, physicsClientId=self.physics_client)
 
         self._setup_gripper()
-        self._setup_objects()
+        self._setup_or_restore_objects()
         # TODO unmask collision between the two bubble links and objects
 
         if self.level in [Levels.RANDOM, Levels.FREESPACE] + selected_levels:
@@ -1420,11 +1788,12 @@ class FloatingGripperEnv(PlanarArmEnv):
 
     def _adjust_mass_and_visual(self, obj, m):
         # adjust the mass of a pybullet object and indicate it via the color
-        p.changeVisualShape(obj, -1, rgbaColor=[1 - m / 3, 0.8 - m / 3, 0.2, 0.8])
-        p.changeDynamics(obj, -1, mass=m)
+        p.changeVisualShape(obj, -1, rgbaColor=[1 - m / 3, 0.8 - m / 3, 0.2, 0.8], physicsClientId=self.physics_client)
+        p.changeDynamics(obj, -1, mass=m, physicsClientId=self.physics_client)
 
     def _adjust_box_dynamics(self, obj):
-        p.changeDynamics(obj, -1, lateralFriction=0.8, spinningFriction=0.05, rollingFriction=0.01)
+        p.changeDynamics(obj, -1, lateralFriction=0.8, spinningFriction=0.05, rollingFriction=0.01,
+                         physicsClientId=self.physics_client)
 
     def get_ee_orientation_with_yaw(self, yaw):
         # this is upside down on the z axis; flip it
@@ -1438,60 +1807,71 @@ class FloatingGripperEnv(PlanarArmEnv):
 
         # use a floating gripper
         self.gripperId = p.loadURDF(os.path.join(cfg.URDF_DIR, "wsg50_flipped_inflated.urdf"),
-                                    basePosition=self.init, baseOrientation=self.endEffectorOrientation)
+                                    basePosition=self.init, baseOrientation=self.endEffectorOrientation,
+                                    physicsClientId=self.physics_client)
 
         self.gripperConstraint = p.createConstraint(self.gripperId, -1, -1, -1, p.JOINT_FIXED, [0, 0, 1], [0, 0, 0],
-                                                    self.init, childFrameOrientation=self.endEffectorOrientation)
+                                                    self.init, childFrameOrientation=self.endEffectorOrientation,
+                                                    physicsClientId=self.physics_client)
 
         # create a constraint to keep the fingers centered
         self.close_gripper()
-        self._make_robot_translucent(self.gripperId)
+        self._make_robot_translucent(self.gripperId, physics_client=self.physics_client)
 
     def get_ee_contact_info(self, bodyId):
-        return p.getContactPoints(self.gripperId, bodyId)
+        return p.getContactPoints(self.gripperId, bodyId, physicsClientId=self.physics_client)
 
-    def _observe_additional_info(self, info, visualize=True):
-        reaction_force = [0, 0, 0]
-        reaction_torque = [0, 0, 0]
+    def get_ee_contacts(self):
+        return get_contacts_by_body(self.gripperId, physics_client=self.physics_client)
 
+    def _observe_additional_info(self, info, visualize=True):
         ee_pos = self._observe_ee(return_z=True)
-        for objectId in self.objects:
-            contactInfo = self.get_ee_contact_info(objectId)
-            for i, contact in enumerate(contactInfo):
-                f_contact = get_total_contact_force(contact, False)
-                reaction_force = [sum(i) for i in zip(reaction_force, f_contact)]
-                # torque wrt end effector position
-                pos_vec = np.subtract(contact[ContactInfo.POS_A], ee_pos)
-                r_contact = np.cross(pos_vec, f_contact)
-                reaction_torque = np.add(reaction_torque, r_contact)
+        contacts = []
+        if self._ee_contacts:
+            for objectId in self.objects:
+                contacts.extend(self._ee_contacts.get(objectId, ()))
+        # torque wrt end effector position
+        reaction_force, reaction_torque = get_contact_wrench(contacts, ee_pos, flip=False)
 
         self._observe_raw_reaction_force(info, reaction_force, reaction_torque, visualize)
 
+    def _resume_control_after_restore(self):
+        self.open_gripper()
+        if self.gripperConstraint:
+            p.removeConstraint(self.gripperConstraint, physicsClientId=self.physics_client)
+        self.gripperConstraint = p.createConstraint(self.gripperId, -1, -1, -1, p.JOINT_FIXED, [0, 0, 1], [0, 0, 0],
+                                                    self.init, childFrameOrientation=self.endEffectorOrientation,
+                                                    physicsClientId=self.physics_client)
+
     def reset(self):
+        if self._restore_reset_snapshot():
+            self.contact_detector.clear()
+            return np.copy(self.state)
         for _ in range(1000):
-            p.stepSimulation()
+            p.stepSimulation(physicsClientId=self.physics_client)
 
         self.open_gripper()
         if self.gripperConstraint:
-            p.removeConstraint(self.gripperConstraint)
+            p.removeConstraint(self.gripperConstraint, physicsClientId=self.physics_client)
 
-        for obj in self.immovable + self.movable:
-            p.removeBody(obj)
-        self._setup_objects()
+        self._setup_or_restore_objects()
 
-        p.resetBasePositionAndOrientation(self.gripperId, self.init, self.endEffectorOrientation)
+        p.resetBasePositionAndOrientation(self.gripperId, self.init, self.endEffectorOrientation,
+                                          physicsClientId=self.physics_client)
         self.gripperConstraint = p.createConstraint(self.gripperId, -1, -1, -1, p.JOINT_FIXED, [0, 0, 1], [0, 0, 0],
-                                                    self.init, childFrameOrientation=self.endEffectorOrientation)
+                                                    self.init, childFrameOrientation=self.endEffectorOrientation,
+                                                    physicsClientId=self.physics_client)
 
         # set robot init config
         self._clear_state_between_control_steps()
         # start at rest
         for _ in range(1000):
-            p.stepSimulation()
+            p.stepSimulation(physicsClientId=self.physics_client)
         self.state = self._obs()
         if self._debug_visualizations[DebugVisualization.STATE]:
             self._dd.draw_point('x0', self.get_ee_pos(self.state), color=(0, 1, 0))
         self.contact_detector.clear()
+        self._save_reset_snapshot()
         return np.copy(self.state)
 
 
@@ -1530,6 +1910,8 @@ class ObjectRetrievalEnv(FloatingGripperEnv):
         return super(ObjectRetrievalEnv, self)._obs()[:2]
 
     def _draw_state(self):
+        if not self.visualize:
+            return
         pos = self.get_ee_pos(self.state)
         self._dd.draw_point('state', pos)
 
@@ -1537,12 +1919,12 @@ class ObjectRetrievalEnv(FloatingGripperEnv):
         if self.level in [Levels.TOMATO_CAN]:
             objId = p.loadURDF(
                 os.path.join(cfg.URDF_DIR, 'YcbTomatoSoupCan', "model.urdf"),
-                target_pos, target_rot, flags=flags, globalScaling=1.2)
-            p.changeDynamics(objId, -1, mass=2)
+                target_pos, target_rot, flags=flags, globalScaling=1.2, physicsClientId=self.physics_client)
+            p.changeDynamics(objId, -1, mass=2, physicsClientId=self.physics_client)
         else:
             objId = p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbCrackerBox', "model.urdf"),
-                               target_pos, target_rot, flags=flags)
-            p.changeDynamics(objId, -1, mass=10)
+                               target_pos, target_rot, flags=flags, physicsClientId=self.physics_client)
+            p.changeDynamics(objId, -1, mass=10, physicsClientId=self.physics_client)
         return objId
 
     def _setup_objects(self):
@@ -1552,9 +1934,12 @@ class ObjectRetrievalEnv(FloatingGripperEnv):
         h = 2 if self.extrude_objects_in_z else 0.15
         separation = 0.7
 
-        self.immovable.append(make_box([0.7, 0.1, h], [1.1, 0, z], [0, 0, -np.pi / 2]))
-        self.immovable.append(make_box([0.7, 0.1, h], [0.5, -separation, z], [0, 0, 0]))
-        self.immovable.append(make_box([0.7, 0.1, h], [0.5, separation, z], [0, 0, 0]))
+        self.immovable.append(make_box([0.7, 0.1, h], [1.1, 0, z], [0, 0, -np.pi / 2],
+                                       physics_client=self.physics_client))
+        self.immovable.append(make_box([0.7, 0.1, h], [0.5, -separation, z], [0, 0, 0],
+                                       physics_client=self.physics_client))
+        self.immovable.append(make_box([0.7, 0.1, h], [0.5, separation, z], [0, 0, 0],
+                                       physics_client=self.physics_client))
         flags = p.URDF_USE_INERTIA_FROM_FILE
         target_pos = [self.goal[0], self.goal[1], z]
         target_rot = p.getQuaternionFromEuler([0, 0, self.goal[2]])
@@ -1562,71 +1947,90 @@ class ObjectRetrievalEnv(FloatingGripperEnv):
         # self.target_object_id = self.create_target_obj(target_pos, target_rot, flags)
         # self.movable.append(self.target_object_id)
 
-        p.changeDynamics(self.planeId, -1, lateralFriction=0.6, spinningFriction=0.8)
+        p.changeDynamics(self.planeId, -1, lateralFriction=0.6, spinningFriction=0.8,
+                         physicsClientId=self.physics_client)
 
         if self.level == Levels.NO_CLUTTER:
             pass
         elif self.level == Levels.SIMPLE_CLUTTER:
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbTomatoSoupCan', "model.urdf"),
                                            [0.3, 0., z],
-                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2))
+                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbTomatoSoupCan', "model.urdf"),
                                            [0.2, -0.3, z],
-                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2))
+                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2,
+                                           physicsClientId=self.physics_client))
         elif self.level == Levels.FLAT_BOX:
-            p.changeDynamics(self.planeId, -1, lateralFriction=0.6, spinningFriction=0.01)
+            p.changeDynamics(self.planeId, -1, lateralFriction=0.6, spinningFriction=0.01,
+                             physicsClientId=self.physics_client)
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbTomatoSoupCan', "model.urdf"),
                                            [0.2, -0.1, z],
-                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2))
+                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbMustardBottle', "model.urdf"),
                                            [0.25, -0.2, z],
-                                           p.getQuaternionFromEuler([0, 0, -1]), flags=flags, globalScaling=1))
+                                           p.getQuaternionFromEuler([0, 0, -1]), flags=flags, globalScaling=1,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbMasterChefCan', "model.urdf"),
                                            [0.3, 0.2, z],
-                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2))
+                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbPottedMeatCan', "model.urdf"),
                                            [0.34, 0.05, z],
-                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=1.5))
+                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=1.5,
+                                           physicsClientId=self.physics_client))
         elif self.level == Levels.BEHIND_CAN:
-            p.changeDynamics(self.planeId, -1, lateralFriction=0.6, spinningFriction=0.01)
+            p.changeDynamics(self.planeId, -1, lateralFriction=0.6, spinningFriction=0.01,
+                             physicsClientId=self.physics_client)
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbTomatoSoupCan', "model.urdf"),
                                            [0.15, 0.15, z],
-                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2))
+                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbMasterChefCan', "model.urdf"),
                                            [0.15, -0.05, z],
-                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2))
+                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2,
+                                           physicsClientId=self.physics_client))
         elif self.level == Levels.IN_BETWEEN:
-            p.changeDynamics(self.planeId, -1, lateralFriction=0.6, spinningFriction=0.01)
+            p.changeDynamics(self.planeId, -1, lateralFriction=0.6, spinningFriction=0.01,
+                             physicsClientId=self.physics_client)
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbTomatoSoupCan', "model.urdf"),
                                            [0.15, 0.12, z],
-                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2))
+                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbMustardBottle', "model.urdf"),
                                            [0.21, 0.21, z],
-                                           p.getQuaternionFromEuler([0, 0, 0.6]), flags=flags, globalScaling=1))
+                                           p.getQuaternionFromEuler([0, 0, 0.6]), flags=flags, globalScaling=1,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbPottedMeatCan', "model.urdf"),
                                            [0.3, -0.05, z],
-                                           p.getQuaternionFromEuler([0, 0, 0.6]), flags=flags, globalScaling=1.5))
+                                           p.getQuaternionFromEuler([0, 0, 0.6]), flags=flags, globalScaling=1.5,
+                                           physicsClientId=self.physics_client))
         elif self.level == Levels.TOMATO_CAN:
-            p.changeDynamics(self.planeId, -1, lateralFriction=0.6, spinningFriction=0.01)
+            p.changeDynamics(self.planeId, -1, lateralFriction=0.6, spinningFriction=0.01,
+                             physicsClientId=self.physics_client)
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbMasterChefCan', "model.urdf"),
                                            [0.15, -0.1, z],
-                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2))
+                                           p.getQuaternionFromEuler([0, 0, 0]), flags=flags, globalScaling=2,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbCrackerBox', "model.urdf"),
                                            [0.23, 0.15, z],
-                                           p.getQuaternionFromEuler([0, 0, 0.5]), flags=flags))
+                                           p.getQuaternionFromEuler([0, 0, 0.5]), flags=flags,
+                                           physicsClientId=self.physics_client))
             self.movable.append(p.loadURDF(os.path.join(cfg.URDF_DIR, 'YcbPottedMeatCan', "model.urdf"),
                                            [0.3, -0.15, z],
-                                           p.getQuaternionFromEuler([0, 0, 0.]), flags=flags, globalScaling=1.5))
+                                           p.getQuaternionFromEuler([0, 0, 0.]), flags=flags, globalScaling=1.5,
+                                           physicsClientId=self.physics_client))
         elif self.level == Levels.MUG:
             obj = p.loadURDF(os.path.join(cfg.URDF_DIR, 'mug_dbl.urdf'),
                              [self.goal[0], self.goal[1], z],
                              p.getQuaternionFromEuler([np.pi / 2, 0, -self.goal[2]]), flags=flags,
-                             globalScaling=1.0)
-            p.changeDynamics(obj, -1, mass=3)
+                             globalScaling=1.0, physicsClientId=self.physics_client)
+            p.changeDynamics(obj, -1, mass=3, physicsClientId=self.physics_client)
             self.movable.append(obj)
 
         for objId in self.immovable:
-            p.changeVisualShape(objId, -1, rgbaColor=[0.2, 0.2, 0.2, 0.8])
+            p.changeVisualShape(objId, -1, rgbaColor=[0.2, 0.2, 0.2, 0.8], physicsClientId=self.physics_client)
         self.objects = self.immovable + self.movable
 
     def evaluate_cost(self, state, action=None):
@@ -1676,6 +2080,14 @@ class ObjectRetrievalArmEnv(ObjectRetrievalEnv):
         self.base_rpy = base_rpy
         super().__init__(*args, **kwargs)
 
+    def _scene_config(self):
+        return super()._scene_config() + (tuple(self.base_pos), tuple(self.base_rpy))
+
+    def _scene_cache_info(self):
+        info = super()._scene_cache_info()
+        info['init_joints'] = list(self.initJoints)
+        return info
+
     def _obs(self):
         # this is of the gripper's origin, not of the last link on the arm
         pos, quat = self._observe_ee(return_z=True, return_orientation=True)
@@ -1688,10 +2100,7 @@ class ObjectRetrievalArmEnv(ObjectRetrievalEnv):
         # this offset is relative to the end effector orientation, so we need to transform it to world frame
         offsetWorldFrame = p.rotateVector(self.endEffectorOrientation, self.gripperOffset)
         pos = np.array(self.init) + np.array(offsetWorldFrame) * 2
-        self.initJoints = list(p.calculateInverseKinematics(self.armId,
-                                                            self.endEffectorIndex,
-                                                            pos,
-                                                            self.endEffectorOrientation))
+        self.initJoints = list(self.ik.solve(pos, self.endEffectorOrientation))
 
     def _setup_gripper(self):
         # default orientation of the end effector
@@ -1706,48 +2115,57 @@ class ObjectRetrievalArmEnv(ObjectRetrievalEnv):
         # arm_path = os.path.join(cfg.URDF_DIR, "kuka_wsg50.urdf")
         pos = self.base_pos
         rpy = self.base_rpy
-        self.armId = p.loadURDF(arm_path, pos, p.getQuaternionFromEuler(rpy), useFixedBase=True)
-        self.reset_base_link_frame(self.armId, pos, rpy)
+        self.armId = p.loadURDF(arm_path, pos, p.getQuaternionFromEuler(rpy), useFixedBase=True,
+                                physicsClientId=self.physics_client)
+        self.reset_base_link_frame(self.armId, pos, rpy, physics_client=self.physics_client)
 
         self.endEffectorIndex = kukaEndEffectorIndex
-        self.numJoints = p.getNumJoints(self.armId)
+        self.numJoints = p.getNumJoints(self.armId, physicsClientId=self.physics_client)
         self.armInds = [i for i in range(self.numJoints)]
 
         self.gripperOffset = [0, 0, -0.026]
 
-        # can get stuck in local minima
-        for _ in range(3):
-            self._calculate_init_joints()
+        cached_init_joints = self._cached_scene['init_joints'] if self._cached_scene is not None else None
+        if cached_init_joints is not None:
+            self.initJoints = list(cached_init_joints)
             for i in self.armInds:
-                p.resetJointState(self.armId, i, self.initJoints[i])
+                p.resetJointState(self.armId, i, self.initJoints[i], physicsClientId=self.physics_client)
+        else:
+            # can get stuck in local minima
+            for _ in range(3):
+                self._calculate_init_joints()
+                for i in self.armInds:
+                    p.resetJointState(self.armId, i, self.initJoints[i], physicsClientId=self.physics_client)
 
         self.gripperId = p.loadURDF(os.path.join(cfg.URDF_DIR, "wsg50_flipped_inflated.urdf"),
                                     basePosition=self.init, baseOrientation=self.endEffectorOrientation,
-                                    useFixedBase=False)
+                                    useFixedBase=False, physicsClientId=self.physics_client)
 
         # attach gripper to the end effector
         self.gripperToArmConstraint = p.createConstraint(self.armId, self.endEffectorIndex, self.gripperId, -1,
-                                                         p.JOINT_FIXED, [0, 0, 1], [0, 0, 0], self.gripperOffset)
+                                                         p.JOINT_FIXED, [0, 0, 1], [0, 0, 0], self.gripperOffset,
+                                                         physicsClientId=self.physics_client)
 
         # disable collision between the gripper and the arm
-        for kuka_link_index in range(p.getNumJoints(self.armId)):
-            for gripper_link_index in range(p.getNumJoints(self.gripperId)):
+        for kuka_link_index in range(p.getNumJoints(self.armId, physicsClientId=self.physics_client)):
+            for gripper_link_index in range(p.getNumJoints(self.gripperId, physicsClientId=self.physics_client)):
                 p.setCollisionFilterPair(self.armId, self.gripperId, kuka_link_index, gripper_link_index,
-                                         enableCollision=0)
+                                         enableCollision=0, physicsClientId=self.physics_client)
 
         # resolve constraints and recalculate init joints
         self.close_gripper()
-        for _ in range(100):
-            p.stepSimulation()
-        self.initJoints = self._observe_joints()
+        if cached_init_joints is None:
+            for _ in range(100):
+                p.stepSimulation(physicsClientId=self.physics_client)
+            self.initJoints = self._observe_joints()
 
         # gripper has no mass so does not interact with the world dynamically; we give it a mass
         self.gripper_base_mass = 0.2
-        p.changeDynamics(self.gripperId, -1, mass=self.gripper_base_mass)
+        p.changeDynamics(self.gripperId, -1, mass=self.gripper_base_mass, physicsClientId=self.physics_client)
 
         self._dd.toggle_3d(True)
-        self._make_robot_translucent(self.armId)
-        self._make_robot_translucent(self.gripperId)
+        self._make_robot_translucent(self.armId, physics_client=self.physics_client)
+        self._make_robot_translucent(self.gripperId, physics_client=self.physics_client)
 
     def step(self, action):
         self._clear_state_before_step()
@@ -1760,7 +2178,7 @@ class ObjectRetrievalArmEnv(ObjectRetrievalEnv):
         # get SE(3) of end effector
         # note that we need to get the end of the arm, not the gripper (they are offset with a constant transform)
         # get position and orientation of the end effector of the arm in world frame
-        end_effector_state = p.getLinkState(self.armId, self.endEffectorIndex)
+        end_effector_state = p.getLinkState(self.armId, self.endEffectorIndex, physicsClientId=self.physics_client)
         # note that 0 and 1 is for the center of mass rather than the origin of the link
         pos = end_effector_state[4]
         quat = end_effector_state[5]
@@ -1782,12 +2200,12 @@ class ObjectRetrievalArmEnv(ObjectRetrievalEnv):
             final_joints = p.calculateInverseKinematics(self.armId,
                                                         self.endEffectorIndex,
                                                         final_pos,
-                                                        final_quat)
+                                                        final_quat, physicsClientId=self.physics_client)
             for i in self.armInds:
-                p.resetJointState(self.armId, i, final_joints[i])
+                p.resetJointState(self.armId, i, final_joints[i], physicsClientId=self.physics_client)
         # reset back to actually execute it
         for i in self.armInds:
-            p.resetJointState(self.armId, i, cur_joints[i])
+            p.resetJointState(self.armId, i, cur_joints[i], physicsClientId=self.physics_client)
 
         if self._debug_visualizations[DebugVisualization.ACTION]:
             self._draw_action(action, old_state=pos)
@@ -1813,14 +2231,19 @@ class ObjectRetrievalArmEnv(ObjectRetrievalEnv):
         self.last_ee_pos = self._observe_ee(return_z=True)
         self._send_move_command(joints)
         self.close_gripper()
+        self._mini_step_sim_step = 0
 
-        p.stepSimulation()
+        p.stepSimulation(physicsClientId=self.physics_client)
+        self._record_video_frame()
         for _ in range(steps_to_wait):
             self._observe_info()
-            p.stepSimulation()
+            p.stepSimulation(physicsClientId=self.physics_client)
+            self._record_video_frame()
             if self.mode is p.GUI and self.sim_step_wait:
                 time.sleep(self.sim_step_wait)
-        self._observe_info()
+        self._observe_info(decimate=False)
+        self._control_step_sim_steps += steps_to_wait + 1
+        self._mini_step += 1
 
     def _unpack_action(self, action):
         dx = action[0] * self.MAX_PUSH_DIST
@@ -1829,39 +2252,50 @@ class ObjectRetrievalArmEnv(ObjectRetrievalEnv):
         dyaw = action[3] * self.MAX_PER_ACTION_DYAW
         return dx, dy, dz, dyaw
 
+    def _resume_control_after_restore(self):
+        self._send_move_command(self.initJoints)
+        self.close_gripper()
+
     def reset(self):
+        # drawn meshes are bodies, so clear them before they can prevent restoring the reset snapshot
+        self._dd.clear_visualizations()
+        if self._restore_reset_snapshot():
+            self.contact_detector.clear()
+            return np.copy(self.state)
         for _ in range(1000):
-            p.stepSimulation()
+            p.stepSimulation(physicsClientId=self.physics_client)
 
         if self.gripperToArmConstraint:
-            p.removeConstraint(self.gripperToArmConstraint)
-        p.resetBasePositionAndOrientation(self.gripperId, self.init, self.endEffectorOrientation)
+            p.removeConstraint(self.gripperToArmConstraint, physicsClientId=self.physics_client)
+        p.resetBasePositionAndOrientation(self.gripperId, self.init, self.endEffectorOrientation,
+                                          physicsClientId=self.physics_client)
         self.gripperToArmConstraint = p.createConstraint(self.armId, self.endEffectorIndex, self.gripperId, -1,
-                                                         p.JOINT_FIXED, [0, 0, 1], [0, 0, 0], self.gripperOffset)
+                                                         p.JOINT_FIXED, [0, 0, 1], [0, 0, 0], self.gripperOffset,
+                                                         physicsClientId=self.physics_client)
 
         for i in self.armInds:
-            p.resetJointState(self.armId, i, self.initJoints[i])
+            p.resetJointState(self.armId, i, self.initJoints[i], physicsClientId=self.physics_client)
         self._move_and_wait_joints(self.initJoints)
 
-        for obj in self.immovable + self.movable:
-            p.removeBody(obj)
-        self._setup_objects()
+        self._setup_or_restore_objects()
 
         self._dd.clear_visualizations()
 
-        for obj in self.immovable + self.movable:
-            p.removeBody(obj)
-        self._setup_objects()
+        if self._object_pool is None:
+            for obj in self.immovable + self.movable:
+                p.removeBody(obj, physicsClientId=self.physics_client)
+            self._setup_objects()
 
         # set robot init config
         self._clear_state_between_control_steps()
         # start at rest
         for _ in range(1000):
-            p.stepSimulation()
+            p.stepSimulation(physicsClientId=self.physics_client)
         self.state = self._obs()
         if self._debug_visualizations[DebugVisualization.STATE]:
             self._dd.draw_point('x0', self.get_ee_pos(self.state), color=(0, 1, 0))
         self.contact_detector.clear()
+        self._save_reset_snapshot()
         return np.copy(self.state)
 
 
@@ -1887,7 +2321,7 @@ def pt_to_config_dist(env, max_robot_radius, configs, pts):
     N = pts.shape[0]
     dist = torch.zeros((M, N), dtype=pts.dtype, device=pts.device)
 
-    orig_pos, orig_orientation = p.getBasePositionAndOrientation(env.robot_id)
+    orig_pos, orig_orientation = p.getBasePositionAndOrientation(env.robot_id, physicsClientId=env.physics_client)
     z = orig_pos[2]
 
     # to speed up distance checking, we compute distance from center of robot config to point
@@ -1899,14 +2333,17 @@ def pt_to_config_dist(env, max_robot_radius, configs, pts):
     #         env._dd.draw_point(f't{i}', pt, color=(1, 0, 0), height=z)
 
     for i in range(M):
-        p.resetBasePositionAndOrientation(env.robot_id, [configs[i][0], configs[i][1], z], orig_orientation)
-        for j in range(N):
-            if center_dist[i, j] > max_robot_radius:
-                # just have to report something > 0
-                dist[i, j] = 1
-            else:
-                closest = closest_point_on_surface(env.robot_id, [pts[j][0], pts[j][1], z])
-                dist[i, j] = closest[ContactInfo.DISTANCE]
-
-    p.resetBasePositionAndOrientation(env.robot_id, orig_pos, orig_orientation)
+        # only need the expensive distance to surface check for points close enough to the robot
+        close = (center_dist[i] <= max_robot_radius).nonzero().view(-1)
+        # just have to report something > 0
+        dist[i] = 1
+        if len(close) == 0:
+            continue
+        p.resetBasePositionAndOrientation(env.robot_id, [configs[i][0], configs[i][1], z], orig_orientation,
+                                          physicsClientId=env.physics_client)
+        query_pts = torch.full((len(close), 3), z, dtype=pts.dtype, device=pts.device)
+        query_pts[:, :2] = pts[close, :2]
+        dist[i, close] = closest_points_on_surface(env.robot_id, query_pts, physics_client=env.physics_client)[0]
+
+    p.resetBasePositionAndOrientation(env.robot_id, orig_pos, orig_orientation, physicsClientId=env.physics_client)
     return dist
@@ -13,9 +13,13 @@ from stucco.detection import ContactDetector
 
 
 class InfoKeys:
-    OBJ_POSES = "object_poses"
+    # ground truth of the scene objects, rows in the order of OBJ_IDS
+    OBJ_IDS = "object_ids"
+    OBJ_POSES = "object_poses"  # position cat with unit quaternion orientation
+    OBJ_DISTANCES = "object_distances"  # closest distance to the robot
     DEE_IN_CONTACT = "dee in contact"
     CONTACT_ID = "contact_id"
+    SIM_STEPS = "sim_steps"  # simulation steps taken by the control step
     # highgest frequency feedback of reaction force and torque at end effector
     HIGH_FREQ_REACTION_F = "r"
     HIGH_FREQ_REACTION_T = "t"
@@ -112,7 +116,7 @@ class Visualizer:
 
     def draw_points(self, name, points, color=(0, 0, 0), **kwargs):
         for i, point in enumerate(points):
-            self.draw_point(f"{name}.{i}", point, color[i] if len(color) > 3 else color, **kwargs)
+            self.draw_point(f"{name}.{i}", point, color[i] if np.ndim(color) > 1 else color, **kwargs)
 
     @abc.abstractmethod
     def draw_2d_pose(self, name, pose, color=(0, 0, 0), length=0.15 / 2, height=None):
@@ -124,7 +128,7 @@ class Visualizer:
 
     def draw_2d_lines(self, name, starts, diffs, color=(0, 0, 0), **kwargs):
         for i in range(len(starts)):
-            self.draw_2d_line(f"{name}.{i}", starts[i], diffs[i], color[i] if len(color) > 3 else color, **kwargs)
+            self.draw_2d_line(f"{name}.{i}", starts[i], diffs[i], color[i] if np.ndim(color) > 1 else color, **kwargs)
 
     @abc.abstractmethod
     def clear_visualizations(self, names=None):
@@ -156,6 +160,61 @@ class Visualizer:
         pass
 
 
+class NullVisualizer(Visualizer):
+    """Visualizer that draws nothing, for when there is nobody to see the drawings (e.g. headless runs)"""
+
+    def draw_point(self, name, point, color=(0, 0, 0), length=0.01, length_ratio=1, rot=0, height=None, label=None,
+                   scale=2):
+        pass
+
+    def draw_points(self, name, points, color=(0, 0, 0), **kwargs):
+        pass
+
+    def draw_2d_pose(self, name, pose, color=(0, 0, 0), length=0.15 / 2, height=None):
+        pass
+
+    def draw_2d_line(self, name, start, diff, color=(0, 0, 0), size=2., scale=0.4):
+        pass
+
+    def draw_2d_lines(self, name, starts, diffs, color=(0, 0, 0), **kwargs):
+        pass
+
+    def clear_visualizations(self, names=None):
+        pass
+
+    def clear_visualization_after(self, prefix, index):
+        pass
+
+    def draw_transition(self, x, new_x, height=None):
+        pass
+
+    def draw_mesh(self, name, model, pose, rgba=(0, 0, 0, 1.), scale=1., object_id=None, vis_frame_pos=(0, 0, 0),
+                  vis_frame_rot=(0, 0, 0, 1)):
+        return object_id
+
+    # methods of the pybullet DebugDrawer that the environments also call
+    def set_camera_position(self, camera_pos, yaw=0, pitch=-89):
+        pass
+
+    def toggle_3d(self, using_3d):
+        pass
+
+    def draw_text(self, name, text, location_index, left_offset=1., offset_in_z=False):
+        pass
+
+    def draw_screen_text(self, name, text, camera_frame_pos):
+        pass
+
+    def draw_contact_point(self, name, contact, flip=True):
+        pass
+
+    def draw_contact_friction(self, name, contact, flip=True, height=None):
+        pass
+
+    def clear_transitions(self):
+        pass
+
+
 class Env:
     @property
     @abc.abstractmethod
@@ -0,0 +1,110 @@
+"""Measure the speed and accuracy of the physics presets on the arm environment levels
+
+python -m base_experiments.env.physics_benchmark --env FloatingGripperEnv --levels SELECT1 WALL --steps 10
+"""
+import argparse
+import logging
+import random
+import time
+
+import numpy as np
+import pybullet as p
+
+from base_experiments.env import bubble
+from base_experiments.env.bubble import Levels
+from base_experiments.env.env import Mode, InfoKeys
+from base_experiments.env.pybullet_env import PhysicsPreset
+
+logger = logging.getLogger(__name__)
+
+
+def default_levels(env_class):
+    """Levels that env_class can set up; object retrieval envs use the retrieval levels"""
+    retrieval = issubclass(env_class, bubble.ObjectRetrievalEnv)
+    return [level for level in Levels if (level >= Levels.NO_CLUTTER) == retrieval]
+
+
+def rollout(env_class, level, preset, actions, seed=0, **env_kwargs):
+    """Apply the actions in a fresh env with the given physics preset
+
+    :return: wall time of the steps, sim steps taken, sim time step, end effector positions, and positions of the
+    movable objects
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    env = env_class(environment_level=level, mode=Mode.DIRECT, physics_preset=preset, **env_kwargs)
+    env.reset()
+    ee_positions = []
+    object_positions = []
+    sim_steps = 0
+    start = time.perf_counter()
+    for action in actions:
+        state, _, _, info = env.step(action)
+        sim_steps += info[InfoKeys.SIM_STEPS]
+        ee_positions.append(np.array(env.get_ee_pos(state)))
+        object_positions.append([p.getBasePositionAndOrientation(obj, physicsClientId=env.physics_client)[0]
+                                 for obj in env.movable])
+    elapsed = time.perf_counter() - start
+    sim_step_s = env.sim_step_s
+    env.close()
+    object_positions = np.array(object_positions).reshape(len(actions), -1, 3)
+    return elapsed, sim_steps, sim_step_s, np.stack(ee_positions), object_positions
+
+
+def benchmark(env_class, levels=None, presets=tuple(PhysicsPreset), steps=10, seed=0, **env_kwargs):
+    """Roll out the same random actions on each level under each preset
+
+    :return: list of dicts with the level, preset, sim steps and sim seconds per second of wall time (the latter is
+    comparable across time steps), and the mean and max distance of the end effector and movable objects from their
+    ACCURATE preset trajectories; levels that fail to roll out instead have a single dict with the level and error
+    """
+    if levels is None:
+        levels = default_levels(env_class)
+    actions = np.random.RandomState(seed).uniform(-1, 1, (steps, env_class.nu))
+    results = []
+    for level in levels:
+        try:
+            runs = {preset: rollout(env_class, level, preset, actions, seed=seed, **env_kwargs)
+                    for preset in set(presets) | {PhysicsPreset.ACCURATE}}
+        except Exception as e:
+            logger.exception("%s failed to roll out level %s", env_class.__name__, level.name)
+            results.append({'level': level, 'error': repr(e)})
+            continue
+        _, _, _, ref_ee, ref_obj = runs[PhysicsPreset.ACCURATE]
+        for preset in presets:
+            elapsed, sim_steps, sim_step_s, ee, obj = runs[preset]
+            ee_err = np.linalg.norm(ee - ref_ee, axis=-1)
+            obj_err = np.linalg.norm(obj - ref_obj, axis=-1) if obj.size else np.zeros(1)
+            results.append({'level': level, 'preset': preset, 'steps_per_s': sim_steps / elapsed,
+                            'realtime_factor': sim_steps * sim_step_s / elapsed,
+                            'ee_mean': ee_err.mean(), 'ee_max': ee_err.max(),
+                            'obj_mean': obj_err.mean(), 'obj_max': obj_err.max()})
+    return results
+
+
+def format_results(results):
+    lines = [f"{'level':<20}{'preset':<10}{'steps/s':>10}{'x realtime':>11}"
+             f"{'ee mean':>10}{'ee max':>10}{'obj mean':>10}{'obj max':>10}"]
+    for r in results:
+        if 'error' in r:
+            lines.append(f"{r['level'].name:<20}failed: {r['error']}")
+            continue
+        lines.append(f"{r['level'].name:<20}{r['preset'].value:<10}{r['steps_per_s']:>10.0f}"
+                     f"{r['realtime_factor']:>11.1f}{r['ee_mean']:>10.4f}"
+                     f"{r['ee_max']:>10.4f}{r['obj_mean']:>10.4f}{r['obj_max']:>10.4f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the speed and accuracy of the physics presets')
+    parser.add_argument('--env', default='FloatingGripperEnv', help='env class in base_experiments.env.bubble')
+    parser.add_argument('--levels', nargs='*', default=None, help='level names; defaults to all for the env')
+    parser.add_argument('--presets', nargs='*', default=[preset.value for preset in PhysicsPreset])
+    parser.add_argument('--steps', type=int, default=10, help='control steps per rollout')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    env_class = getattr(bubble, args.env)
+    levels = None if args.levels is None else [Levels[name] for name in args.levels]
+    print(format_results(benchmark(env_class, levels, [PhysicsPreset(name) for name in args.presets],
+                                   steps=args.steps, seed=args.seed)))
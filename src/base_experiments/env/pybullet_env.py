@@ -1,11 +1,15 @@
 import abc
+import importlib.util
 import logging
 import pybullet as p
+import queue
 import random
+import threading
 import time
 import numpy as np
 import enum
 import math
+from collections import OrderedDict
 
 from datetime import datetime
 
@@ -14,7 +18,7 @@ from arm_pytorch_utilities import math_utils
 import pytorch_kinematics as pk
 
 import pybullet_data
-from base_experiments.env.env import Visualizer, Env, Mode
+from base_experiments.env.env import Visualizer, NullVisualizer, Env, Mode
 
 logger = logging.getLogger(__name__)
 
@@ -24,89 +28,363 @@ state_action_color_pairs = [[(1, 0.5, 0), (1, 0.8, 0.4)],
                             [(181 / 255, 237 / 255, 28 / 255), (148 / 255, 194 / 255, 23 / 255)]]
 
 
-def remove_user_debug_item(id):
+def remove_user_debug_item(id, physics_client=0):
     # p.removeUserDebugItem seems bugged and after calling it the whole simulation slows dramatically
-    p.addUserDebugLine([-100, -100, -100], [-100, -100, -100], (0, 0, 0), 1, replaceItemUniqueId=id)
+    p.addUserDebugLine([-100, -100, -100], [-100, -100, -100], (0, 0, 0), 1, replaceItemUniqueId=id,
+                       physicsClientId=physics_client)
 
 
-def make_box(half_extents, position, euler_angles, lateral_friction=0.7):
-    col_id = p.createCollisionShape(p.GEOM_BOX, halfExtents=half_extents)
-    vis_id = p.createVisualShape(p.GEOM_BOX, halfExtents=half_extents, rgbaColor=[0.2, 0.2, 0.2, 0.8])
-    obj_id = p.createMultiBody(0, col_id, vis_id, basePosition=position,
-                               baseOrientation=p.getQuaternionFromEuler(euler_angles))
-    p.changeDynamics(obj_id, -1, lateralFriction=lateral_friction)
+def remove_user_debug_points(id, physics_client=0):
+    # debug points can only be replaced by other debug points, so hide them the same way as remove_user_debug_item
+    p.addUserDebugPoints([[-100, -100, -100]], [[0, 0, 0]], 1, replaceItemUniqueId=id, physicsClientId=physics_client)
+
+
+def _debug_rows(values):
+    if torch.is_tensor(values):
+        values = values.detach().cpu().numpy()
+    else:
+        values = [v.detach().cpu().numpy() if torch.is_tensor(v) else v for v in values]
+    return np.array(values, dtype=float).reshape(len(values), -1)
+
+
+def _debug_colors(color, n):
+    # either a single color or one color per element
+    color = np.asarray(color, dtype=float)
+    if color.ndim > 1:
+        return color[:, :3]
+    return np.broadcast_to(color[:3], (n, 3))
+
+
+# center of mass frame of each body's base link relative to the base link frame, and what's derived from it, for each
+# physics client
+_COM_FRAME_CACHE = {}
+
+
+def clear_com_frame_cache(physics_client=0):
+    """Forget the cached center of mass frames of a physics client, such as when it gets disconnected"""
+    _COM_FRAME_CACHE.pop(physics_client, None)
+
+
+def _get_com_frame(body_id, physics_client):
+    info = p.getDynamicsInfo(body_id, -1, physicsClientId=physics_client)
+    frames = _COM_FRAME_CACHE.setdefault(physics_client, {})
+    frame = frames.get(body_id)
+    # body IDs get reused after bodies are removed, so recompute when the center of mass changes
+    if frame is None or frame['pos'] != info[3] or frame['xyzw'] != info[4]:
+        inv_pos, inv_xyzw = p.invertTransform(info[3], info[4])
+        frame = frames[body_id] = {'pos': info[3], 'xyzw': info[4], 'inv_pos': inv_pos, 'inv_xyzw': inv_xyzw}
+    return frame
+
+
+# collision and visual shapes shared between bodies for each physics client, keyed by their creation arguments
+_SHAPE_CACHE = {}
+_SHAPE_CACHE_COUNTS = {}
+
+
+def clear_shape_cache(physics_client=0):
+    """Forget the shared shapes of a physics client, such as when it gets disconnected or reset"""
+    _SHAPE_CACHE.pop(physics_client, None)
+    _SHAPE_CACHE_COUNTS.pop(physics_client, None)
+
+
+def shape_cache_counts(physics_client=0):
+    """Number of collision and visual shapes created and reused by make_box, make_cylinder, and make_sphere"""
+    return dict(_SHAPE_CACHE_COUNTS.get(physics_client, {'created': 0, 'reused': 0}))
+
+
+def _shape_signature(obj_id, create_shape, physics_client):
+    # geometry type, dimensions, and color of the body's shape to check a reused shape ID is still the same shape
+    if create_shape is p.createCollisionShape:
+        data = p.getCollisionShapeData(obj_id, -1, physicsClientId=physics_client)
+        return data[0][2:4] if len(data) else None
+    data = p.getVisualShapeData(obj_id, physicsClientId=physics_client)
+    return data[0][2:4] + data[0][7:8] if len(data) else None
+
+
+def _make_body_with_shared_shapes(col_args, vis_args, mass, position, orientation, physics_client):
+    shapes = _SHAPE_CACHE.setdefault(physics_client, {})
+    counts = _SHAPE_CACHE_COUNTS.setdefault(physics_client, {'created': 0, 'reused': 0})
+    shape_ids = []
+    keys = []
+    for create_shape, args in ((p.createCollisionShape, col_args), (p.createVisualShape, vis_args)):
+        if args is None:
+            shape_ids.append(-1)
+            keys.append(None)
+            continue
+        key = (create_shape, tuple((k, tuple(np.ravel(v).tolist())) for k, v in sorted(args.items())))
+        if key in shapes:
+            counts['reused'] += 1
+        else:
+            shapes[key] = [create_shape(**args, physicsClientId=physics_client), None]
+            counts['created'] += 1
+        shape_ids.append(shapes[key][0])
+        keys.append(key)
+
+    obj_id = p.createMultiBody(mass, shape_ids[0], shape_ids[1], basePosition=position, baseOrientation=orientation,
+                               physicsClientId=physics_client)
+    for key in keys:
+        if key is None:
+            continue
+        signature = _shape_signature(obj_id, key[0], physics_client)
+        if shapes[key][1] is None:
+            shapes[key][1] = signature
+        elif signature != shapes[key][1]:
+            # the client was reset or reconnected so the shape IDs no longer refer to our shapes
+            logger.debug("shape cache for physics client %d is stale; clearing it", physics_client)
+            p.removeBody(obj_id, physicsClientId=physics_client)
+            clear_shape_cache(physics_client)
+            return _make_body_with_shared_shapes(col_args, vis_args, mass, position, orientation, physics_client)
+    return obj_id
+
+
+def make_box(half_extents, position, euler_angles, lateral_friction=0.7, physics_client=0):
+    obj_id = _make_body_with_shared_shapes(dict(shapeType=p.GEOM_BOX, halfExtents=half_extents),
+                                           dict(shapeType=p.GEOM_BOX, halfExtents=half_extents,
+                                                rgbaColor=[0.2, 0.2, 0.2, 0.8]),
+                                           0, position, p.getQuaternionFromEuler(euler_angles), physics_client)
+    p.changeDynamics(obj_id, -1, lateralFriction=lateral_friction, physicsClientId=physics_client)
     return obj_id
 
 
-def make_cylinder(radius, height, position, euler_angles, mass=1., lateral_friction=1.5, spinning_friction=0.1):
-    col_id = p.createCollisionShape(p.GEOM_CYLINDER, radius=radius, height=height)
-    vis_id = p.createVisualShape(p.GEOM_CYLINDER, radius=radius, length=height, rgbaColor=[0.8, 0.7, 0.3, 0.8])
-    obj_id = p.createMultiBody(mass, col_id, vis_id, basePosition=position,
-                               baseOrientation=p.getQuaternionFromEuler(euler_angles))
-    p.changeDynamics(obj_id, -1, lateralFriction=lateral_friction, spinningFriction=spinning_friction)
+def make_cylinder(radius, height, position, euler_angles, mass=1., lateral_friction=1.5, spinning_friction=0.1,
+                  physics_client=0):
+    obj_id = _make_body_with_shared_shapes(dict(shapeType=p.GEOM_CYLINDER, radius=radius, height=height),
+                                           dict(shapeType=p.GEOM_CYLINDER, radius=radius, length=height,
+                                                rgbaColor=[0.8, 0.7, 0.3, 0.8]),
+                                           mass, position, p.getQuaternionFromEuler(euler_angles), physics_client)
+    p.changeDynamics(obj_id, -1, lateralFriction=lateral_friction, spinningFriction=spinning_friction,
+                     physicsClientId=physics_client)
     return obj_id
 
 
 def make_sphere(radius, position, visual_only=False, mass=1., lateral_friction=1.5, spinning_friction=0.1,
-                rgba=(0.8, 0.7, 0.3, 0.8)):
-    col_id = -1
+                rgba=(0.8, 0.7, 0.3, 0.8), physics_client=0):
+    col_args = None
     if not visual_only:
-        col_id = p.createCollisionShape(p.GEOM_SPHERE, radius=radius)
-    vis_id = p.createVisualShape(p.GEOM_SPHERE, radius=radius, rgbaColor=rgba)
-    obj_id = p.createMultiBody(mass, col_id, vis_id, basePosition=position)
-    p.changeDynamics(obj_id, -1, lateralFriction=lateral_friction, spinningFriction=spinning_friction)
+        col_args = dict(shapeType=p.GEOM_SPHERE, radius=radius)
+    obj_id = _make_body_with_shared_shapes(col_args, dict(shapeType=p.GEOM_SPHERE, radius=radius, rgbaColor=rgba),
+                                           mass, position, [0, 0, 0, 1], physics_client)
+    p.changeDynamics(obj_id, -1, lateralFriction=lateral_friction, spinningFriction=spinning_friction,
+                     physicsClientId=physics_client)
     return obj_id
 
 
-_CONTACT_TESTER_ID = -1
+# contact tester bodies and shapes for each physics client
+_CONTACT_TESTER_ID = {}
+_CONTACT_TESTER_SHAPE_ID = {}
+
+
+def clear_contact_testers(physics_client=0):
+    """Forget the contact testers of a physics client, such as when it gets disconnected or reset"""
+    _CONTACT_TESTER_ID.pop(physics_client, None)
+    _CONTACT_TESTER_SHAPE_ID.pop(physics_client, None)
 
 
-def closest_point_on_surface(object_id, query_point, return_full_contact_info=True):
+def _get_contact_tester(query_point, physics_client):
     # create query object if it doesn't exist
-    global _CONTACT_TESTER_ID
-    if _CONTACT_TESTER_ID == -1:
-        col_id = p.createCollisionShape(p.GEOM_SPHERE, radius=1e-8)
-        vis_id = p.createVisualShape(p.GEOM_SPHERE, radius=0.003, rgbaColor=[0.1, 0.9, 0.3, 0.6])
-        _CONTACT_TESTER_ID = p.createMultiBody(0, col_id, vis_id, basePosition=query_point)
-
-    p.resetBasePositionAndOrientation(_CONTACT_TESTER_ID, query_point, [0, 0, 0, 1])
-    p.performCollisionDetection()
-    pts_on_surface = p.getClosestPoints(object_id, _CONTACT_TESTER_ID, 100, linkIndexB=-1)
+    tester_id = _CONTACT_TESTER_ID.get(physics_client, -1)
+    if tester_id == -1:
+        col_id = p.createCollisionShape(p.GEOM_SPHERE, radius=1e-8, physicsClientId=physics_client)
+        vis_id = p.createVisualShape(p.GEOM_SPHERE, radius=0.003, rgbaColor=[0.1, 0.9, 0.3, 0.6],
+                                     physicsClientId=physics_client)
+        tester_id = p.createMultiBody(0, col_id, vis_id, basePosition=query_point, physicsClientId=physics_client)
+        _CONTACT_TESTER_ID[physics_client] = tester_id
+    return tester_id
+
+
+def closest_point_on_surface(object_id, query_point, return_full_contact_info=True, physics_client=0):
+    tester_id = _get_contact_tester(query_point, physics_client)
+
+    p.resetBasePositionAndOrientation(tester_id, query_point, [0, 0, 0, 1], physicsClientId=physics_client)
+    p.performCollisionDetection(physicsClientId=physics_client)
+    pts_on_surface = p.getClosestPoints(object_id, tester_id, 100, linkIndexB=-1, physicsClientId=physics_client)
     # if the pybullet environment is reset and the object doesn't exist; this will not catch all cases
     if len(pts_on_surface) < 1:
-        _CONTACT_TESTER_ID = -1
-        return closest_point_on_surface(object_id, query_point, return_full_contact_info=return_full_contact_info)
+        _CONTACT_TESTER_ID[physics_client] = -1
+        return closest_point_on_surface(object_id, query_point, return_full_contact_info=return_full_contact_info,
+                                        physics_client=physics_client)
 
     pts_on_surface = sorted(pts_on_surface, key=lambda c: c[ContactInfo.DISTANCE])
 
     # move out the way
-    p.resetBasePositionAndOrientation(_CONTACT_TESTER_ID, [0, 0, 100], [0, 0, 0, 1])
+    p.resetBasePositionAndOrientation(tester_id, [0, 0, 100], [0, 0, 0, 1], physicsClientId=physics_client)
     ret = pts_on_surface[0]
     if not return_full_contact_info:
         ret = ret[ContactInfo.POS_A]
     return ret
 
 
-def surface_normal_at_point(object_id, query_point):
-    # find contact normal on point of object closest to query point
-    query_point = closest_point_on_surface(object_id, query_point, return_full_contact_info=False)
-
-    global _CONTACT_TESTER_ID
-    if _CONTACT_TESTER_ID == -1:
-        col_id = p.createCollisionShape(p.GEOM_SPHERE, radius=1e-8)
-        vis_id = p.createVisualShape(p.GEOM_SPHERE, radius=0.003, rgbaColor=[0.1, 0.9, 0.3, 0.6])
-        _CONTACT_TESTER_ID = p.createMultiBody(0, col_id, vis_id, basePosition=query_point)
-
-    p.resetBasePositionAndOrientation(_CONTACT_TESTER_ID, query_point, [0, 0, 0, 1])
-    p.performCollisionDetection()
-    pts_on_surface = p.getContactPoints(object_id, _CONTACT_TESTER_ID, linkIndexB=-1)
-    # if the pybullet environment is reset and the object doesn't exist; this will not catch all cases
+def _tester_shape_exists(shape_id, physics_client):
+    # two copies of the tester shape 1m apart are 1m apart only if the shape is still our tiny sphere
+    pts = p.getClosestPoints(-1, -1, 2, collisionShapeA=shape_id, collisionShapeB=shape_id,
+                             collisionShapePositionB=[0, 0, 1], physicsClientId=physics_client)
+    return len(pts) > 0 and abs(pts[0][ContactInfo.DISTANCE] - 1) < 1e-6
+
+
+def _closest_points_to_tester_shape(object_id, query_point, max_distance, physics_client):
+    shape_id = _CONTACT_TESTER_SHAPE_ID.get(physics_client, -1)
+    if shape_id == -1:
+        shape_id = p.createCollisionShape(p.GEOM_SPHERE, radius=1e-8, physicsClientId=physics_client)
+        _CONTACT_TESTER_SHAPE_ID[physics_client] = shape_id
+    pts_on_surface = p.getClosestPoints(object_id, -1, max_distance, collisionShapeB=shape_id,
+                                        collisionShapePositionB=query_point, physicsClientId=physics_client)
+    # nothing within max_distance is normal; only if the pybullet environment was reset or reconnected without
+    # clear_contact_testers is the shape gone and needs to be recreated
+    if len(pts_on_surface) < 1 and not _tester_shape_exists(shape_id, physics_client):
+        shape_id = p.createCollisionShape(p.GEOM_SPHERE, radius=1e-8, physicsClientId=physics_client)
+        _CONTACT_TESTER_SHAPE_ID[physics_client] = shape_id
+        pts_on_surface = p.getClosestPoints(object_id, -1, max_distance, collisionShapeB=shape_id,
+                                            collisionShapePositionB=query_point, physicsClientId=physics_client)
+    return pts_on_surface
+
+
+def closest_point_and_normal(object_id, query_point, max_distance=100, physics_client=0):
+    """Closest point on the object surface to the query point along with its signed distance and surface normal.
+
+    Everything comes from a single closest point query against a tester collision shape placed at the query point.
+    :return: signed distance, closest point on the object surface, and surface normal pointing out of the object;
+    the distance is inf and the point and normal are zero if the object is not within max_distance
+    """
+    pts_on_surface = _closest_points_to_tester_shape(object_id, query_point, max_distance, physics_client)
     if len(pts_on_surface) < 1:
-        return np.zeros(3)
-
-    # move out the way
-    p.resetBasePositionAndOrientation(_CONTACT_TESTER_ID, [0, 0, 100], [0, 0, 0, 1])
-    return pts_on_surface[0][ContactInfo.NORMAL_DIR_B]
+        return np.inf, np.zeros(3), np.zeros(3)
+    # for multi-link bodies there is 1 per link
+    closest = min(pts_on_surface, key=lambda c: c[ContactInfo.DISTANCE])
+    # normal on the tester points towards the object, so negate it to point out of the surface
+    normal = -np.array(closest[ContactInfo.NORMAL_DIR_B])
+    return closest[ContactInfo.DISTANCE], np.array(closest[ContactInfo.POS_A]), normal
+
+
+def closest_points_on_surface(object_id, query_points, max_distance=100, physics_client=0):
+    """Batched version of closest_point_and_normal for an (N, 3) array or tensor of query points against one object.
+
+    Instead of moving a tester body around and running collision detection for every point, each point is queried
+    directly against a tester collision shape placed at that point, so the world is never modified.
+    :return: signed distances (N,), closest points on the object surface (N, 3), and surface normals (N, 3) pointing
+    out of the object (the SDF gradient); tensors matching the input if it is a tensor, otherwise numpy arrays
+    """
+    is_tensor = torch.is_tensor(query_points)
+    if is_tensor:
+        dtype = query_points.dtype
+        device = query_points.device
+        query_points = query_points.detach().cpu().numpy()
+    query_points = np.asarray(query_points, dtype=np.float64).reshape(-1, 3)
+    N = query_points.shape[0]
+
+    distances = np.full(N, np.inf)
+    surface_points = np.zeros((N, 3))
+    normals = np.zeros((N, 3))
+    for i in range(N):
+        distances[i], surface_points[i], normals[i] = closest_point_and_normal(object_id, query_points[i],
+                                                                               max_distance=max_distance,
+                                                                               physics_client=physics_client)
+
+    if is_tensor:
+        distances, surface_points, normals = (torch.tensor(v, dtype=dtype, device=device) for v in
+                                              (distances, surface_points, normals))
+    return distances, surface_points, normals
+
+
+def surface_normal_at_point(object_id, query_point, physics_client=0):
+    # contact normal on point of object closest to query point, pointing into the object like NORMAL_DIR_B
+    _, _, normal = closest_point_and_normal(object_id, query_point, physics_client=physics_client)
+    return -normal
+
+
+class SurfaceQueryCache:
+    """Opt-in LRU cache for closest_point_on_surface, closest_point_and_normal and surface_normal_at_point queries.
+
+    Queries are keyed on the body, the query point quantized to the given resolution, and the body's base pose.
+    Entries of a body are dropped as soon as it is seen to have moved, so this is most useful for static bodies.
+    Only the base pose is checked, so articulated bodies with moving joints should not be queried through this.
+    """
+
+    def __init__(self, resolution=1e-4, max_size=100000, physics_client=0):
+        """
+        :param resolution: grid size (m) the query points are quantized to; queries are done at the quantized point
+        :param max_size: maximum number of cached queries, with the least recently used evicted first
+        :param physics_client: pybullet physics client the queried bodies live in
+        """
+        self.resolution = resolution
+        self.max_size = max_size
+        self.physics_client = physics_client
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._body_pose = {}
+        self._body_keys = {}
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        self._cache.clear()
+        self._body_pose = {}
+        self._body_keys = {}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, object_id):
+        """Drop all cached queries for this body"""
+        for key in self._body_keys.pop(object_id, ()):
+            self._cache.pop(key, None)
+        self._body_pose.pop(object_id, None)
+
+    def _query(self, query_type, object_id, query_point, query_fn):
+        pos, orn = p.getBasePositionAndOrientation(object_id, physicsClientId=self.physics_client)
+        pose = pos + orn
+        if self._body_pose.get(object_id) != pose:
+            self.invalidate(object_id)
+            self._body_pose[object_id] = pose
+
+        cell = tuple(np.round(np.asarray(query_point, dtype=np.float64) / self.resolution).astype(int))
+        key = (query_type, object_id, cell)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses += 1
+        value = query_fn(object_id, [c * self.resolution for c in cell], physics_client=self.physics_client)
+        self._cache[key] = value
+        self._body_keys.setdefault(object_id, set()).add(key)
+        if len(self._cache) > self.max_size:
+            old_key, _ = self._cache.popitem(last=False)
+            self._body_keys[old_key[1]].discard(old_key)
+        return value
+
+    def closest_point_on_surface(self, object_id, query_point, return_full_contact_info=True):
+        ret = self._query('closest', object_id, query_point, closest_point_on_surface)
+        if not return_full_contact_info:
+            ret = ret[ContactInfo.POS_A]
+        return ret
+
+    def closest_point_and_normal(self, object_id, query_point):
+        return self._query('closest_and_normal', object_id, query_point, closest_point_and_normal)
+
+    def surface_normal_at_point(self, object_id, query_point):
+        return self._query('normal', object_id, query_point, surface_normal_at_point)
+
+
+class PhysicsPreset(enum.Enum):
+    """Tradeoffs between simulation speed and accuracy; see physics_benchmark for their measured effects"""
+    FAST = 'fast'
+    DEFAULT = 'default'
+    ACCURATE = 'accurate'
+
+
+# time step and setPhysicsEngineParameter arguments of each preset; the default keeps pybullet's own parameters
+# FAST keeps the default contact parameters: at 1/120 s objects resting against the gripper's fingers get launched on
+# reset, which contactERP, frictionERP and contactSlop don't prevent and disabling cone friction only reduces, while at
+# 1/180 s objects drift about as much as with the default and changing them makes no difference
+PHYSICS_PRESETS = {
+    PhysicsPreset.FAST: {'sim_step_s': 1. / 180., 'engine': {'numSolverIterations': 20}},
+    PhysicsPreset.DEFAULT: {'sim_step_s': 1. / 240., 'engine': {}},
+    PhysicsPreset.ACCURATE: {'sim_step_s': 1. / 240., 'engine': {'numSolverIterations': 150, 'numSubSteps': 4,
+                                                                 'solverResidualThreshold': 1e-9}},
+}
 
 
 class PybulletEnv(Env):
@@ -114,12 +392,23 @@ class PybulletEnv(Env):
     LINK_FRAME_ORIENTATION = [0, 0, 0, 1]
 
     def __init__(self, mode=Mode.DIRECT, log_video=False, video_name="", default_debug_height=0, camera_dist=1.5,
-                 background=None):
+                 background=None, visualize=None, video_fps=30, physics_preset=PhysicsPreset.DEFAULT):
+        """
+        :param visualize: whether to draw debug visualizations; if None, draw them only in GUI mode
+        :param video_fps: frame rate of videos logged without a GUI, which are rendered offscreen
+        :param physics_preset: PhysicsPreset (or its value) setting the time step and solver parameters
+        """
         self.log_video = log_video
         self.video_name = video_name
+        self.video_fps = video_fps
+        self.logging_id = None
+        self.video_recorder = None
+        self._video_sim_steps = 0
+        self.camera_dist = camera_dist
         self.mode = mode
         self.realtime = False
-        self.sim_step_s = 1. / 240.
+        self.physics_preset = PhysicsPreset(physics_preset)
+        self.sim_step_s = PHYSICS_PRESETS[self.physics_preset]['sim_step_s']
         self.randseed = None
         self.background = background
 
@@ -128,10 +417,25 @@ class PybulletEnv(Env):
         self.R = self.control_cost()
 
         self._configure_physics_engine()
-        self._dd = DebugDrawer(default_debug_height, camera_dist)
+        self.visualize = self.mode == Mode.GUI if visualize is None else visualize
+        if self.visualize:
+            self._dd = DebugDrawer(default_debug_height, camera_dist, physics_client=self.physics_client)
+        else:
+            self._dd = NullVisualizer()
 
     def set_camera_position(self, camera_pos, yaw=0, pitch=-89):
         self._dd.set_camera_position(camera_pos, yaw, pitch)
+        if self.video_recorder is not None:
+            target = [camera_pos[0], camera_pos[1], camera_pos[2] if len(camera_pos) > 2 else 0]
+            self.video_recorder.set_camera(target, self.camera_dist, yaw, pitch)
+
+    def _record_video_frame(self):
+        """Call after each simulation step to capture offscreen video frames at the video frame rate"""
+        if self.video_recorder is None:
+            return
+        self._video_sim_steps += 1
+        if self._video_sim_steps % max(1, round(1 / (self.video_fps * self.sim_step_s))) == 0:
+            self.video_recorder.capture()
 
     def _configure_physics_engine(self):
         mode_dict = {Mode.GUI: p.GUI, Mode.DIRECT: p.DIRECT}
@@ -146,20 +450,35 @@ class PybulletEnv(Env):
         self.physics_client = p.connect(mode, options=options)  # p.GUI for GUI or p.DIRECT for non-graphical version
 
         # disable useless menus on the left and right
-        p.configureDebugVisualizer(p.COV_ENABLE_GUI, 0)
+        p.configureDebugVisualizer(p.COV_ENABLE_GUI, 0, physicsClientId=self.physics_client)
         if self.log_video:
             if self.video_name == "":
                 self.video_name = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
-            self.logging_id = p.startStateLogging(p.STATE_LOGGING_VIDEO_MP4, "{}.mp4".format(self.video_name))
+            if mode == p.GUI:
+                self.logging_id = p.startStateLogging(p.STATE_LOGGING_VIDEO_MP4, "{}.mp4".format(self.video_name),
+                                                      physicsClientId=self.physics_client)
+            else:
+                # video logging needs the GUI, so render the frames ourselves
+                self.video_recorder = OffscreenVideoRecorder("{}.mp4".format(self.video_name), fps=self.video_fps,
+                                                             camera_distance=self.camera_dist,
+                                                             physics_client=self.physics_client)
 
         # use data provided by PyBullet
-        p.setAdditionalSearchPath(pybullet_data.getDataPath())  # optionally
+        p.setAdditionalSearchPath(pybullet_data.getDataPath(), physicsClientId=self.physics_client)  # optionally
 
         if self.realtime:
-            p.setRealTimeSimulation(True)
+            p.setRealTimeSimulation(True, physicsClientId=self.physics_client)
         else:
-            p.setRealTimeSimulation(False)
-            p.setTimeStep(self.sim_step_s)
+            p.setRealTimeSimulation(False, physicsClientId=self.physics_client)
+            p.setTimeStep(self.sim_step_s, physicsClientId=self.physics_client)
+        engine_parameters = PHYSICS_PRESETS[self.physics_preset]['engine']
+        if engine_parameters:
+            p.setPhysicsEngineParameter(**engine_parameters, physicsClientId=self.physics_client)
+
+    def sim_steps(self, default_steps):
+        """Number of sim steps covering the same simulated time as default_steps at the default time step"""
+        default_step_s = PHYSICS_PRESETS[PhysicsPreset.DEFAULT]['sim_step_s']
+        return max(1, round(default_steps * default_step_s / self.sim_step_s))
 
     def seed(self, randseed=None):
         random.seed(time.time())
@@ -171,8 +490,16 @@ class PybulletEnv(Env):
         # potentially also randomize the starting configuration
 
     def close(self):
-        if self.log_video:
-            p.stopStateLogging(self.logging_id)
+        if self.logging_id is not None:
+            p.stopStateLogging(self.logging_id, physicsClientId=self.physics_client)
+        if self.video_recorder is not None:
+            self.video_recorder.close()
+            logger.info("offscreen video %s captured %d frames and dropped %d, taking %.3fs",
+                        self.video_recorder.filename, self.video_recorder.frames_captured,
+                        self.video_recorder.dropped_frames, self.video_recorder.capture_time)
+        clear_contact_testers(self.physics_client)
+        clear_shape_cache(self.physics_client)
+        clear_com_frame_cache(self.physics_client)
         p.disconnect(self.physics_client)
 
     def draw_user_text(self, text, location_index=1, left_offset=1.0, xy=None):
@@ -220,51 +547,146 @@ class PybulletEnv(Env):
         """In GUI mode, show the difference between the predicted state and the current actual state"""
 
     @staticmethod
-    def _make_robot_translucent(robot_id, alpha=0.4):
+    def _make_robot_translucent(robot_id, alpha=0.4, physics_client=0):
         def make_transparent(link):
             link_id = link[1]
             rgba = list(link[7])
             rgba[3] = alpha
-            p.changeVisualShape(robot_id, link_id, rgbaColor=rgba)
+            p.changeVisualShape(robot_id, link_id, rgbaColor=rgba, physicsClientId=physics_client)
 
-        visual_data = p.getVisualShapeData(robot_id)
+        visual_data = p.getVisualShapeData(robot_id, physicsClientId=physics_client)
         for link in visual_data:
             make_transparent(link)
 
     @staticmethod
-    def get_com_tf(robot_id):
-        info = p.getDynamicsInfo(robot_id, -1)
-        pos_com = torch.tensor(info[3])
-        xyzw_com = torch.tensor(info[4])
-        return pk.Transform3d(pos=pos_com, rot=pk.xyzw_to_wxyz(xyzw_com))
+    def get_com_tf(robot_id, physics_client=0):
+        """Center of mass frame of the base link relative to the base link frame"""
+        frame = _get_com_frame(robot_id, physics_client)
+        return pk.Transform3d(pos=torch.tensor(frame['pos']), rot=pk.xyzw_to_wxyz(torch.tensor(frame['xyzw'])))
 
     @staticmethod
-    def reset_base_link_frame(robot_id, pos, rpy):
+    def reset_base_link_frame(robot_id, pos, rpy, physics_client=0):
         """pybullet uses the center of mass for get/reset base position and orientation, this provides an alternative
         to specifying the base link frame."""
-        com_tf = PybulletEnv.get_com_tf(robot_id)
+        frame = _get_com_frame(robot_id, physics_client)
         baseOrientation = p.getQuaternionFromEuler(rpy)
         # convert to COM frame
-        world_to_base_tf = pk.Transform3d(pos=torch.tensor(pos),
-                                          rot=pk.xyzw_to_wxyz(torch.tensor(baseOrientation)))
-        world_to_base_com_tf = world_to_base_tf.compose(com_tf)
-        pos, xyzw = pk.rotation_conversions.matrix_to_pos_rot(world_to_base_com_tf.get_matrix())
-        p.resetBasePositionAndOrientation(robot_id, pos[0], xyzw[0])
+        pos, xyzw = p.multiplyTransforms(pos, baseOrientation, frame['pos'], frame['xyzw'])
+        p.resetBasePositionAndOrientation(robot_id, pos, xyzw, physicsClientId=physics_client)
 
     @staticmethod
-    def get_base_link_frame(robot_id):
+    def get_base_link_frame(robot_id, physics_client=0):
         """pybullet uses the center of mass for get/reset base position and orientation, this provides an alternative
         for retrieving the base link frame."""
-        com_tf = PybulletEnv.get_com_tf(robot_id)
-        pos, xyzw = p.getBasePositionAndOrientation(robot_id)
-        world_to_base_com_tf = pk.Transform3d(pos=torch.tensor(pos),
-                                              rot=pk.xyzw_to_wxyz(torch.tensor(xyzw)))
-        world_to_base_tf = world_to_base_com_tf.compose(com_tf.inverse())
-        return world_to_base_tf
+        return PybulletEnv.get_base_link_frames([robot_id], physics_client=physics_client)
+
+    @staticmethod
+    def get_base_link_frames(robot_ids, physics_client=0):
+        """Batched get_base_link_frame, with the frame of each robot in order as a single Transform3d"""
+        pos = []
+        xyzw = []
+        for robot_id in robot_ids:
+            frame = _get_com_frame(robot_id, physics_client)
+            com_pos, com_xyzw = p.getBasePositionAndOrientation(robot_id, physicsClientId=physics_client)
+            base_pos, base_xyzw = p.multiplyTransforms(com_pos, com_xyzw, frame['inv_pos'], frame['inv_xyzw'])
+            pos.append(base_pos)
+            xyzw.append(base_xyzw)
+        return pk.Transform3d(pos=torch.tensor(pos), rot=pk.xyzw_to_wxyz(torch.tensor(xyzw)))
+
+
+class OffscreenVideoRecorder:
+    """Record video by rendering with getCameraImage, which unlike STATE_LOGGING_VIDEO_MP4 works without a GUI.
+
+    Frames are encoded on a background thread so capturing doesn't wait on compression. When the encoder falls behind
+    and its queue is full, new frames are dropped and counted in dropped_frames.
+    """
+
+    def __init__(self, filename, fps=30, width=320, height=240, camera_target=(0, 0, 0), camera_distance=1.5, yaw=0,
+                 pitch=-89, fov=60, use_egl=False, max_queued_frames=64, writer=None, physics_client=0):
+        """
+        :param filename: video file to write
+        :param fps: frame rate the video is played back at
+        :param use_egl: render with OpenGL through pybullet's EGL plugin, which is much faster than the default CPU
+        renderer on machines with a GPU but needs an EGL capable driver; falls back to the default renderer if
+        pybullet's EGL plugin is not installed or fails to load
+        :param max_queued_frames: number of captured frames waiting to be encoded before new frames are dropped
+        :param writer: object with append_data(frame) and close() methods, such as an imageio writer; by default an
+        imageio writer for filename (needs imageio and imageio-ffmpeg from the video extra)
+        :param physics_client: pybullet physics client to render
+        """
+        if writer is None:
+            import imageio
+            writer = imageio.get_writer(filename, fps=fps)
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.fov = fov
+        self.physics_client = physics_client
+        self.renderer = p.ER_TINY_RENDERER
+        self._egl_plugin = None
+        if use_egl:
+            egl = importlib.util.find_spec('eglRenderer')
+            if egl is not None:
+                self._egl_plugin = p.loadPlugin(egl.origin, "_eglRendererPlugin", physicsClientId=physics_client)
+            if egl is None or self._egl_plugin < 0:
+                logger.warning("pybullet's EGL renderer plugin could not be loaded; rendering with TinyRenderer")
+                self._egl_plugin = None
+            else:
+                self.renderer = p.ER_BULLET_HARDWARE_OPENGL
+        self.frames_captured = 0
+        self.dropped_frames = 0
+        # total seconds spent capturing, for measuring the overhead of recording
+        self.capture_time = 0.
+        self.set_camera(camera_target, camera_distance, yaw, pitch)
+
+        self._writer = writer
+        self._queue = queue.Queue(maxsize=max_queued_frames)
+        self._encoder = threading.Thread(target=self._encode, daemon=True)
+        self._encoder.start()
+
+    def set_camera(self, camera_target, camera_distance, yaw, pitch):
+        # the matrices only change with the camera, so compute them here instead of for every frame
+        self._view_matrix = p.computeViewMatrixFromYawPitchRoll(camera_target, camera_distance, yaw, pitch, 0, 2,
+                                                                physicsClientId=self.physics_client)
+        self._projection_matrix = p.computeProjectionMatrixFOV(self.fov, self.width / self.height, 0.01, 100,
+                                                               physicsClientId=self.physics_client)
+
+    def capture(self):
+        start = time.perf_counter()
+        rgba = p.getCameraImage(self.width, self.height, self._view_matrix, self._projection_matrix,
+                                renderer=self.renderer, flags=p.ER_NO_SEGMENTATION_MASK,
+                                physicsClientId=self.physics_client)[2]
+        frame = np.asarray(rgba, dtype=np.uint8).reshape(self.height, self.width, 4)[:, :, :3]
+        try:
+            self._queue.put_nowait(frame)
+            self.frames_captured += 1
+        except queue.Full:
+            self.dropped_frames += 1
+        self.capture_time += time.perf_counter() - start
+
+    def _encode(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            self._writer.append_data(frame)
+        self._writer.close()
+
+    def close(self):
+        """Finish encoding the captured frames and close the video"""
+        if self._encoder.is_alive():
+            self._queue.put(None)
+            self._encoder.join()
+        if self._egl_plugin is not None:
+            p.unloadPlugin(self._egl_plugin, physicsClientId=self.physics_client)
+            self._egl_plugin = None
 
 
 class ContactInfo(enum.IntEnum):
     """Semantics for indices of a contact info from getContactPoints"""
+    CONTACT_FLAG = 0
+    BODY_A = 1
+    BODY_B = 2
     LINK_A = 3
     LINK_B = 4
     POS_A = 5
@@ -278,6 +700,27 @@ class ContactInfo(enum.IntEnum):
     LATERAL2_DIR = 13
 
 
+def flip_contact(contact):
+    """The contact as getContactPoints reports it with bodies A and B swapped"""
+    return (contact[ContactInfo.CONTACT_FLAG], contact[ContactInfo.BODY_B], contact[ContactInfo.BODY_A],
+            contact[ContactInfo.LINK_B], contact[ContactInfo.LINK_A], contact[ContactInfo.POS_B],
+            contact[ContactInfo.POS_A], tuple(-n for n in contact[ContactInfo.NORMAL_DIR_B])) + \
+        tuple(contact[ContactInfo.DISTANCE:])
+
+
+def get_contacts_by_body(body_id, link_index=None, flip=False, physics_client=0):
+    """Contact points of a body (or one of its links) with every other body, from a single query
+
+    :param flip: report each contact with the other body as A, as if it were queried from the other body
+    :return: dict of other body ID to its contact points, in the order querying that pair of bodies would give
+    """
+    kwargs = {} if link_index is None else {'linkIndexA': link_index}
+    contacts = {}
+    for c in p.getContactPoints(body_id, physicsClientId=physics_client, **kwargs):
+        contacts.setdefault(c[ContactInfo.BODY_B], []).append(flip_contact(c) if flip else c)
+    return contacts
+
+
 def get_total_contact_force(contact, flip=True):
     force_sign = -1 if flip else 1
     force = force_sign * contact[ContactInfo.NORMAL_MAG]
@@ -296,9 +739,63 @@ def get_lateral_friction_forces(contact, flip=True):
     return fyd, fxd
 
 
+_CONTACT_VECTOR_FIELDS = {ContactInfo.POS_A, ContactInfo.POS_B, ContactInfo.NORMAL_DIR_B, ContactInfo.LATERAL1_DIR,
+                          ContactInfo.LATERAL2_DIR}
+# structured array fields for contacts, with the same names and order as ContactInfo
+CONTACT_DTYPE = np.dtype([(c.name, np.float64, (3,)) if c in _CONTACT_VECTOR_FIELDS else
+                          (c.name, np.int64 if c <= ContactInfo.LINK_B else np.float64) for c in ContactInfo])
+
+
+def contacts_to_array(contacts):
+    """Convert the result of getContactPoints or getClosestPoints into a structured array with CONTACT_DTYPE"""
+    if isinstance(contacts, np.ndarray):
+        return contacts
+    # the outer sequence has to be a list since numpy reads tuples as single records
+    return np.array(list(contacts), dtype=CONTACT_DTYPE)
+
+
+def get_lateral_friction_forces_array(contacts, flip=True):
+    """Vectorized get_lateral_friction_forces over all contacts, each as (N, 3)"""
+    contacts = contacts_to_array(contacts)
+    force_sign = -1 if flip else 1
+    fyd = force_sign * contacts['LATERAL1_MAG'][:, None] * contacts['LATERAL1_DIR']
+    fxd = force_sign * contacts['LATERAL2_MAG'][:, None] * contacts['LATERAL2_DIR']
+    return fyd, fxd
+
+
+def get_total_contact_forces(contacts, flip=True):
+    """Vectorized get_total_contact_force over all contacts as (N, 3)"""
+    contacts = contacts_to_array(contacts)
+    force_sign = -1 if flip else 1
+    fyd, fxd = get_lateral_friction_forces_array(contacts, flip)
+    return force_sign * contacts['NORMAL_MAG'][:, None] * contacts['NORMAL_DIR_B'] + fyd + fxd
+
+
+def get_contact_wrench(contacts, origin, flip=True):
+    """Sum of the forces of all contacts and of their torques about origin, using the contact points on A"""
+    contacts = contacts_to_array(contacts)
+    if len(contacts) == 0:
+        return np.zeros(3), np.zeros(3)
+    forces = get_total_contact_forces(contacts, flip)
+    torques = np.cross(contacts['POS_A'] - np.asarray(origin), forces)
+    return forces.sum(axis=0), torques.sum(axis=0)
+
+
 class DebugDrawer(Visualizer):
-    def __init__(self, default_height, camera_height):
+    def __init__(self, default_height, camera_height, physics_client=0, max_transitions=1000):
+        self.physics_client = physics_client
         self._debug_ids = {}
+        # names ending in .index grouped by prefix then index, for clearing everything after an index
+        self._indexed_names = {}
+        # point sets drawn as a single debug item, kept apart since they can only be replaced by other points
+        self._debug_point_ids = {}
+        # text items can't be reused as lines, so keep track of them
+        self._debug_text_ids = set()
+        # lines that have been hidden and can be replaced instead of adding new ones
+        self._hidden_line_ids = []
+        # transitions are drawn into a ring buffer, replacing the oldest once full
+        self._max_transitions = max_transitions
+        self._oldest_transition = 0
         self._mesh_to_single_id = {}
         self._drawn_mesh_ids = set()
         self._camera_pos = None
@@ -308,6 +805,9 @@ class DebugDrawer(Visualizer):
         self._inv_camera_tsf = None
         self._mesh_shape_ids = {}
         self._hide_text = False
+        # without a GUI there is no camera to set
+        self._gui = p.getConnectionInfo(physicsClientId=self.physics_client)['connectionMethod'] in (p.GUI,
+                                                                                                     p.GUI_SERVER)
         self.set_camera_position([0, 0])
 
     def set_hide_text(self, hide_text):
@@ -315,23 +815,25 @@ class DebugDrawer(Visualizer):
 
     def set_camera_position(self, camera_pos, yaw=0, pitch=-89):
         self._camera_pos = camera_pos
-        for _ in range(1000):
-            p.stepSimulation()
+        # the camera takes a while to update, so only get its inverse transform when it's needed
+        self._inv_camera_tsf = None
+        if not self._gui:
+            return
         z = 0
         if len(self._camera_pos) > 2:
             z = self._camera_pos[2]
         p.resetDebugVisualizerCamera(cameraDistance=self._camera_height, cameraYaw=yaw, cameraPitch=pitch,
-                                     cameraTargetPosition=[camera_pos[0], camera_pos[1], z])
-        # wait for reset
-        for _ in range(1000):
-            p.stepSimulation()
-        # cache the inverse camera transform for efficiency
-        info = p.getDebugVisualizerCamera()
-        if info[0] == 0 and info[1] == 0:
-            logger.debug("Setting empty camera; check that we are not in GUI mode")
-        else:
-            view_matrix = np.array(info[2]).reshape(4, 4).T
-            self._inv_camera_tsf = np.linalg.inv(view_matrix)
+                                     cameraTargetPosition=[camera_pos[0], camera_pos[1], z],
+                                     physicsClientId=self.physics_client)
+
+    def _get_inv_camera_tsf(self):
+        if self._inv_camera_tsf is None and self._gui:
+            info = p.getDebugVisualizerCamera(physicsClientId=self.physics_client)
+            if info[0] != 0 or info[1] != 0:
+                # cache the inverse camera transform for efficiency
+                view_matrix = np.array(info[2]).reshape(4, 4).T
+                self._inv_camera_tsf = np.linalg.inv(view_matrix)
+        return self._inv_camera_tsf
 
     def toggle_3d(self, using_3d):
         self._3dmode = using_3d
@@ -344,10 +846,47 @@ class DebugDrawer(Visualizer):
                 height = self._default_height
         return height
 
+    def _add_name(self, name, uids):
+        self._debug_ids[name] = uids
+        prefix, _, index = name.rpartition('.')
+        if index.isdigit():
+            self._indexed_names.setdefault(prefix, {})[int(index)] = name
+        return uids
+
+    def _pop_name(self, name):
+        uids = self._debug_ids.pop(name)
+        prefix, _, index = name.rpartition('.')
+        if index.isdigit():
+            self._indexed_names[prefix].pop(int(index), None)
+        return uids
+
+    def _line_id(self, uid):
+        """ID to replace when drawing a line, reusing a hidden line for new ones"""
+        if uid < 0 and len(self._hidden_line_ids):
+            return self._hidden_line_ids.pop()
+        return uid
+
+    def _text_id(self, uid):
+        if uid >= 0:
+            self._debug_text_ids.add(uid)
+        return uid
+
+    def _hide(self, uids):
+        if type(uids) is int:
+            uids = [uids]
+        for uid in uids:
+            if uid < 0:
+                continue
+            remove_user_debug_item(uid, physics_client=self.physics_client)
+            if uid in self._debug_text_ids:
+                self._debug_text_ids.remove(uid)
+            else:
+                self._hidden_line_ids.append(uid)
+
     def draw_point(self, name, point, color=(0, 0, 0), length=0.01, length_ratio=1, rot=0, height=None, label=None,
                    scale=2):
         if name not in self._debug_ids:
-            self._debug_ids[name] = [-1, -1, -1]
+            self._add_name(name, [-1, -1, -1])
         uids = self._debug_ids[name]
         l = length
 
@@ -361,23 +900,51 @@ class DebugDrawer(Visualizer):
         s = math.sin(rot)
         uids[0] = p.addUserDebugLine(np.add(location, [l * c, l * s, 0]),
                                      np.add(location, [-l * c, - l * s, 0]), color, scale,
-                                     replaceItemUniqueId=uids[0])
+                                     replaceItemUniqueId=self._line_id(uids[0]), physicsClientId=self.physics_client)
         uids[1] = p.addUserDebugLine(np.add(location, [- l * s * length_ratio, l * length_ratio * c, 0]),
                                      np.add(location, [l * s * length_ratio, -l * length_ratio * c, 0]), color,
                                      scale,
-                                     replaceItemUniqueId=uids[1])
+                                     replaceItemUniqueId=self._line_id(uids[1]), physicsClientId=self.physics_client)
         if label is not None:
-            uids[2] = p.addUserDebugText(label,
-                                         [location[0], location[1], location[2]],
-                                         textColorRGB=color,
-                                         textSize=2,
-                                         replaceItemUniqueId=uids[2])
+            uids[2] = self._text_id(p.addUserDebugText(label,
+                                                       [location[0], location[1], location[2]],
+                                                       textColorRGB=color,
+                                                       textSize=2,
+                                                       replaceItemUniqueId=uids[2],
+                                                       physicsClientId=self.physics_client))
         return uids
 
+    def draw_points(self, name, points, color=(0, 0, 0), length=0.01, height=None, label=None, scale=2, **kwargs):
+        """Draw all points as a single debug item, replacing what was last drawn under name"""
+        if label is not None:
+            return super().draw_points(name, points, color, length=length, height=height, label=label, scale=scale,
+                                       **kwargs)
+        # points previously drawn one at a time under this name
+        self.clear_visualization_after(name, 0)
+        if len(points) == 0:
+            self.clear_visualizations([name])
+            return -1
+        points = _debug_rows(points)
+        positions = np.zeros((len(points), 3))
+        positions[:, :2] = points[:, :2]
+        if height is not None:
+            positions[:, 2] = height
+        elif self._3dmode:
+            positions[:, 2] = points[:, 2]
+        else:
+            positions[:, 2] = self._default_height
+
+        uid = self._debug_point_ids.get(name, -1)
+        self._debug_point_ids[name] = p.addUserDebugPoints(positions.tolist(),
+                                                           _debug_colors(color, len(points)).tolist(),
+                                                           pointSize=scale * 2, replaceItemUniqueId=uid,
+                                                           physicsClientId=self.physics_client)
+        return self._debug_point_ids[name]
+
     def draw_2d_pose(self, name, pose, color=(0, 0, 0), length=0.15 / 2, height=None):
         height = self._process_point_height(pose, height)
         if name not in self._debug_ids:
-            self._debug_ids[name] = [-1, -1]
+            self._add_name(name, [-1, -1])
         uids = self._debug_ids[name]
 
         location = (pose[0], pose[1], height)
@@ -385,45 +952,47 @@ class DebugDrawer(Visualizer):
         pointer = math_utils.rotate_wrt_origin((length, 0), pose[2])
         uids[0] = p.addUserDebugLine(np.add(location, [side_lines[0], side_lines[1], 0]),
                                      np.add(location, [-side_lines[0], -side_lines[1], 0]),
-                                     color, 2, replaceItemUniqueId=uids[0])
+                                     color, 2, replaceItemUniqueId=self._line_id(uids[0]),
+                                     physicsClientId=self.physics_client)
         uids[1] = p.addUserDebugLine(np.add(location, [0, 0, 0]),
                                      np.add(location, [pointer[0], pointer[1], 0]),
-                                     color, 2, replaceItemUniqueId=uids[1])
+                                     color, 2, replaceItemUniqueId=self._line_id(uids[1]),
+                                     physicsClientId=self.physics_client)
         return uids
 
     def clear_visualizations(self, names=None):
         if names is None:
-            p.removeAllUserDebugItems()
+            p.removeAllUserDebugItems(physicsClientId=self.physics_client)
             self._debug_ids = {}
+            self._indexed_names = {}
+            self._debug_point_ids = {}
+            self._debug_text_ids = set()
+            self._hidden_line_ids = []
+            self._oldest_transition = 0
             for mesh in self._drawn_mesh_ids:
-                p.removeBody(mesh)
+                p.removeBody(mesh, physicsClientId=self.physics_client)
             self._drawn_mesh_ids = set()
             self._mesh_to_single_id = {}
             return
 
         for name in names:
+            if name in self._debug_point_ids:
+                remove_user_debug_points(self._debug_point_ids.pop(name), physics_client=self.physics_client)
             if name not in self._debug_ids:
                 continue
-            uids = self._debug_ids.pop(name)
-            if type(uids) is int:
-                uids = [uids]
-            for id in uids:
-                remove_user_debug_item(id)
+            self._hide(self._pop_name(name))
 
     def clear_visualization_after(self, prefix, index):
-        name = "{}.{}".format(prefix, index)
-        while name in self._debug_ids:
-            uids = self._debug_ids.pop(name)
-            if type(uids) is int:
-                uids = [uids]
-            for id in uids:
-                remove_user_debug_item(id)
+        indexed_names = self._indexed_names.get(prefix)
+        if indexed_names is None:
+            return
+        while index in indexed_names:
+            self._hide(self._debug_ids.pop(indexed_names.pop(index)))
             index += 1
-            name = "{}.{}".format(prefix, index)
 
     def draw_2d_line(self, name, start, diff, color=(0, 0, 0), size=2., scale=0.4):
         if name not in self._debug_ids:
-            self._debug_ids[name] = -1
+            self._add_name(name, -1)
         uid = self._debug_ids[name]
         if torch.is_tensor(start):
             start = start.detach().cpu()
@@ -432,7 +1001,35 @@ class DebugDrawer(Visualizer):
 
         self._debug_ids[name] = p.addUserDebugLine(start, np.add(start, [diff[0] * scale, diff[1] * scale,
                                                                          diff[2] * scale if len(diff) == 3 else 0]),
-                                                   color, lineWidth=size, replaceItemUniqueId=uid)
+                                                   color, lineWidth=size, replaceItemUniqueId=self._line_id(uid),
+                                                   physicsClientId=self.physics_client)
+        return self._debug_ids[name]
+
+    def draw_2d_lines(self, name, starts, diffs, color=(0, 0, 0), size=2., scale=0.4):
+        """Draw all lines under a single name, reusing the debug items from when it was last drawn"""
+        # lines previously drawn one at a time under this name
+        self.clear_visualization_after(name, 0)
+        if name not in self._debug_ids:
+            self._add_name(name, [])
+        uids = self._debug_ids[name]
+        if type(uids) is int:
+            uids = [uids]
+        n = len(starts)
+        if n > 0:
+            starts = _debug_rows(starts)
+            diffs = _debug_rows(diffs)
+            ends = starts.copy()
+            # same as draw_2d_line, only use the z component of 3D differences
+            d = 3 if diffs.shape[1] == 3 else 2
+            ends[:, :d] += diffs[:, :d] * scale
+            colors = _debug_colors(color, n)
+            uids = list(uids) + [-1] * (n - len(uids))
+            for i in range(n):
+                uids[i] = p.addUserDebugLine(starts[i], ends[i], colors[i], lineWidth=size,
+                                             replaceItemUniqueId=self._line_id(uids[i]),
+                                             physicsClientId=self.physics_client)
+        self._hide(uids[n:])
+        self._debug_ids[name] = uids[:n]
         return self._debug_ids[name]
 
     def draw_contact_point(self, name, contact, flip=True):
@@ -459,24 +1056,31 @@ class DebugDrawer(Visualizer):
         name = 't'
         if name not in self._debug_ids:
             self._debug_ids[name] = []
+        uids = self._debug_ids[name]
+        if len(uids) < self._max_transitions:
+            uids.append(-1)
+            i = len(uids) - 1
+        else:
+            i = self._oldest_transition % len(uids)
+            self._oldest_transition = (i + 1) % len(uids)
 
-        self._debug_ids[name].append(
-            p.addUserDebugLine([prev_block[0], prev_block[1], self._process_point_height(prev_block, height)],
-                               (new_block[0], new_block[1], self._process_point_height(new_block, height)),
-                               [0, 0, 1], 2))
+        uids[i] = p.addUserDebugLine([prev_block[0], prev_block[1], self._process_point_height(prev_block, height)],
+                                     (new_block[0], new_block[1], self._process_point_height(new_block, height)),
+                                     [0, 0, 1], 2, replaceItemUniqueId=self._line_id(uids[i]),
+                                     physicsClientId=self.physics_client)
 
     def clear_transitions(self):
         name = 't'
         if name in self._debug_ids:
-            for line in self._debug_ids[name]:
-                remove_user_debug_item(line)
+            self._hide(self._debug_ids[name])
             self._debug_ids[name] = []
+        self._oldest_transition = 0
 
     def draw_text(self, name, text, location_index, left_offset=1., offset_in_z=False):
         if self._hide_text:
             return
         if name not in self._debug_ids:
-            self._debug_ids[name] = -1
+            self._add_name(name, -1)
         uid = self._debug_ids[name]
 
         z = 0.1
@@ -486,33 +1090,37 @@ class DebugDrawer(Visualizer):
             z += location_index * 0.1
 
         height_scale = self._camera_height * 0.7
-        self._debug_ids[name] = p.addUserDebugText(str(text),
-                                                   [self._camera_pos[0] + left_offset * height_scale,
-                                                    self._camera_pos[1] + (1 - move_down) * height_scale, z],
-                                                   textColorRGB=[0.5, 0.1, 0.1],
-                                                   textSize=2,
-                                                   replaceItemUniqueId=uid)
+        self._debug_ids[name] = self._text_id(p.addUserDebugText(str(text),
+                                                                 [self._camera_pos[0] + left_offset * height_scale,
+                                                                  self._camera_pos[1] + (1 - move_down) * height_scale,
+                                                                  z],
+                                                                 textColorRGB=[0.5, 0.1, 0.1],
+                                                                 textSize=2,
+                                                                 replaceItemUniqueId=uid,
+                                                                 physicsClientId=self.physics_client))
         return self._debug_ids[name]
 
     def draw_screen_text(self, name, text, camera_frame_pos):
         if self._hide_text:
             return
         # not in camera mode, ignore
-        if self._inv_camera_tsf is None:
+        inv_camera_tsf = self._get_inv_camera_tsf()
+        if inv_camera_tsf is None:
             return
         if name not in self._debug_ids:
-            self._debug_ids[name] = -1
+            self._add_name(name, -1)
         uid = self._debug_ids[name]
 
         # convert from camera frame to world frame
         pos_in = np.r_[camera_frame_pos, 1]
-        world_frame_pos = self._inv_camera_tsf @ pos_in
-
-        self._debug_ids[name] = p.addUserDebugText(str(text),
-                                                   world_frame_pos[:3],
-                                                   textColorRGB=[0.5, 0.1, 0.1],
-                                                   textSize=2,
-                                                   replaceItemUniqueId=uid)
+        world_frame_pos = inv_camera_tsf @ pos_in
+
+        self._debug_ids[name] = self._text_id(p.addUserDebugText(str(text),
+                                                                 world_frame_pos[:3],
+                                                                 textColorRGB=[0.5, 0.1, 0.1],
+                                                                 textSize=2,
+                                                                 replaceItemUniqueId=uid,
+                                                                 physicsClientId=self.physics_client))
         return self._debug_ids[name]
 
     def draw_mesh(self, name, model, pose, rgba=(0, 0, 0, 1.), scale=1., object_id=None, vis_frame_pos=(0, 0, 0),
@@ -524,7 +1132,8 @@ class DebugDrawer(Visualizer):
                                                   fileName=model,
                                                   rgbaColor=rgba, meshScale=[scale, scale, scale],
                                                   visualFrameOrientation=vis_frame_rot,
-                                                  visualFramePosition=vis_frame_pos)
+                                                  visualFramePosition=vis_frame_pos,
+                                                  physicsClientId=self.physics_client)
             self._mesh_shape_ids[visual_shape_name] = visual_shape_id
         pos, rot = pose
 
@@ -532,20 +1141,175 @@ class DebugDrawer(Visualizer):
             object_id = self._mesh_to_single_id.get(name, None)
 
         if object_id is None or object_id not in self._drawn_mesh_ids:
-            object_id = p.createMultiBody(baseMass=0, basePosition=pos, baseVisualShapeIndex=visual_shape_id)
-        p.resetBasePositionAndOrientation(object_id, pos, rot)
-        p.changeVisualShape(object_id, -1, rgbaColor=rgba)
+            object_id = p.createMultiBody(baseMass=0, basePosition=pos, baseVisualShapeIndex=visual_shape_id,
+                                          physicsClientId=self.physics_client)
+        p.resetBasePositionAndOrientation(object_id, pos, rot, physicsClientId=self.physics_client)
+        p.changeVisualShape(object_id, -1, rgbaColor=rgba, physicsClientId=self.physics_client)
         self._drawn_mesh_ids.add(object_id)
         self._mesh_to_single_id[name] = object_id
 
         return object_id
 
 
-def pybullet_obj_range(obj_id, padding=0):
-    aabb = p.getAABB(obj_id)
+def pybullet_obj_range(obj_id, padding=0, physics_client=0):
+    aabb = p.getAABB(obj_id, physicsClientId=physics_client)
     world_min, world_max = aabb
     # already scaled, but we add a little padding
     ranges = np.array(list(zip(world_min, world_max)))
     ranges[:, 0] -= padding
     ranges[:, 1] += padding
     return ranges
+
+
+class AABBCache:
+    """Axis-aligned bounding boxes of the base link of bodies in a scene, in the same (3, 2) range format as
+    pybullet_obj_range.
+
+    Boxes of static bodies are computed once, while those of other bodies are recomputed only when their base pose
+    changes. Static bodies should be invalidated if they are removed since their ID could be reused.
+    """
+
+    def __init__(self, static_ids=(), physics_client=0):
+        self.physics_client = physics_client
+        self._static_ids = set(static_ids)
+        # body ID -> (base pose when computed, or None if static; ranges)
+        self._ranges = {}
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def add_static(self, *body_ids):
+        for body_id in body_ids:
+            self._static_ids.add(body_id)
+            self._ranges.pop(body_id, None)
+
+    def invalidate(self, body_id=None):
+        """Forget the box of this body, or of all bodies, including whether they are static"""
+        if body_id is None:
+            self._static_ids = set()
+            self._ranges = {}
+        else:
+            self._static_ids.discard(body_id)
+            self._ranges.pop(body_id, None)
+
+    def obj_range(self, obj_id, padding=0):
+        if obj_id in self._static_ids:
+            pose = None
+            cached = self._ranges.get(obj_id)
+        else:
+            pos, orn = p.getBasePositionAndOrientation(obj_id, physicsClientId=self.physics_client)
+            pose = pos + orn
+            cached = self._ranges.get(obj_id)
+            if cached is not None and cached[0] != pose:
+                cached = None
+        if cached is None:
+            cached = self._ranges[obj_id] = (pose, pybullet_obj_range(obj_id, physics_client=self.physics_client))
+        ranges = cached[1].copy()
+        ranges[:, 0] -= padding
+        ranges[:, 1] += padding
+        return ranges
+
+    def obj_ranges(self, obj_ids, padding=0):
+        """Batched obj_range with shape (N, 3, 2)"""
+        if len(obj_ids) == 0:
+            return np.zeros((0, 3, 2))
+        return np.stack([self.obj_range(obj_id, padding=padding) for obj_id in obj_ids])
+
+    def overlapping(self, ranges, obj_ids=None):
+        """IDs of the bodies whose boxes overlap the (3, 2) ranges box, out of the given ones or else all cached ones"""
+        if obj_ids is None:
+            obj_ids = list(self._ranges)
+        obj_ids = np.asarray(obj_ids, dtype=int)
+        obj_ranges = self.obj_ranges(obj_ids)
+        ranges = np.asarray(ranges)
+        overlap = np.all((obj_ranges[:, :, 0] <= ranges[:, 1]) & (obj_ranges[:, :, 1] >= ranges[:, 0]), axis=1)
+        return obj_ids[overlap]
+
+
+class IKSolver:
+    """Warm started and cached inverse kinematics for a link of a fixed base body.
+
+    Each solve starts from a given seed joint configuration (the body's current one by default) rather than whatever
+    state the body is in, so solutions are repeatable. They are cached by the target, orientation and seed quantized to
+    the given resolution, so repeated queries such as the initial configuration on every reset are free.
+    """
+
+    def __init__(self, body_id, link_index, resolution=1e-6, max_size=10000, physics_client=0):
+        """
+        :param resolution: grid size the target, orientation, and seed are quantized to for the cache key
+        :param max_size: maximum number of cached solutions, with the least recently used evicted first
+        """
+        self.body_id = body_id
+        self.link_index = link_index
+        self.resolution = resolution
+        self.max_size = max_size
+        self.physics_client = physics_client
+        # calculateInverseKinematics takes and gives positions of only the non-fixed joints
+        self.dof_joints = [j for j in range(p.getNumJoints(body_id, physicsClientId=physics_client))
+                           if p.getJointInfo(body_id, j, physicsClientId=physics_client)[2] != p.JOINT_FIXED]
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        self._cache.clear()
+
+    def current_joints(self):
+        return tuple(state[0] for state in
+                     p.getJointStates(self.body_id, self.dof_joints, physicsClientId=self.physics_client))
+
+    def solve(self, position, orientation=None, seed=None, iterations=1):
+        """Positions of the non-fixed joints putting the link at the position (and orientation)
+
+        :param seed: joint positions to start from; defaults to the body's current ones
+        :param iterations: number of times to solve, each starting from the last solution to get out of local minima
+        :return: tuple of joint positions, as calculateInverseKinematics gives them
+        """
+        at_seed = seed is None
+        if at_seed:
+            seed = self.current_joints()
+        values = tuple(position) + (tuple(orientation) if orientation is not None else ()) + tuple(seed)
+        key = (tuple(int(round(v / self.resolution)) for v in values), orientation is None, iterations)
+        joints = self._cache.get(key)
+        if joints is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return joints
+        self.misses += 1
+
+        # IK starts from the body's joint state (currentPositions only changes the Jacobian, not the link pose it
+        # starts from), so put the body at the seed and restore its state after
+        state = None
+        if not at_seed or iterations > 1:
+            state = p.getJointStates(self.body_id, self.dof_joints, physicsClientId=self.physics_client)
+        if not at_seed:
+            self._reset_joints(seed)
+        kwargs = {} if orientation is None else {'targetOrientation': orientation}
+        for i in range(iterations):
+            if i:
+                self._reset_joints(joints)
+            joints = p.calculateInverseKinematics(self.body_id, self.link_index, position,
+                                                  physicsClientId=self.physics_client, **kwargs)
+        if state is not None:
+            self._reset_joints([s[0] for s in state], [s[1] for s in state])
+
+        self._cache[key] = joints
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return joints
+
+    def _reset_joints(self, positions, velocities=None):
+        for i, j in enumerate(self.dof_joints):
+            p.resetJointState(self.body_id, j, positions[i], targetVelocity=0 if velocities is None else velocities[i],
+                              physicsClientId=self.physics_client)
+
+    def solve_waypoints(self, positions, orientation=None, seed=None):
+        """Joint positions for each of a sequence of positions, each solve starting from the previous solution"""
+        solutions = []
+        for position in positions:
+            seed = self.solve(position, orientation, seed=seed)
+            solutions.append(seed)
+        return solutions
@@ -1,25 +1,31 @@
 import logging
+import os
 import time
+import xml.etree.ElementTree as ET
 
 import pytorch_kinematics.transforms.rotation_conversions
 
 import numpy as np
+import open3d as o3d
 import torch
 import pybullet as p
 
-from pytorch_volumetric.sdf import ObjectFactory, ObjectFrameSDF
-from base_experiments.env.pybullet_env import closest_point_on_surface, ContactInfo
+from pytorch_volumetric.sdf import ObjectFactory, ObjectFrameSDF, MeshObjectFactory
+from base_experiments.env.pybullet_env import closest_points_on_surface, AABBCache
 
 logger = logging.getLogger(__name__)
 
 
 class PyBulletNaiveSDF(ObjectFrameSDF):
-    def __init__(self, test_obj_id, vis=None):
+    def __init__(self, test_obj_id, vis=None, physics_client=0, aabb_cache=None):
         self.test_obj_id = test_obj_id
         self.vis = vis
+        self.physics_client = physics_client
+        # can share the scene's cache; otherwise the box is only recomputed when the object moves
+        self.aabb_cache = aabb_cache if aabb_cache is not None else AABBCache(physics_client=physics_client)
 
     def surface_bounding_box(self, padding=0., padding_ratio=0.):
-        bb = torch.tensor(p.getAABB(self.test_obj_id)).transpose(0, 1)
+        bb = torch.tensor(self.aabb_cache.obj_range(self.test_obj_id), dtype=torch.get_default_dtype())
         extents = bb[:, 1] - bb[:, 0]
         bb[:, 0] -= padding + padding_ratio * extents
         bb[:, 1] += padding + padding_ratio * extents
@@ -33,25 +39,168 @@ class PyBulletNaiveSDF(ObjectFrameSDF):
         device = points_in_object_frame.device
         # compute SDF value for new sampled points
         sdf = torch.zeros(B, N, dtype=dtype, device=device)
-        sdf_grad = [[None] * N for _ in range(B)]
+        sdf_grad = torch.zeros(B, N, d, dtype=dtype, device=device)
         # points are transformed to link frame, thus it needs to compare against the object in link frame
         # objId is not in link frame and shouldn't be moved
         for b in range(B):
-            for i in range(N):
-                closest = closest_point_on_surface(self.test_obj_id, points_in_object_frame[b, i])
-                sdf[b, i] = closest[ContactInfo.DISTANCE]
-                sdf_grad[b][i] = closest[ContactInfo.NORMAL_DIR_B]
+            # gradient from low to high value (pointing out of surface)
+            sdf[b], closest, sdf_grad[b] = closest_points_on_surface(self.test_obj_id, points_in_object_frame[b],
+                                                                     physics_client=self.physics_client)
 
-                if self.vis is not None:
+            if self.vis is not None:
+                for i in range(N):
                     self.vis.draw_point("test_point", points_in_object_frame[b, i], color=(1, 0, 0), length=0.005)
-                    self.vis.draw_2d_line(f"test_normal", points_in_object_frame[b, i],
-                                          [-v for v in closest[ContactInfo.NORMAL_DIR_B]], color=(0, 0, 0),
-                                          size=2., scale=0.03)
-                    self.vis.draw_point("test_point_surf", closest[ContactInfo.POS_A], color=(0, 1, 0),
-                                        length=0.005,
-                                        label=f'{closest[ContactInfo.DISTANCE]:.5f}')
-        # want the gradient from low to high value (pointing out of surface), so need negative
-        sdf_grad = -torch.tensor(sdf_grad, dtype=dtype, device=device)
+                    self.vis.draw_2d_line(f"test_normal", points_in_object_frame[b, i], sdf_grad[b, i],
+                                          color=(0, 0, 0), size=2., scale=0.03)
+                    self.vis.draw_point("test_point_surf", closest[i], color=(0, 1, 0), length=0.005,
+                                        label=f'{sdf[b, i].item():.5f}')
+        return sdf, sdf_grad
+
+
+def _origin_to_matrix(elem):
+    """4x4 transform from the origin element under elem, if it has one"""
+    tf = np.eye(4)
+    origin = elem.find('origin')
+    if origin is not None:
+        rpy = [float(v) for v in origin.get('rpy', '0 0 0').split()]
+        tf[:3, :3] = np.array(p.getMatrixFromQuaternion(p.getQuaternionFromEuler(rpy))).reshape(3, 3)
+        tf[:3, 3] = [float(v) for v in origin.get('xyz', '0 0 0').split()]
+    return tf
+
+
+def _resolve_mesh_filename(filename, urdf_dir):
+    # like pybullet, look for package:// paths relative to the URDF and its parent directories
+    filename = filename.replace("package://", "")
+    search_dir = urdf_dir
+    while True:
+        full_path = os.path.join(search_dir, filename)
+        if os.path.exists(full_path):
+            return full_path
+        parent_dir = os.path.dirname(search_dir)
+        if parent_dir == search_dir:
+            raise RuntimeError(f"Expected mesh file does not exist: {filename} (relative to {urdf_dir})")
+        search_dir = parent_dir
+
+
+def _read_obj_parts(filename):
+    """Vertices and triangles of each object (o) in a wavefront obj file, such as the hulls of a V-HACD
+    decomposition"""
+    vertices = []
+    parts = [[]]
+    with open(filename) as f:
+        for line in f:
+            tokens = line.split()
+            if len(tokens) == 0:
+                continue
+            if tokens[0] == 'v':
+                vertices.append([float(v) for v in tokens[1:4]])
+            elif tokens[0] == 'o' and len(parts[-1]):
+                parts.append([])
+            elif tokens[0] == 'f':
+                # v/vt/vn indices are 1-indexed, or negative to count from the end; triangulate as a fan
+                face = [int(v.split('/')[0]) for v in tokens[1:]]
+                face = [v - 1 if v > 0 else len(vertices) + v for v in face]
+                for i in range(1, len(face) - 1):
+                    parts[-1].append([face[0], face[i], face[i + 1]])
+    vertices = np.array(vertices)
+    obj_parts = []
+    for faces in parts:
+        if len(faces):
+            # only keep the vertices used by this object
+            used, faces = np.unique(np.array(faces), return_inverse=True)
+            obj_parts.append((vertices[used], faces.reshape(-1, 3)))
+    return obj_parts
+
+
+def _collision_geometry_meshes(geometry, urdf_dir, global_scaling):
+    """Open3d meshes in the geometry frame for each convex part of a URDF collision geometry"""
+    shape = geometry[0]
+    if shape.tag == 'box':
+        size = np.array([float(v) for v in shape.get('size').split()]) * global_scaling
+        mesh = o3d.geometry.TriangleMesh.create_box(*size)
+        return [mesh.translate(-size / 2)]
+    if shape.tag == 'sphere':
+        return [o3d.geometry.TriangleMesh.create_sphere(float(shape.get('radius')) * global_scaling, resolution=40)]
+    if shape.tag == 'cylinder':
+        return [o3d.geometry.TriangleMesh.create_cylinder(float(shape.get('radius')) * global_scaling,
+                                                          float(shape.get('length')) * global_scaling,
+                                                          resolution=80)]
+    if shape.tag == 'mesh':
+        scale = np.array([float(v) for v in shape.get('scale', '1 1 1').split()]) * global_scaling
+        meshes = []
+        # pybullet uses the convex hull of each object in the file for collision
+        for vertices, faces in _read_obj_parts(_resolve_mesh_filename(shape.get('filename'), urdf_dir)):
+            mesh = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(vertices * scale),
+                                             o3d.utility.Vector3iVector(faces))
+            hull, _ = mesh.compute_convex_hull()
+            meshes.append(hull)
+        return meshes
+    raise ValueError(f"Unsupported collision geometry {shape.tag}")
+
+
+class URDFMeshSDF(ObjectFrameSDF):
+    """SDF of the collision geometry of a URDF computed directly from its meshes and primitives, without needing a
+    physics client. The object frame is the base link frame, and links are placed at their zero joint configuration.
+
+    Each mesh object is replaced by its convex hull like pybullet does, and the SDF is the union over all parts.
+    For repeated queries over a region, wrap it in a pytorch_volumetric CachedSDF to precompute it on a grid.
+    """
+
+    def __init__(self, urdf_file, global_scaling=1., vis=None):
+        self.urdf_file = urdf_file
+        self.vis = vis
+        urdf_dir = os.path.dirname(os.path.abspath(urdf_file))
+        robot = ET.parse(urdf_file).getroot()
+
+        # link frames relative to the base link from the joint origins
+        parent_of = {joint.find('child').get('link'): (joint.find('parent').get('link'), _origin_to_matrix(joint))
+                     for joint in robot.findall('joint')}
+        link_tf = {}
+
+        def get_link_tf(link_name):
+            if link_name not in link_tf:
+                if link_name in parent_of:
+                    parent, joint_tf = parent_of[link_name]
+                    tf = get_link_tf(parent) @ joint_tf
+                else:
+                    tf = np.eye(4)
+                link_tf[link_name] = tf
+            return link_tf[link_name]
+
+        self.obj_factories = []
+        for link in robot.findall('link'):
+            for collision in link.findall('collision'):
+                tf = get_link_tf(link.get('name')) @ _origin_to_matrix(collision)
+                # global scaling applies to all the origin offsets as well
+                tf[:3, 3] *= global_scaling
+                for mesh in _collision_geometry_meshes(collision.find('geometry'), urdf_dir, global_scaling):
+                    mesh.transform(tf)
+                    self.obj_factories.append(MeshObjectFactory(mesh=mesh))
+
+    def surface_bounding_box(self, padding=0., padding_ratio=0.):
+        ranges = np.stack([obj_factory.bounding_box() for obj_factory in self.obj_factories])
+        ranges = np.stack((ranges[:, :, 0].min(axis=0), ranges[:, :, 1].max(axis=0)), axis=-1)
+        extents = ranges[:, 1] - ranges[:, 0]
+        ranges[:, 0] -= padding + padding_ratio * extents
+        ranges[:, 1] += padding + padding_ratio * extents
+        return torch.tensor(ranges)
+
+    def __call__(self, points_in_object_frame, compute_grad=True):
+        res = [obj_factory.object_frame_closest_point(points_in_object_frame) for obj_factory in self.obj_factories]
+        # SDF of the union is from the closest part
+        sdf, part = torch.stack([r.distance for r in res]).min(dim=0)
+        part = part.unsqueeze(0).unsqueeze(-1).expand(1, *part.shape, points_in_object_frame.shape[-1])
+        sdf_grad = None
+        if compute_grad:
+            sdf_grad = torch.stack([r.gradient for r in res]).gather(0, part)[0]
+
+        if self.vis is not None:
+            pts = points_in_object_frame.reshape(-1, points_in_object_frame.shape[-1])
+            closest = torch.stack([r.closest for r in res]).gather(0, part)[0].reshape(pts.shape)
+            for i in range(pts.shape[0]):
+                self.vis.draw_point("test_point", pts[i], color=(1, 0, 0), length=0.005)
+                self.vis.draw_point("test_point_surf", closest[i], color=(0, 1, 0), length=0.005,
+                                    label=f'{sdf.reshape(-1)[i].item():.5f}')
         return sdf, sdf_grad
 
 
@@ -0,0 +1,343 @@
+import pathlib
+import random
+import tempfile
+import numpy as np
+import pybullet as p
+import pytest
+import torch
+import pytorch_kinematics as pk
+from arm_pytorch_utilities import math_utils
+from base_experiments import cfg
+from base_experiments.env.bubble import StepInfoBuffers, FloatingGripperEnv, Levels, GroundTruthLogging, \
+    angle_between, transform_between_poses
+from base_experiments.env.env import InfoKeys, Mode
+from base_experiments.env.pybullet_env import ContactInfo, PhysicsPreset, closest_point_on_surface
+
+
+def test_step_info_buffers():
+    buffers = StepInfoBuffers(2)
+    values = [np.array([i, i + 1, i + 2]) for i in range(5)]
+    for v in values:
+        buffers.append('pos', v)
+    # grows past its capacity
+    arrays = buffers.arrays()
+    assert arrays['pos'].dtype == np.stack(values).dtype
+    assert np.array_equal(arrays['pos'], np.stack(values))
+
+    # promotes the dtype like stacking would
+    buffers.append('pos', np.array([0.5, 1, 2]))
+    assert buffers.arrays()['pos'].dtype == np.float64
+    assert np.array_equal(buffers.arrays()['pos'], np.stack(values + [np.array([0.5, 1, 2])]))
+
+    # cleared buffers are reused, and what was returned before is unaffected
+    buffers.clear()
+    assert buffers.arrays() == {}
+    buffers.append('pos', [3., 2, 1])
+    buffers.append('id', 7)
+    new_arrays = buffers.arrays()
+    assert np.array_equal(new_arrays['pos'], [[3, 2, 1]])
+    assert np.array_equal(new_arrays['id'], [7])
+    assert np.array_equal(arrays['pos'], np.stack(values))
+
+    # a buffer is kept across control steps whose values have a narrower dtype
+    buffer = buffers._buffers['pos']
+    buffers.clear()
+    buffers.append('pos', [3, 2, 1])
+    assert buffers._buffers['pos'] is buffer
+    assert buffers.arrays()['pos'].dtype == np.float64
+    assert np.array_equal(buffers.arrays()['pos'], [[3, 2, 1]])
+
+    # values of a different shape are an error rather than broadcast
+    with pytest.raises(ValueError):
+        buffers.append('pos', 1.)
+    with pytest.raises(ValueError):
+        buffers.append('pos', [1, 2])
+    assert np.array_equal(buffers.arrays()['pos'], [[3, 2, 1]])
+    # after clearing, a key can start over with a different shape
+    buffers.clear()
+    buffers.append('pos', [1, 2])
+    assert np.array_equal(buffers.arrays()['pos'], [[1, 2]])
+
+
+def object_states(env):
+    return [(p.getBasePositionAndOrientation(obj, physicsClientId=env.physics_client),
+             p.getBaseVelocity(obj, physicsClientId=env.physics_client),
+             p.getDynamicsInfo(obj, -1, physicsClientId=env.physics_client)[:2]) for obj in env.movable]
+
+
+def disturb_objects(env, change_dynamics=True):
+    for i, obj in enumerate(env.movable):
+        p.resetBasePositionAndOrientation(obj, [0.5 + 0.3 * i, -0.5, 0.3], p.getQuaternionFromEuler([0.2, 0, 1]),
+                                          physicsClientId=env.physics_client)
+        p.resetBaseVelocity(obj, [0.3, 0, 0], [0, 0, 1], physicsClientId=env.physics_client)
+        if change_dynamics:
+            p.changeDynamics(obj, -1, mass=5, physicsClientId=env.physics_client)
+
+
+def test_pooled_objects_reset():
+    fresh = FloatingGripperEnv(environment_level=Levels.SELECT2, mode=Mode.DIRECT)
+    pooled = FloatingGripperEnv(environment_level=Levels.SELECT2, mode=Mode.DIRECT, pool_objects=True)
+    pooled_ids = list(pooled.movable)
+    for env in (fresh, pooled):
+        disturb_objects(env)
+        env._setup_or_restore_objects()
+    # the pooled objects are kept and put back to how a fresh setup creates them
+    assert pooled.movable == pooled_ids
+    assert object_states(pooled) == object_states(fresh)
+
+    for env in (fresh, pooled):
+        disturb_objects(env)
+        env.reset()
+    # settling can differ slightly since pybullet keeps the contacts of kept bodies between steps
+    for (pose, vel, _), (fresh_pose, fresh_vel, _) in zip(object_states(pooled), object_states(fresh)):
+        assert np.allclose(pose[0], fresh_pose[0], atol=1e-3) and np.allclose(pose[1], fresh_pose[1], atol=1e-3)
+        assert np.allclose(vel, fresh_vel, atol=1e-3)
+    fresh.close()
+    pooled.close()
+
+
+def run_episode(env, actions):
+    states = [env.reset()]
+    objects = [object_states(env)]
+    for action in actions:
+        state, _, _, _ = env.step(action)
+        states.append(state)
+        objects.append(object_states(env))
+    return np.stack(states), objects
+
+
+def assert_objects_close(objects, other_objects):
+    # contacts cached by pybullet are not part of the saved state, so the objects can settle slightly differently
+    for states, other_states in zip(objects, other_objects):
+        for (pose, vel, dynamics), (other_pose, other_vel, other_dynamics) in zip(states, other_states):
+            assert np.allclose(pose[0], other_pose[0], atol=1e-3) and np.allclose(pose[1], other_pose[1], atol=1e-3)
+            assert np.allclose(vel, other_vel, atol=1e-2)
+            assert dynamics == other_dynamics
+
+
+def test_snapshot_resets():
+    actions = np.random.RandomState(0).uniform(-1, 1, (2, FloatingGripperEnv.nu))
+    full = FloatingGripperEnv(environment_level=Levels.SELECT2, mode=Mode.DIRECT)
+    snapshot = FloatingGripperEnv(environment_level=Levels.SELECT2, mode=Mode.DIRECT, snapshot_resets=True)
+    full_states, full_objects = run_episode(full, actions)
+    states, objects = run_episode(snapshot, actions)
+    assert np.array_equal(states, full_states) and objects == full_objects
+
+    # the second reset restores the snapshot saved by the first, so the episodes play out the same;
+    # episodes don't change dynamics so the state saved by pybullet doesn't include them
+    for env in (full, snapshot):
+        disturb_objects(env, change_dynamics=False)
+    full_states, full_objects = run_episode(full, actions)
+    restored_states, restored_objects = run_episode(snapshot, actions)
+    assert np.array_equal(restored_states, states)
+    assert_objects_close(restored_objects, objects)
+    # a full reset reloads and settles the objects again, so only its reset state is reproduced
+    assert np.array_equal(full_states[0], states[0])
+
+    # a body created after the snapshot prevents restoring it, so reset falls back to a full reset like the other env's
+    closest_point_on_surface(snapshot.movable[0], [0, 0, 0.1], physics_client=snapshot.physics_client)
+    disturb_objects(snapshot)
+    fallback_states, fallback_objects = run_episode(snapshot, actions)
+    assert np.array_equal(fallback_states, full_states) and fallback_objects == full_objects
+    # which saves a new snapshot for the resets after it
+    disturb_objects(snapshot, change_dynamics=False)
+    restored_states, restored_objects = run_episode(snapshot, actions)
+    assert np.array_equal(restored_states, fallback_states)
+    assert_objects_close(restored_objects, fallback_objects)
+    full.close()
+    snapshot.close()
+
+
+def body_poses(env):
+    return [p.getBasePositionAndOrientation(i, physicsClientId=env.physics_client) for i in
+            range(p.getNumBodies(physicsClientId=env.physics_client))]
+
+
+def test_scene_cache():
+    with tempfile.TemporaryDirectory() as tmp_dir, pytest.MonkeyPatch.context() as monkeypatch:
+        tmp_path = pathlib.Path(tmp_dir)
+        monkeypatch.setattr(cfg, 'DATA_DIR', tmp_dir)
+        action = [0.5, -0.3]
+        results = []
+        for _ in range(2):
+            env = FloatingGripperEnv(environment_level=Levels.RANDOM, mode=Mode.DIRECT, scene_cache_seed=3)
+            # the same random numbers follow whether the scene was generated or loaded
+            results.append((body_poses(env), env.state, random.random(), env.step(action)))
+            env.close()
+        assert len(list((tmp_path / "scene_cache").glob("*.bullet"))) == 1
+        # scenes settled under another physics preset are cached separately
+        FloatingGripperEnv(environment_level=Levels.RANDOM, mode=Mode.DIRECT, scene_cache_seed=3,
+                           physics_preset=PhysicsPreset.FAST).close()
+        assert len(list((tmp_path / "scene_cache").glob("*.bullet"))) == 2
+
+    (poses, state, rand, (next_state, _, _, info)), (cached_poses, cached_state, cached_rand, cached_step) = results
+    assert cached_poses == poses
+    assert np.array_equal(cached_state, state)
+    assert cached_rand == rand
+    assert np.array_equal(cached_step[0], next_state)
+    assert info.keys() == cached_step[3].keys()
+    for k, v in info.items():
+        # pybullet does not save its cached contacts, so they can be found in a different order after loading and the
+        # first one is reported as the contact point
+        if k != InfoKeys.HIGH_FREQ_CONTACT_POINT:
+            assert np.array_equal(cached_step[3][k], v)
+
+
+def record_control_steps(env):
+    """Record the (sim step, mini step, sim steps since its start) of each observation and each mini step's contact"""
+    observed, mini_step_contacts = [], []
+    observe, aggregate = env._observe_additional_info, env._aggregate_info
+
+    def observe_additional_info(info, visualize=True):
+        observed.append((env._sim_step, env._mini_step, env._mini_step_position()[1]))
+        observe(info, visualize)
+
+    def aggregate_info():
+        mini_step_contacts.append({k: np.copy(v) for k, v in env._mini_step_contact.items()})
+        return aggregate()
+
+    env._observe_additional_info = observe_additional_info
+    env._aggregate_info = aggregate_info
+    return observed, mini_step_contacts
+
+
+def test_observe_every_sim_steps():
+    action = [0.7, -0.4]
+    infos = []
+    for observe_every_sim_steps in (1, 7):
+        env = FloatingGripperEnv(environment_level=Levels.SELECT2, mode=Mode.DIRECT,
+                                 observe_every_sim_steps=observe_every_sim_steps)
+        observed, mini_step_contacts = record_control_steps(env)
+        state, _, _, info = env.step(action)
+        infos.append((state, info, observed, mini_step_contacts[0]))
+        reaction_sample_step = env._steps_since_start_to_get_reaction
+        mini_steps = env.mini_steps
+        env.close()
+    (state, info, observed, contact), (decimated_state, decimated_info, decimated_observed, decimated_contact) = infos
+
+    assert len(observed) == len(info[InfoKeys.HIGH_FREQ_REACTION_F])
+    assert len(observed) > len(decimated_observed) == len(decimated_info[InfoKeys.HIGH_FREQ_REACTION_F])
+    # every reaction force sample and end of mini step is still observed
+    sampled = [o for o in observed if o[2] == reaction_sample_step]
+    end_of_mini_step = [[o for o in observed if o[1] == mini_step][-1] for mini_step in range(mini_steps)]
+    assert len(sampled) and set(sampled + end_of_mini_step) <= set(decimated_observed)
+    # and observed the same as when observing every sim step
+    rows = [observed.index(o) for o in decimated_observed]
+    for key in (InfoKeys.HIGH_FREQ_REACTION_F, InfoKeys.HIGH_FREQ_REACTION_T, InfoKeys.HIGH_FREQ_EE_POSE,
+                InfoKeys.HIGH_FREQ_CONTACT_POINT):
+        assert np.array_equal(decimated_info[key], info[key][rows])
+    assert np.any(contact['mag'])
+    for k in contact:
+        assert np.array_equal(decimated_contact[k], contact[k])
+    assert np.array_equal(decimated_state, state)
+    assert decimated_info[InfoKeys.CONTACT_ID] == info[InfoKeys.CONTACT_ID]
+    assert np.array_equal(decimated_info[InfoKeys.LOW_FREQ_REACTION_F], info[InfoKeys.LOW_FREQ_REACTION_F])
+
+
+def test_converge_pos_tolerance():
+    env = FloatingGripperEnv(environment_level=Levels.SELECT2, mode=Mode.DIRECT, converge_pos_tolerance=1e-3)
+    observed, mini_step_contacts = record_control_steps(env)
+    sim_steps = []
+    step_simulation = p.stepSimulation
+
+    def count_step_simulation(*args, **kwargs):
+        sim_steps.append(1)
+        return step_simulation(*args, **kwargs)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(p, 'stepSimulation', count_step_simulation)
+        _, _, _, info = env.step([0, 0])
+    # already at the target, so each mini step ends once its reaction force is sampled
+    reaction_sample_step = env._steps_since_start_to_get_reaction
+    assert info[InfoKeys.SIM_STEPS] == len(sim_steps) == env.mini_steps * (reaction_sample_step + 2)
+    assert len(sim_steps) < env.mini_steps * (env.wait_sim_step_per_mini_step + 1)
+
+    # each mini step's reaction force sample goes in its own slot
+    contact = mini_step_contacts[0]
+    for mini_step in range(env.mini_steps):
+        rows = [i for i, o in enumerate(observed) if o[1:] == (mini_step, reaction_sample_step)]
+        assert len(rows) == 1
+        assert np.array_equal(contact['full'][mini_step], info[InfoKeys.HIGH_FREQ_REACTION_F][rows[0]])
+        assert np.linalg.norm(contact['full'][mini_step]) > 0
+    assert not np.any(contact['full'][env.mini_steps])
+    env.close()
+
+
+def test_ground_truth_logging():
+    for logging in GroundTruthLogging:
+        env = FloatingGripperEnv(environment_level=Levels.SELECT2, mode=Mode.DIRECT, ground_truth_logging=logging,
+                                 ground_truth_distance=0.5)
+        far = env.movable[-1]
+        p.resetBasePositionAndOrientation(far, [3, 3, 0.1], [0, 0, 0, 1], physicsClientId=env.physics_client)
+        _, _, _, info = env.step([0, 0])
+        keys = {InfoKeys.OBJ_IDS, InfoKeys.OBJ_POSES, InfoKeys.OBJ_DISTANCES}
+        # the per object keys these replaced are not logged anymore
+        assert not any(k.startswith('obj') for k in info if k not in keys)
+        if logging is GroundTruthLogging.OFF:
+            assert not keys & info.keys()
+            env.close()
+            continue
+
+        objects = env.movable + env.immovable
+        assert np.array_equal(info[InfoKeys.OBJ_IDS], objects)
+        for obj, pose in zip(objects, info[InfoKeys.OBJ_POSES]):
+            pos, orientation = p.getBasePositionAndOrientation(obj, physicsClientId=env.physics_client)
+            assert np.array_equal(pose, np.r_[pos, orientation])
+        if logging is GroundTruthLogging.POSES:
+            assert InfoKeys.OBJ_DISTANCES not in info
+            env.close()
+            continue
+
+        for obj, distance in zip(objects, info[InfoKeys.OBJ_DISTANCES]):
+            closest = p.getClosestPoints(obj, env.robot_id, 100, physicsClientId=env.physics_client)
+            true_distance = min(c[ContactInfo.DISTANCE] for c in closest)
+            if obj == far:
+                assert true_distance > 0.5 and distance == np.inf
+            else:
+                assert true_distance < 0.5 and distance == pytest.approx(true_distance)
+        env.close()
+
+
+def random_pose(rng):
+    orientation = rng.randn(4)
+    return rng.uniform(-1, 1, 3).tolist(), (orientation / np.linalg.norm(orientation)).tolist()
+
+
+def torch_transform(pose):
+    return pk.Transform3d(matrix=pk.pos_rot_to_matrix(torch.tensor(pose[0]), torch.tensor(pose[1])))
+
+
+def test_transform_between_poses():
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        last_pose, pose = random_pose(rng), random_pose(rng)
+        pt = rng.uniform(-1, 1, 3)
+        tf = transform_between_poses(pose, last_pose)
+        prev_pt = p.multiplyTransforms(*tf, pt, (0, 0, 0, 1))[0]
+        # how the end effector displacement was computed with torch transforms
+        B_to_A_world = torch_transform(pose).compose(torch_transform(last_pose).inverse()).inverse()
+        expected = B_to_A_world.transform_points(torch.tensor(pt).view(1, -1)).numpy().flatten()
+        assert np.allclose(prev_pt, expected, atol=1e-6)
+        # a point at pose is where it was at last pose
+        assert np.allclose(p.multiplyTransforms(*tf, *pose)[0], last_pose[0], atol=1e-6)
+
+
+def test_angle_between():
+    rng = np.random.RandomState(0)
+    vectors = [rng.randn(2, 3) for _ in range(50)] + [np.array([[1., 0, 0], [1, 1e-9, 0]]),
+                                                       np.array([[1., 0, 0], [-1, 1e-9, 0]])]
+    for u, v in vectors:
+        expected = math_utils.angle_between_stable(torch.tensor(u).view(1, -1), torch.tensor(v).view(1, -1)).item()
+        assert angle_between(u, v) == pytest.approx(expected, abs=1e-9)
+
+
+if __name__ == "__main__":
+    test_step_info_buffers()
+    test_pooled_objects_reset()
+    test_snapshot_resets()
+    test_scene_cache()
+    test_observe_every_sim_steps()
+    test_converge_pos_tolerance()
+    test_ground_truth_logging()
+    test_transform_between_poses()
+    test_angle_between()
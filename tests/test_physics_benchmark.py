@@ -0,0 +1,37 @@
+from base_experiments.env.bubble import FloatingGripperEnv, Levels
+from base_experiments.env.physics_benchmark import rollout, benchmark, format_results
+from base_experiments.env.pybullet_env import PhysicsPreset
+
+
+def test_physics_benchmark():
+    actions = [[0.5, 0.5], [-0.5, 0.2]]
+    elapsed, sim_steps, sim_step_s, ee, obj = rollout(FloatingGripperEnv, Levels.SELECT3, PhysicsPreset.DEFAULT,
+                                                      actions)
+    assert elapsed > 0 and sim_steps > 0 and sim_step_s == 1. / 240
+    assert len(ee) == 2
+    assert obj.shape[0] == 2 and obj.shape[2] == 3
+
+    results = benchmark(FloatingGripperEnv, [Levels.SELECT3], steps=2)
+    assert [r['preset'] for r in results] == list(PhysicsPreset)
+    for r in results:
+        assert r['level'] is Levels.SELECT3
+        assert r['steps_per_s'] > 0 and r['realtime_factor'] > 0
+    accurate = results[-1]
+    assert accurate['ee_max'] == 0 and accurate['obj_max'] == 0
+
+    # the fast preset keeps objects that rest against the gripper in place
+    fast, default = benchmark(FloatingGripperEnv, [Levels.SELECT1], [PhysicsPreset.FAST, PhysicsPreset.DEFAULT],
+                              steps=2)
+    assert fast['obj_max'] < 0.05 and default['obj_max'] < 0.05
+
+    # levels that fail are reported rather than left out
+    failed = benchmark(FloatingGripperEnv, [Levels.SELECT3], steps=2, not_an_env_argument=True)
+    assert len(failed) == 1 and failed[0]['level'] is Levels.SELECT3 and 'not_an_env_argument' in failed[0]['error']
+
+    lines = format_results(results + failed).splitlines()
+    assert len(lines) == 1 + len(results) + 1
+    assert lines[-1].startswith('SELECT3') and 'failed' in lines[-1]
+
+
+if __name__ == "__main__":
+    test_physics_benchmark()
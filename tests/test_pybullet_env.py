@@ -1,6 +1,20 @@
+import importlib.util
+import inspect
+import os
+import threading
+
 import numpy as np
 import pybullet as p
-from base_experiments.env.pybullet_env import closest_point_on_surface, make_sphere
+import pytest
+import torch
+from base_experiments import cfg
+from base_experiments.env import pybullet_env
+from base_experiments.env.env import NullVisualizer
+from base_experiments.env.pybullet_env import closest_point_on_surface, closest_points_on_surface, make_sphere, \
+    make_box, closest_point_and_normal, surface_normal_at_point, SurfaceQueryCache, shape_cache_counts, \
+    clear_shape_cache, PybulletEnv, AABBCache, pybullet_obj_range, ContactInfo, contacts_to_array, \
+    get_total_contact_force, get_total_contact_forces, get_contact_wrench, OffscreenVideoRecorder, \
+    get_contacts_by_body, IKSolver, DebugDrawer
 
 
 def test_closest_point_on_surface():
@@ -14,5 +28,433 @@ def test_closest_point_on_surface():
     p.disconnect(clientID)
 
 
+def test_closest_points_on_surface():
+    clientID = p.connect(p.DIRECT)
+    r = 1
+    objId = make_sphere(r, [0., 0, 0])
+
+    query_pts = np.array([[0.1, 0, 0], [0, 2, 0], [0, 0, -0.5]])
+    dist, surface_pts, normals = closest_points_on_surface(objId, query_pts)
+    assert np.allclose(dist, [-0.9, 1, -0.5])
+    assert np.allclose(surface_pts, [[r, 0, 0], [0, r, 0], [0, 0, -r]])
+    assert np.allclose(normals, [[1, 0, 0], [0, 1, 0], [0, 0, -1]])
+    for i, pt in enumerate(query_pts):
+        closest = closest_point_on_surface(objId, pt)
+        assert np.allclose(closest[5], surface_pts[i])
+
+    dist, surface_pts, normals = closest_points_on_surface(objId, torch.tensor(query_pts, dtype=torch.float32))
+    assert torch.is_tensor(dist) and dist.dtype == torch.float32
+    assert torch.allclose(dist, torch.tensor([-0.9, 1, -0.5]))
+
+    p.disconnect(clientID)
+
+
+def test_closest_point_and_normal():
+    clientID = p.connect(p.DIRECT)
+    objId = make_box([0.2, 0.3, 0.1], [0., 0, 0], [0, 0, 0], physics_client=clientID)
+
+    dist, pt, normal = closest_point_and_normal(objId, [0, 0, 0.3], physics_client=clientID)
+    assert np.allclose(dist, 0.2)
+    assert np.allclose(pt, [0, 0, 0.1])
+    assert np.allclose(normal, [0, 0, 1])
+    dist, pt, normal = closest_point_and_normal(objId, [0.19, 0, 0], physics_client=clientID)
+    assert np.allclose(dist, -0.01)
+    assert np.allclose(normal, [1, 0, 0])
+    assert np.allclose(surface_normal_at_point(objId, [0, 0, 0.3], physics_client=clientID), [0, 0, -1])
+
+    dist, pt, normal = closest_point_and_normal(objId, [0, 0, 0.3], max_distance=0.15, physics_client=clientID)
+    assert dist == np.inf
+
+    p.disconnect(clientID)
+
+
+def test_closest_points_beyond_max_distance():
+    clientID = p.connect(p.DIRECT)
+    objId = make_sphere(1, [0., 0, 0], physics_client=clientID)
+    closest_point_and_normal(objId, [0, 0, 1.1], physics_client=clientID)
+    tester_shape = pybullet_env._CONTACT_TESTER_SHAPE_ID[clientID]
+
+    far_pts = [[0, 0, 3], [5, 0, 0], [0, -2, 0]]
+    for _ in range(3):
+        dist, _, _ = closest_points_on_surface(objId, far_pts, max_distance=0.5, physics_client=clientID)
+        assert np.all(dist == np.inf)
+    # misses reuse the tester shape rather than creating new ones
+    assert pybullet_env._CONTACT_TESTER_SHAPE_ID[clientID] == tester_shape
+    assert p.createCollisionShape(p.GEOM_SPHERE, radius=0.1, physicsClientId=clientID) == tester_shape + 1
+    p.disconnect(clientID)
+
+
+def test_closest_point_on_surface_multiple_clients():
+    clientA = p.connect(p.DIRECT)
+    clientB = p.connect(p.DIRECT)
+    objA = make_sphere(1, [0., 0, 0], physics_client=clientA)
+    objB = make_sphere(0.5, [0., 0, 0], physics_client=clientB)
+
+    for _ in range(2):
+        pt = closest_point_on_surface(objA, [0, 0.1, 0], return_full_contact_info=False, physics_client=clientA)
+        assert np.allclose(pt, [0, 1, 0])
+        pt = closest_point_on_surface(objB, [0, 0.1, 0], return_full_contact_info=False, physics_client=clientB)
+        assert np.allclose(pt, [0, 0.5, 0])
+        dist = closest_points_on_surface(objB, [[0, 0, 1]], physics_client=clientB)[0]
+        assert np.allclose(dist, [0.5])
+
+    p.disconnect(clientA)
+    p.disconnect(clientB)
+
+
+def test_surface_query_cache():
+    clientID = p.connect(p.DIRECT)
+    objId = make_sphere(1, [0., 0, 0], physics_client=clientID)
+    cache = SurfaceQueryCache(max_size=2, physics_client=clientID)
+
+    for _ in range(2):
+        pt = cache.closest_point_on_surface(objId, [0, 0.1, 0], return_full_contact_info=False)
+        assert np.allclose(pt, [0, 1, 0])
+    assert cache.hits == 1 and cache.misses == 1
+
+    # moving the body drops its cached queries
+    p.resetBasePositionAndOrientation(objId, [0, 1, 0], [0, 0, 0, 1], physicsClientId=clientID)
+    pt = cache.closest_point_on_surface(objId, [0, 1.1, 0], return_full_contact_info=False)
+    assert np.allclose(pt, [0, 2, 0])
+    assert cache.misses == 2 and len(cache) == 1
+
+    # least recently used query is evicted
+    cache.surface_normal_at_point(objId, [0, 1.1, 0])
+    cache.closest_point_on_surface(objId, [0.1, 1, 0])
+    assert len(cache) == 2
+    cache.closest_point_on_surface(objId, [0, 1.1, 0])
+    assert cache.misses == 5
+
+    p.disconnect(clientID)
+
+
+def test_shape_cache():
+    clientID = p.connect(p.DIRECT)
+    clear_shape_cache(clientID)
+    boxes = [make_box([0.1, 0.2, 0.3], [i, 0, 0], [0, 0, 0], physics_client=clientID) for i in range(3)]
+    make_sphere(0.1, [0, 0, 1], physics_client=clientID)
+    assert shape_cache_counts(clientID) == {'created': 4, 'reused': 4}
+    for objId in boxes:
+        assert p.getCollisionShapeData(objId, -1, physicsClientId=clientID)[0][3] == (0.2, 0.4, 0.6)
+    p.disconnect(clientID)
+
+    # reconnecting may give the same client ID, but the previously created shapes are gone
+    clientID = p.connect(p.DIRECT)
+    objId = make_sphere(0.1, [0, 0, 1], physics_client=clientID)
+    assert p.getCollisionShapeData(objId, -1, physicsClientId=clientID)[0][3] == (0.1, 0.1, 0.1)
+    objId = make_box([0.1, 0.2, 0.3], [0, 0, 0], [0, 0, 0], physics_client=clientID)
+    assert p.getCollisionShapeData(objId, -1, physicsClientId=clientID)[0][3] == (0.2, 0.4, 0.6)
+    p.disconnect(clientID)
+
+
+def test_base_link_frames():
+    clientID = p.connect(p.DIRECT)
+    # objects whose center of mass is away from their base link frame
+    urdfs = ["YcbMustardBottle/model.urdf", "mug_dbl.urdf"]
+    objIds = [p.loadURDF(os.path.join(cfg.URDF_DIR, urdf), physicsClientId=clientID) for urdf in urdfs]
+    poses = [([0.1, 0.2, 0.3], [0.3, -0.5, 1.2]), ([-0.4, 0, 0.1], [0, 0, -2])]
+    for objId, (pos, rpy) in zip(objIds, poses):
+        PybulletEnv.reset_base_link_frame(objId, pos, rpy, physics_client=clientID)
+
+    tf = PybulletEnv.get_base_link_frames(objIds, physics_client=clientID)
+    m = tf.get_matrix()
+    assert m.shape == (2, 4, 4)
+    for i, (objId, (pos, rpy)) in enumerate(zip(objIds, poses)):
+        assert torch.allclose(m[i, :3, 3], torch.tensor(pos), atol=1e-5)
+        rot = np.array(p.getMatrixFromQuaternion(p.getQuaternionFromEuler(rpy))).reshape(3, 3)
+        assert torch.allclose(m[i, :3, :3], torch.tensor(rot, dtype=m.dtype), atol=1e-5)
+        assert torch.allclose(PybulletEnv.get_base_link_frame(objId, physics_client=clientID).get_matrix()[0], m[i])
+
+    # a new body that reuses the ID of a removed one should not use its center of mass
+    p.removeBody(objIds[1], physicsClientId=clientID)
+    objId = make_box([0.1, 0.2, 0.3], [0.5, 0, 0], [0, 0, 0], physics_client=clientID)
+    assert objId == objIds[1]
+    assert torch.allclose(PybulletEnv.get_base_link_frame(objId, physics_client=clientID).get_matrix()[0, :3, 3],
+                          torch.tensor([0.5, 0, 0]))
+    p.removeBody(objId, physicsClientId=clientID)
+    objId = p.loadURDF(os.path.join(cfg.URDF_DIR, urdfs[0]), physicsClientId=clientID)
+    assert objId == objIds[1]
+    PybulletEnv.reset_base_link_frame(objId, *poses[1], physics_client=clientID)
+    m = PybulletEnv.get_base_link_frame(objId, physics_client=clientID).get_matrix()[0]
+    assert torch.allclose(m[:3, 3], torch.tensor(poses[1][0]), atol=1e-5)
+    p.disconnect(clientID)
+
+
+def test_com_tf():
+    clientID = p.connect(p.DIRECT)
+    objId = p.loadURDF(os.path.join(cfg.URDF_DIR, "mug_dbl.urdf"), physicsClientId=clientID)
+    com = p.getDynamicsInfo(objId, -1, physicsClientId=clientID)[3]
+    tf = PybulletEnv.get_com_tf(objId, physics_client=clientID)
+    assert torch.allclose(tf.get_matrix()[0, :3, 3], torch.tensor(com, dtype=tf.dtype))
+
+    # callers get their own transforms
+    other = PybulletEnv.get_com_tf(objId, physics_client=clientID)
+    assert torch.allclose(other.get_matrix(), tf.get_matrix())
+    tf._matrix[0, 0, 3] += 1
+    assert torch.allclose(PybulletEnv.get_com_tf(objId, physics_client=clientID).get_matrix(), other.get_matrix())
+    assert PybulletEnv.get_com_tf(objId, physics_client=clientID) is not other
+
+    # a body reusing the ID of one removed directly gets its own center of mass, as it does after a reset
+    p.removeBody(objId, physicsClientId=clientID)
+    objId = p.loadURDF(os.path.join(cfg.URDF_DIR, "YcbMustardBottle/model.urdf"), physicsClientId=clientID)
+    new_com = p.getDynamicsInfo(objId, -1, physicsClientId=clientID)[3]
+    assert not np.allclose(new_com, com)
+    tf = PybulletEnv.get_com_tf(objId, physics_client=clientID)
+    assert torch.allclose(tf.get_matrix()[0, :3, 3], torch.tensor(new_com, dtype=tf.dtype))
+    p.resetSimulation(physicsClientId=clientID)
+    objId = p.loadURDF(os.path.join(cfg.URDF_DIR, "mug_dbl.urdf"), physicsClientId=clientID)
+    tf = PybulletEnv.get_com_tf(objId, physics_client=clientID)
+    assert torch.allclose(tf.get_matrix()[0, :3, 3], torch.tensor(com, dtype=tf.dtype))
+    p.disconnect(clientID)
+
+
+def test_aabb_cache():
+    clientID = p.connect(p.DIRECT)
+    wall = make_box([0.1, 1, 0.5], [1, 0, 0.5], [0, 0, 0], physics_client=clientID)
+    boxes = [make_box([0.05, 0.05, 0.05], [i * 0.3, 0, 0.05], [0, 0, 0], physics_client=clientID) for i in range(3)]
+    cache = AABBCache(static_ids=[wall], physics_client=clientID)
+    for objId in [wall] + boxes:
+        assert np.allclose(cache.obj_range(objId, padding=0.1), pybullet_obj_range(objId, 0.1, physics_client=clientID))
+    assert np.allclose(cache.obj_ranges(boxes), np.stack([pybullet_obj_range(objId, physics_client=clientID)
+                                                          for objId in boxes]))
+
+    # moved bodies are recomputed
+    p.resetBasePositionAndOrientation(boxes[0], [0.9, 0, 0.05], [0, 0, 0, 1], physicsClientId=clientID)
+    assert np.allclose(cache.obj_range(boxes[0]), pybullet_obj_range(boxes[0], physics_client=clientID))
+
+    region = np.array([[0.8, 1.2], [-0.1, 0.1], [0, 0.2]])
+    assert set(cache.overlapping(region)) == {wall, boxes[0]}
+    assert list(cache.overlapping(region, obj_ids=boxes)) == [boxes[0]]
+    assert len(cache.overlapping(region, obj_ids=[])) == 0
+    p.disconnect(clientID)
+
+
+def test_contact_array():
+    clientID = p.connect(p.DIRECT)
+    p.setGravity(0, 0, -10, physicsClientId=clientID)
+    ground = make_box([1, 1, 0.1], [0, 0, -0.1], [0, 0, 0], physics_client=clientID)
+    objId = p.createMultiBody(1, p.createCollisionShape(p.GEOM_BOX, halfExtents=[0.05, 0.1, 0.05],
+                                                        physicsClientId=clientID),
+                              basePosition=[0, 0, 0.05], baseOrientation=p.getQuaternionFromEuler([0, 0, 0.3]),
+                              physicsClientId=clientID)
+    p.resetBaseVelocity(objId, [0.3, 0.1, 0], physicsClientId=clientID)
+    for _ in range(10):
+        p.stepSimulation(physicsClientId=clientID)
+    contacts = p.getContactPoints(objId, ground, physicsClientId=clientID)
+    assert len(contacts) > 1
+
+    c = contacts_to_array(contacts)
+    assert c.shape == (len(contacts),)
+    for i, contact in enumerate(contacts):
+        for field in ContactInfo:
+            assert np.allclose(c[field.name][i], contact[field])
+
+    forces = get_total_contact_forces(c)
+    assert np.allclose(forces, [get_total_contact_force(contact) for contact in contacts])
+    origin = [0.1, 0, 0.2]
+    force, torque = get_contact_wrench(contacts, origin)
+    assert np.allclose(force, forces.sum(axis=0))
+    assert np.allclose(torque, sum(np.cross(np.subtract(contact[ContactInfo.POS_A], origin), f)
+                                   for contact, f in zip(contacts, forces)))
+    force, torque = get_contact_wrench([], origin)
+    assert np.allclose(force, 0) and np.allclose(torque, 0)
+    p.disconnect(clientID)
+
+
+def test_contacts_by_body():
+    clientID = p.connect(p.DIRECT)
+    p.setGravity(0, 0, -10, physicsClientId=clientID)
+    ground = make_box([1, 1, 0.1], [0, 0, -0.1], [0, 0, 0], physics_client=clientID)
+    shape = p.createCollisionShape(p.GEOM_BOX, halfExtents=[0.05, 0.05, 0.05], physicsClientId=clientID)
+    objs = [p.createMultiBody(1, shape, basePosition=[x, 0, 0.05], physicsClientId=clientID) for x in (0, 0.1)]
+    p.resetBaseVelocity(objs[0], [0.3, 0.1, 0], physicsClientId=clientID)
+    for _ in range(10):
+        p.stepSimulation(physicsClientId=clientID)
+    assert set(get_contacts_by_body(ground, physics_client=clientID)) == set(objs)
+
+    for body in [ground] + objs:
+        by_body = get_contacts_by_body(body, physics_client=clientID)
+        flipped = get_contacts_by_body(body, flip=True, physics_client=clientID)
+        assert set(by_body) == set(flipped) == {other for other in [ground] + objs if other != body and len(
+            p.getContactPoints(body, other, physicsClientId=clientID))}
+        for other in by_body:
+            # same values as querying the pair from either side
+            assert by_body[other] == list(p.getContactPoints(body, other, physicsClientId=clientID))
+            assert flipped[other] == list(p.getContactPoints(other, body, physicsClientId=clientID))
+    p.disconnect(clientID)
+
+
+def test_ik_solver():
+    import pybullet_data
+    clientID = p.connect(p.DIRECT)
+    p.setAdditionalSearchPath(pybullet_data.getDataPath(), physicsClientId=clientID)
+    arm = p.loadURDF("kuka_iiwa/model.urdf", useFixedBase=True, physicsClientId=clientID)
+    ik = IKSolver(arm, 6, physics_client=clientID)
+    orientation = p.getQuaternionFromEuler([0, np.pi, 0])
+    target = [0.5, 0.1, 0.4]
+
+    # without a seed it starts from the current joints like calculateInverseKinematics does
+    joints = ik.solve(target, orientation)
+    assert joints == p.calculateInverseKinematics(arm, 6, target, orientation, physicsClientId=clientID)
+    assert ik.solve(target, orientation) == joints
+    assert ik.hits == 1 and ik.misses == 1
+
+    # a seed is solved from without disturbing the arm's state
+    for j in ik.dof_joints:
+        p.resetJointState(arm, j, 0.2, targetVelocity=0.1, physicsClientId=clientID)
+    state = p.getJointStates(arm, ik.dof_joints, physicsClientId=clientID)
+    seed = [0.5] * len(ik.dof_joints)
+    seeded = ik.solve(target, orientation, seed=seed)
+    assert p.getJointStates(arm, ik.dof_joints, physicsClientId=clientID) == state
+    for j, q in zip(ik.dof_joints, seed):
+        p.resetJointState(arm, j, q, physicsClientId=clientID)
+    assert seeded == p.calculateInverseKinematics(arm, 6, target, orientation, physicsClientId=clientID)
+
+    waypoints = [[0.5, 0.1 + 0.02 * i, 0.4] for i in range(5)]
+    solutions = ik.solve_waypoints(waypoints, orientation)
+    assert len(solutions) == len(waypoints)
+    assert ik.solve_waypoints(waypoints, orientation) == solutions
+    # each waypoint is solved starting from the last solution
+    assert ik.solve(waypoints[2], orientation, seed=solutions[1]) == solutions[2]
+    p.disconnect(clientID)
+
+
+def test_null_visualizer():
+    vis = NullVisualizer()
+    # can stand in for the debug drawer
+    for name, method in inspect.getmembers(DebugDrawer, inspect.isfunction):
+        if name.startswith('_'):
+            continue
+        # takes the required arguments of the drawer method
+        params = [param for param in inspect.signature(method).parameters.values() if param.name != 'self' and
+                  param.default is param.empty and param.kind is param.POSITIONAL_OR_KEYWORD]
+        inspect.signature(getattr(vis, name)).bind(*[None] * len(params))
+    assert vis.draw_mesh('mesh', 'mesh.obj', ([0, 0, 0], [0, 0, 0, 1]), object_id=3) == 3
+    with pytest.raises(AttributeError):
+        vis.draw_pont('typo', [0, 0, 0])
+
+
+class FakeDebugItems:
+    """Hands out debug item IDs like the GUI does, since without a GUI pybullet gives -1 for every debug item"""
+
+    def __init__(self):
+        self.created = 0
+
+    def add(self, *args, replaceItemUniqueId=-1, **kwargs):
+        if replaceItemUniqueId >= 0:
+            return replaceItemUniqueId
+        self.created += 1
+        return self.created - 1
+
+
+def test_debug_drawer_reuses_items():
+    clientID = p.connect(p.DIRECT)
+    items = FakeDebugItems()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(p, 'addUserDebugLine', items.add)
+        monkeypatch.setattr(p, 'addUserDebugText', items.add)
+        dd = DebugDrawer(0, 1, physics_client=clientID, max_transitions=5)
+
+        # transitions are bounded, with the oldest replaced once full
+        for i in range(12):
+            dd.draw_transition([i, 0], [i + 1, 0])
+        assert len(dd._debug_ids['t']) == 5 and items.created == 5
+
+        dd.draw_2d_lines('lines', np.zeros((4, 3)), np.ones((4, 3)))
+        assert items.created == 9
+        dd.draw_2d_lines('lines', np.zeros((2, 3)), np.ones((2, 3)))
+        assert len(dd._hidden_line_ids) == 2
+        # hidden lines are reused by later draws instead of adding new lines
+        dd.draw_point('pt', [0, 0, 0])
+        assert items.created == 9 and len(dd._hidden_line_ids) == 0
+
+        # text can't be reused as lines so it doesn't go into the pool
+        dd.draw_text('txt', 'hello', 1)
+        assert items.created == 10
+        dd.clear_visualizations(['txt', 'pt'])
+        assert len(dd._hidden_line_ids) == 2
+        dd.clear_transitions()
+        assert len(dd._hidden_line_ids) == 7 and len(set(dd._hidden_line_ids)) == 7
+        dd.draw_transition([0, 0], [1, 0])
+        assert items.created == 10 and len(dd._hidden_line_ids) == 6
+
+        # clearing everything removes the items, so none can be reused
+        dd.clear_visualizations()
+        assert len(dd._hidden_line_ids) == 0 and len(dd._debug_ids) == 0
+        dd.draw_point('pt', [0, 0, 0])
+        assert items.created == 12
+    p.disconnect(clientID)
+
+
+class BlockingWriter:
+    def __init__(self):
+        self.frames = []
+        self.closed = False
+        self.unblock = threading.Event()
+
+    def append_data(self, frame):
+        self.unblock.wait()
+        self.frames.append(frame)
+
+    def close(self):
+        self.closed = True
+
+
+def test_offscreen_video_recorder():
+    clientID = p.connect(p.DIRECT)
+    make_box([0.1, 0.1, 0.1], [0, 0, 0.1], [0, 0, 0], physics_client=clientID)
+    writer = BlockingWriter()
+    recorder = OffscreenVideoRecorder("unused.mp4", width=64, height=48, camera_distance=1, max_queued_frames=2,
+                                      writer=writer, physics_client=clientID)
+    # the encoder gets stuck on the first frame it takes, so after the queue fills up, frames get dropped
+    for _ in range(6):
+        recorder.capture()
+    assert recorder.frames_captured + recorder.dropped_frames == 6
+    assert 2 <= recorder.frames_captured <= 3
+    assert recorder.capture_time > 0
+
+    writer.unblock.set()
+    recorder.close()
+    assert writer.closed
+    assert len(writer.frames) == recorder.frames_captured
+    assert writer.frames[0].shape == (48, 64, 3) and writer.frames[0].dtype == np.uint8
+    # the box is in view
+    assert len(np.unique(writer.frames[0].reshape(-1, 3), axis=0)) > 1
+    p.disconnect(clientID)
+
+
+def test_offscreen_video_recorder_without_egl():
+    clientID = p.connect(p.DIRECT)
+    find_spec = importlib.util.find_spec
+    writer = BlockingWriter()
+    writer.unblock.set()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(importlib.util, 'find_spec',
+                            lambda name: None if name == 'eglRenderer' else find_spec(name))
+        recorder = OffscreenVideoRecorder("unused.mp4", width=64, height=48, use_egl=True, writer=writer,
+                                          physics_client=clientID)
+    assert recorder.renderer == p.ER_TINY_RENDERER
+    recorder.capture()
+    recorder.close()
+    assert len(writer.frames) == 1
+    p.disconnect(clientID)
+
+
 if __name__ == "__main__":
     test_closest_point_on_surface()
+    test_closest_points_on_surface()
+    test_closest_point_and_normal()
+    test_closest_points_beyond_max_distance()
+    test_closest_point_on_surface_multiple_clients()
+    test_surface_query_cache()
+    test_shape_cache()
+    test_base_link_frames()
+    test_com_tf()
+    test_aabb_cache()
+    test_contact_array()
+    test_contacts_by_body()
+    test_ik_solver()
+    test_null_visualizer()
+    test_debug_drawer_reuses_items()
+    test_offscreen_video_recorder()
+    test_offscreen_video_recorder_without_egl()
@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+import pybullet as p
+import torch
+from base_experiments import cfg
+from base_experiments.env.pybullet_env import closest_points_on_surface, PybulletEnv
+from base_experiments.sdf import URDFMeshSDF
+
+
+def test_urdf_mesh_sdf_matches_pybullet():
+    clientID = p.connect(p.DIRECT)
+    rng = np.random.RandomState(0)
+    for urdf, global_scaling in [("YcbMustardBottle/model.urdf", 1), ("wall.urdf", 0.7), ("mug_dbl.urdf", 1)]:
+        urdf_file = os.path.join(cfg.URDF_DIR, urdf)
+        objId = p.loadURDF(urdf_file, globalScaling=global_scaling, useFixedBase=True, physicsClientId=clientID)
+        PybulletEnv.reset_base_link_frame(objId, [0, 0, 0], [0, 0, 0], physics_client=clientID)
+        sdf = URDFMeshSDF(urdf_file, global_scaling=global_scaling)
+
+        bb = sdf.surface_bounding_box(padding=0.05).numpy()
+        query_pts = torch.tensor(rng.uniform(bb[:, 0], bb[:, 1], size=(2, 100, 3)), dtype=torch.float)
+        d, grad = sdf(query_pts)
+        assert d.shape == (2, 100) and grad.shape == (2, 100, 3)
+
+        for b in range(2):
+            d_pb, _, normals = closest_points_on_surface(objId, query_pts[b], physics_client=clientID)
+            # pybullet has a 1mm collision margin on convex meshes
+            assert torch.allclose(d[b], d_pb, atol=2e-3)
+            # normals can differ where several surfaces are equally close
+            assert (grad[b] * normals).sum(dim=-1).median() > 0.99
+        p.removeBody(objId, physicsClientId=clientID)
+
+    p.disconnect(clientID)
+
+
+if __name__ == "__main__":
+    test_urdf_mesh_sdf_matches_pybullet()